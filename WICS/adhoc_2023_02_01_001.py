@@ -13,114 +13,84 @@ from django.shortcuts import render
 #from cMenu.models import getcParm
 from cMenu.utils import isDate, WrapInQuotes
 from userprofiles.models import WICSuser
-from mathematical_expressions_parser.eval import evaluate
-from WICS.models import ActualCounts, SAP_SOHRecs
+from WICS.models import ActualCounts
+from WICS.procs_ActualCounts import fnCTDQtyShown
+from WICS.procs_CountSummary import fnCountSummaryAccuracy
+from WICS.procs_SAP import fnSAPSnapshotDate, fnSAPSnapshotTotals
+from WICS.report_engine import ReportRowClass, SumOf, fnGroupedReport
 
 
+adhoc001DetailRow = ReportRowClass('adhoc001DetailRow', 'Detail', (
+        'CountDate', 'CycCtID', 'Material', 'ActCounter', 'BLDG', 'LOCATION', 'PKGID', 'TAGQTY',
+        'PossNotRec', 'MovDurCt', 'CTD_QTY_Expr', 'CTD_QTY_Eval', 'ActCountNotes'))
+adhoc001SummaryRow = ReportRowClass('adhoc001SummaryRow', 'Summary', (
+        'CountDate', 'SAPDate', 'SAPNum', 'TypicalContainerQty', 'TypicalPalletQty', 'Material', 'PartType',
+        'CountTotal', 'SAPTotal', 'Diff', 'Accuracy', 'MatlNotes'))
+
 
 @login_required
 def adhoc001(req):
     _userorg = WICSuser.objects.get(user=req.user).org
 
-    def CreateOutputRows(raw_qs, Eval_CTDQTY=True):
-        def SummaryLine(lastrow):
-            # summarize last Matl
-            # total SAP Numbers
-            if SAPRecs.filter(uploaded_at__date__lte=lastrow['CountDate']).exists():
-                SAPDate = SAPRecs.filter(org=_userorg, uploaded_at__date__lte=lastrow['CountDate']).latest().uploaded_at
-            else:
-                SAPDate = SAPRecs.filter(org=_userorg).order_by('uploaded_at').first().uploaded_at
-
-            SAPTot = 0
-            outputline = dict()
-            outputline['type'] = 'Summary'
-            outputline['CountDate'] = lastrow['CountDate']
-            outputline['SAPDate'] = SAPDate
-            outputline['SAPNum'] = []
-            for SAProw in SAPRecs.filter(uploaded_at=SAPDate,Material=lastrow['Material']): 
-                outputline['SAPNum'].append((SAProw.StorageLocation, SAProw.Amount))
-                SAPTot += SAProw.Amount
-            outputline['TypicalContainerQty'] = lastrow['TypicalContainerQty']
-            outputline['TypicalPalletQty'] = lastrow['TypicalPalletQty']
-            outputline['Material'] = lastrow['Material']
-            outputline['PartType'] = lastrow['PartType']
-            outputline['CountTotal'] = lastrow['TotalCounted']
-            outputline['SAPTotal'] = SAPTot
-            outputline['Diff'] = lastrow['TotalCounted'] - SAPTot
-            divsr = 1
-            if lastrow['TotalCounted']!=0 or SAPTot!=0: divsr = max(lastrow['TotalCounted'], SAPTot)
-            outputline['Accuracy'] = min(lastrow['TotalCounted'], SAPTot) / divsr * 100
-            outputline['MatlNotes'] = lastrow['MatlNotes']
-            #outputrows.append(outputline)
-
-            return outputline
-
-        def CreateLastrow(rawrow):
-            lastrow = dict()
-            lastrow['CountDate'] = rawrow.ac_CountDate
-            lastrow['Material'] = rawrow.Matl_PartNum
-            lastrow['PartType'] = rawrow.PartType
-            lastrow['TotalCounted'] = 0
-            lastrow['TypicalContainerQty'] = rawrow.TypicalContainerQty
-            lastrow['TypicalPalletQty'] = rawrow.TypicalPalletQty
-            lastrow['MatlNotes'] = rawrow.mtl_Notes
-
-            return lastrow
+    def CreateOutputRows(raw_qs):
+        def CTDQty(rawrow):
+            return fnCTDQtyShown(rawrow.ac_CTD_QTY_Expr, rawrow.ac_CTD_QTY_Eval, rawrow.ac_CTD_QTY_Status)
+
+        def SAPLookups(keys):
+            # the SAP totals of a chunk of (Material, CountDate), one query per SAP snapshot involved
+            bySAPDate = {}
+            for Matl, CountDate in keys:
+                bySAPDate.setdefault(fnSAPSnapshotDate(_userorg, CountDate), []).append((Matl, CountDate))
+            looked = {}
+            for SAPDate, SAPkeys in bySAPDate.items():
+                SAPTotals = fnSAPSnapshotTotals(_userorg, SAPDate, {Matl for Matl, CountDate in SAPkeys})
+                for key in SAPkeys:
+                    looked[key] = (SAPDate, SAPTotals.get(key[0], {}))
+            return looked
+
+        def SummaryLine(key, firstrow, totals, looked):
+            # summarize the Matl on the CountDate
+            SAPDate, T = looked
+            SAPNum = [(SL, Amount) for SL, Amount, UOM in T.get('StorageLocations', [])]
+            SAPTot = sum(Amount for SL, Amount in SAPNum)
+            return adhoc001SummaryRow(
+                CountDate = firstrow.ac_CountDate,
+                SAPDate = SAPDate,
+                SAPNum = SAPNum,
+                TypicalContainerQty = firstrow.TypicalContainerQty,
+                TypicalPalletQty = firstrow.TypicalPalletQty,
+                Material = firstrow.Matl_PartNum,
+                PartType = firstrow.PartType,
+                CountTotal = totals['TotalCounted'],
+                SAPTotal = SAPTot,
+                Diff = totals['TotalCounted'] - SAPTot,
+                Accuracy = fnCountSummaryAccuracy(totals['TotalCounted'], SAPTot),
+                MatlNotes = firstrow.mtl_Notes,
+                )
+
+        def DetailLine(rawrow):
+            return adhoc001DetailRow(
+                CountDate = rawrow.ac_CountDate,
+                CycCtID = rawrow.ac_CycCtID,
+                Material = rawrow.Matl_PartNum,
+                ActCounter = rawrow.ac_Counter,
+                BLDG = rawrow.ac_BLDG,
+                LOCATION = rawrow.ac_LOCATION,
+                PKGID = rawrow.ac_PKGID_Desc,
+                TAGQTY = rawrow.ac_TAGQTY,
+                PossNotRec = rawrow.FLAG_PossiblyNotRecieved,
+                MovDurCt = rawrow.FLAG_MovementDuringCount,
+                CTD_QTY_Expr = rawrow.ac_CTD_QTY_Expr,
+                CTD_QTY_Eval = CTDQty(rawrow),
+                ActCountNotes = rawrow.ac_Notes,
+                )
+
+        return list(fnGroupedReport(raw_qs.iterator(),
+                        groupkey=lambda rawrow: (rawrow.Matl_PartNum, rawrow.ac_CountDate),
+                        detail=DetailLine, summary=SummaryLine,
+                        aggregates=[SumOf('TotalCounted', CTDQty)],
+                        lookups=SAPLookups))
 
-        def DetailLine(rawrow, Eval_CTDQTY=True):
-            outputline = dict()
-            outputline['type'] = 'Detail'
-            outputline['CountDate'] = rawrow.ac_CountDate
-            outputline['CycCtID'] = rawrow.ac_CycCtID
-            outputline['Material'] = rawrow.Matl_PartNum
-            outputline['ActCounter'] = rawrow.ac_Counter
-            outputline['BLDG'] = rawrow.ac_BLDG
-            outputline['LOCATION'] = rawrow.ac_LOCATION
-            outputline['PKGID'] = rawrow.ac_PKGID_Desc
-            outputline['TAGQTY'] = rawrow.ac_TAGQTY
-            outputline['PossNotRec'] = rawrow.FLAG_PossiblyNotRecieved
-            outputline['MovDurCt'] = rawrow.FLAG_MovementDuringCount
-            outputline['CTD_QTY_Expr'] = rawrow.ac_CTD_QTY_Expr
-            if Eval_CTDQTY:
-                try:
-                    outputline['CTD_QTY_Eval'] = evaluate(rawrow.ac_CTD_QTY_Expr)   # yes, I know the risks - Ill write my own parser later ...
-                    # do next line at caller
-                    # lastrow['TotalCounted'] += outputline['CTD_QTY_Eval']
-                except:
-                    # Exception('bad expression:'+rawrow.ac_CTD_QTY_Expr)
-                    outputline['CTD_QTY_Eval'] = "????"
-            else:
-                outputline['CTD_QTY_Eval'] = "----"
-            outputline['ActCountNotes'] = rawrow.ac_Notes
-            # outputrows.append(outputline)
-
-            return outputline
-        
-        outputrows = []
-        lastrow = {'Material': None, 'CountDate':None}
-        for rawrow in raw_qs:
-            if rawrow.Matl_PartNum != lastrow['Material'] or rawrow.ac_CountDate != lastrow['CountDate']:     # new Matl
-                if outputrows:
-                    outputrows.append(SummaryLine(lastrow))
-                # no else -  if outputrows is empty, this is the first row, so keep going
-
-                # this new material is now the "old" one; save values for when it switches, and we do the above block
-                # this whole block becomes
-                lastrow = CreateLastrow(rawrow)
-            #endif
-
-            # process this row
-            outputline = DetailLine(rawrow, Eval_CTDQTY)
-            outputrows.append(outputline)
-            if isinstance(outputline['CTD_QTY_Eval'],(int,float)): lastrow['TotalCounted'] += outputline['CTD_QTY_Eval']
-        # endfor
-        # need to do the summary on the last row
-        if outputrows:
-            # summarize last Matl
-            outputrows.append(SummaryLine(lastrow))
-        
-        return outputrows
-        
     ### main body of fnCountSummaryRpt
 
     cutoff_date = '2023-01-25'
@@ -141,12 +111,10 @@ def adhoc001(req):
         if matl_as_string: matl_as_string += ", "
         matl_as_string += WrapInQuotes(MM,"'","'")
     
-    # get the SAP data
-    SAPRecs = SAP_SOHRecs.objects.filter(org=_userorg,Material__in=matl).order_by('uploaded_at','Material')
-
     fldlist = "0 as id" \
         ", ac.id as ac_id, ac.CountDate as ac_CountDate, ac.CycCtID as ac_CycCtID, ac.Counter as ac_Counter" \
         ", ac.LocationOnly as ac_LocationOnly, ac.CTD_QTY_Expr as ac_CTD_QTY_Expr, ac.BLDG as ac_BLDG" \
+        ", ac.CTD_QTY_Eval as ac_CTD_QTY_Eval, ac.CTD_QTY_Status as ac_CTD_QTY_Status" \
         ", ac.LOCATION as ac_LOCATION, ac.PKGID_Desc as ac_PKGID_Desc, ac.TAGQTY as ac_TAGQTY" \
         ", ac.FLAG_PossiblyNotRecieved, ac.FLAG_MovementDuringCount, ac.Notes as ac_Notes" \
         ", mtl.Material as Matl_PartNum, (SELECT WhsePartType FROM WICS_whseparttypes WHERE id=mtl.PartType_id) as PartType" \
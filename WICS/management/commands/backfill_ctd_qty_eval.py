@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from WICS.models import Organizations
+from WICS.procs_ActualCounts import fnCTDQtyEvalBackfill
+
+
+class Command(BaseCommand):
+    help = 'evaluate CTD_QTY_Expr into CTD_QTY_Eval / CTD_QTY_Status for the ActualCounts not evaluated yet (--redo: all of them)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--org', help='orgname to backfill (default: all)')
+        parser.add_argument('--redo', action='store_true', help='re-evaluate every record, not just the ones never evaluated')
+
+    def handle(self, *args, **options):
+        orgs = Organizations.objects.all()
+        if options['org']: orgs = orgs.filter(orgname=options['org'])
+        for org in orgs:
+            nRecs = fnCTDQtyEvalBackfill(org, redo=options['redo'])
+            self.stdout.write(f'{org.orgname}: {nRecs} count records evaluated')
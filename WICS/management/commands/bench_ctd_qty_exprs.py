@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from mathematical_expressions_parser.benchmark import run
+from WICS.models import ActualCounts
+
+
+class Command(BaseCommand):
+    help = 'benchmark the expression evaluator on the CTD_QTY_Expr of the ActualCounts records, and check MathCompiler agrees with MathParser (see mathematical_expressions_parser.benchmark)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--org', type=int, default=None, help='only this org (id) - default all')
+        parser.add_argument('--repeat', type=int, default=3, help='run each pass this many times and keep the best (default 3)')
+
+    def handle(self, *args, **options):
+        qs = ActualCounts.objects.all()
+        if options['org']: qs = qs.filter(org_id=options['org'])
+        corpus = [(expr, None) for expr in qs.values_list('CTD_QTY_Expr', flat=True)]
+        if not corpus:
+            self.stdout.write('no count records')
+            return
+        run({'ActualCounts': corpus}, options['repeat'], self.stdout)
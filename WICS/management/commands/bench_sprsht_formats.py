@@ -0,0 +1,56 @@
+import csv, io, random, time
+from django.core.management.base import BaseCommand
+from openpyxl import Workbook
+from WICS.procs_SAP import SAP_SSName_TableName_map
+from WICS.procs_UploadJobs import NamedBytesIO
+from WICS.sprsht_reader import SprshtReader
+
+
+class Command(BaseCommand):
+    help = 'compare SprshtReader parse speed for the same SAP SOH report saved as .xlsx and as .csv'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=50000, help='number of SAP SOH rows to generate (default 50000)')
+        parser.add_argument('--repeat', type=int, default=3, help='parse each file this many times and keep the best (default 3)')
+
+    def handle(self, *args, **options):
+        nRows = options['rows']
+        header = list(SAP_SSName_TableName_map)
+        rnd = random.Random(20230301)
+        rows = []
+        for n in range(nRows):
+            qty = rnd.randint(0, 5000)
+            rows.append([
+                '%07d-%02d' % (rnd.randint(1000000, 1200000), rnd.randint(1, 15)),
+                'MATERIAL DESCRIPTION %d' % n,
+                '1000', 'ROH', 'WH%02d' % rnd.randint(1, 12), 'EA',
+                float(qty), 'USD', qty * 1.37, '', '',
+                ])
+
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet()
+        ws.append(header)
+        for r in rows: ws.append(r)
+        xlsxbuf = io.BytesIO()
+        wb.save(xlsxbuf)
+
+        txtbuf = io.StringIO()
+        wrtr = csv.writer(txtbuf)
+        wrtr.writerow(header)
+        wrtr.writerows(rows)
+        csvbytes = txtbuf.getvalue().encode('utf-8')
+
+        results = {}
+        for fmt, fName, data in (('xlsx', 'SAP.xlsx', xlsxbuf.getvalue()), ('csv', 'SAP.csv', csvbytes)):
+            best = None
+            for _ in range(options['repeat']):
+                tStart = time.perf_counter()
+                with SprshtReader(NamedBytesIO(data, fName), SAP_SSName_TableName_map,
+                            numericFields=('Amount', 'ValueUnrestricted')) as SAPRdr:
+                    nRead = sum(1 for _ in SAPRdr)
+                elapsed = time.perf_counter() - tStart
+                if best is None or elapsed < best: best = elapsed
+            results[fmt] = best
+            self.stdout.write('%-5s %8d rows  %9.0f KB  %7.3f s  %9.0f rows/s' % (fmt, nRead, len(data)/1024, best, nRead/best))
+
+        self.stdout.write('csv is %.1fx faster than xlsx' % (results['xlsx'] / results['csv']))
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from WICS.models import Organizations
+from WICS.procs_CountSummary import fnCountSummaryRebuild
+
+
+class Command(BaseCommand):
+    help = 'rebuild the Count Summary table (CountDailySummary) from the counts, schedules and SAP totals'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--org', help='orgname to rebuild (default: all)')
+        parser.add_argument('--date', help='only this CountDate (default: all)')
+
+    def handle(self, *args, **options):
+        orgs = Organizations.objects.all()
+        if options['org']: orgs = orgs.filter(orgname=options['org'])
+        for org in orgs:
+            nDates = fnCountSummaryRebuild(org, options['date'])
+            self.stdout.write(f'{org.orgname}: {nDates} count dates rebuilt')
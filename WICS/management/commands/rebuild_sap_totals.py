@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from WICS.models import Organizations
+from WICS.procs_SAP import fnSAPTotalsRebuild
+
+
+class Command(BaseCommand):
+    help = 'rebuild the per-Material SAP totals (SAP_SOHTotals) from the SAP SOH records, e.g. after a UOM multiplier changes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--org', help='orgname to rebuild (default: all)')
+
+    def handle(self, *args, **options):
+        orgs = Organizations.objects.all()
+        if options['org']: orgs = orgs.filter(orgname=options['org'])
+        for org in orgs:
+            nSnaps = fnSAPTotalsRebuild(org)
+            self.stdout.write(f'{org.orgname}: {nSnaps} SAP snapshots rebuilt')
@@ -0,0 +1,29 @@
+import threading
+from django.core.management.base import BaseCommand
+from WICS.procs_UploadJobs import fnUploadJobWorker
+
+
+class Command(BaseCommand):
+    help = 'run queued spreadsheet uploads (UploadJobs).  Uploads are only queued when cParm UPLOAD-JOBQUEUE is on'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1, help='number of worker threads (default 1)')
+        parser.add_argument('--poll', type=float, default=2.0, help='seconds to wait between checks of an empty queue (default 2)')
+        parser.add_argument('--once', action='store_true', help='run whatever is queued, then exit')
+
+    def handle(self, *args, **options):
+        stopEvent = threading.Event()
+        workers = [
+            threading.Thread(target=fnUploadJobWorker, name=f'uploadjobs-{n}', daemon=True,
+                    args=(stopEvent, options['poll'], options['once']))
+            for n in range(max(options['workers'], 1))
+            ]
+        for w in workers: w.start()
+        self.stdout.write(f"{len(workers)} upload job worker(s) started")
+        try:
+            for w in workers:
+                while w.is_alive(): w.join(1.0)
+        except KeyboardInterrupt:
+            self.stdout.write('stopping - running jobs will finish first')
+            stopEvent.set()
+            for w in workers: w.join()
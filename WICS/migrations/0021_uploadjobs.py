@@ -0,0 +1,83 @@
+# Generated by Django 4.1.13 on 2026-10-18 02:39
+
+from django.conf import settings
+import django.core.serializers.json
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("WICS", "0020_unitsofmeasure"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="UploadJobs",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("JobType", models.CharField(max_length=50)),
+                ("Status", models.CharField(default="QUEUED", max_length=20)),
+                (
+                    "Params",
+                    models.JSONField(
+                        blank=True,
+                        default=dict,
+                        encoder=django.core.serializers.json.DjangoJSONEncoder,
+                    ),
+                ),
+                ("FileName", models.CharField(blank=True, max_length=250)),
+                ("FileData", models.BinaryField(blank=True, null=True)),
+                ("RowsTotal", models.IntegerField(blank=True, null=True)),
+                ("RowsProcessed", models.IntegerField(default=0)),
+                ("nErrors", models.IntegerField(default=0)),
+                (
+                    "Results",
+                    models.JSONField(
+                        blank=True,
+                        encoder=django.core.serializers.json.DjangoJSONEncoder,
+                        null=True,
+                    ),
+                ),
+                ("ErrorText", models.TextField(blank=True)),
+                ("QueuedAt", models.DateTimeField(auto_now_add=True)),
+                ("StartedAt", models.DateTimeField(blank=True, null=True)),
+                ("FinishedAt", models.DateTimeField(blank=True, null=True)),
+                (
+                    "org",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="WICS.organizations",
+                    ),
+                ),
+                (
+                    "user",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ["QueuedAt"],
+            },
+        ),
+        migrations.AddIndex(
+            model_name="uploadjobs",
+            index=models.Index(
+                fields=["Status", "QueuedAt"], name="UpldJobIDX_Status_Queued"
+            ),
+        ),
+    ]
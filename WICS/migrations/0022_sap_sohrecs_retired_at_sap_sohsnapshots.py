@@ -0,0 +1,75 @@
+# Generated by Django 4.1.13 on 2026-10-18 02:45
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def catalog_existing_snapshots(apps, schema_editor):
+    # every existing upload is a full snapshot: catalog it, and retire its records at the next upload date
+    SAP_SOHRecs = apps.get_model("WICS", "SAP_SOHRecs")
+    SAP_SOHSnapshots = apps.get_model("WICS", "SAP_SOHSnapshots")
+    uploads = (
+        SAP_SOHRecs.objects.order_by("org", "uploaded_at")
+        .values_list("org", "uploaded_at")
+        .distinct()
+    )
+    prev = None
+    for org_id, uploaded_at in uploads:
+        SAP_SOHSnapshots.objects.create(org_id=org_id, uploaded_at=uploaded_at)
+        if prev and prev[0] == org_id:
+            SAP_SOHRecs.objects.filter(org_id=org_id, uploaded_at=prev[1]).update(
+                retired_at=uploaded_at
+            )
+        prev = (org_id, uploaded_at)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("WICS", "0021_uploadjobs"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="sap_sohrecs",
+            name="retired_at",
+            field=models.DateField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name="SAP_SOHSnapshots",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("uploaded_at", models.DateField()),
+                ("DeltaStorage", models.BooleanField(blank=True, default=False)),
+                (
+                    "org",
+                    models.ForeignKey(
+                        blank=True,
+                        on_delete=django.db.models.deletion.RESTRICT,
+                        to="WICS.organizations",
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ["org", "uploaded_at"],
+                "get_latest_by": "uploaded_at",
+            },
+        ),
+        migrations.AddConstraint(
+            model_name="sap_sohsnapshots",
+            constraint=models.UniqueConstraint(
+                models.F("org"),
+                models.F("uploaded_at"),
+                name="SAPSnapUNQ_org_uploaded_at",
+            ),
+        ),
+        migrations.RunPython(catalog_existing_snapshots, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,61 @@
+# Generated by Django 4.1.13 on 2026-10-18 02:46
+
+from django.db import migrations, models
+from django.db.models import Q
+
+
+def count_existing_snapshots(apps, schema_editor):
+    SAP_SOHRecs = apps.get_model("WICS", "SAP_SOHRecs")
+    SAP_SOHSnapshots = apps.get_model("WICS", "SAP_SOHSnapshots")
+    for snap in SAP_SOHSnapshots.objects.all():
+        snap.RowCount = SAP_SOHRecs.objects.filter(
+            Q(retired_at__isnull=True) | Q(retired_at__gt=snap.uploaded_at),
+            org_id=snap.org_id,
+            uploaded_at__lte=snap.uploaded_at,
+        ).count()
+        snap.save(update_fields=["RowCount"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("WICS", "0022_sap_sohrecs_retired_at_sap_sohsnapshots"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="sap_sohsnapshots",
+            name="LoadSeconds",
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="sap_sohsnapshots",
+            name="LoadedAt",
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name="sap_sohsnapshots",
+            name="RowCount",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="sap_sohsnapshots",
+            name="SourceFileHash",
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddIndex(
+            model_name="sap_sohrecs",
+            index=models.Index(
+                fields=["org", "uploaded_at", "Material"],
+                name="SAPRecIDX_org_upld_Matl",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="sap_sohrecs",
+            index=models.Index(
+                fields=["org", "Material", "uploaded_at"],
+                name="SAPRecIDX_org_Matl_upld",
+            ),
+        ),
+        migrations.RunPython(count_existing_snapshots, migrations.RunPython.noop),
+    ]
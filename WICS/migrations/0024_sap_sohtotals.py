@@ -0,0 +1,109 @@
+# Generated by Django 4.1.13 on 2026-10-18 02:48
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import Q
+
+
+def build_totals(apps, schema_editor):
+    # totals for the snapshots already loaded, one full set per snapshot
+    # (manage.py rebuild_sap_totals rebuilds them the way the upload stores them)
+    SAP_SOHRecs = apps.get_model("WICS", "SAP_SOHRecs")
+    SAP_SOHSnapshots = apps.get_model("WICS", "SAP_SOHSnapshots")
+    SAP_SOHTotals = apps.get_model("WICS", "SAP_SOHTotals")
+    UnitsOfMeasure = apps.get_model("WICS", "UnitsOfMeasure")
+    UOMMult = dict(UnitsOfMeasure.objects.values_list("UOM", "Multiplier1"))
+    snaps = list(SAP_SOHSnapshots.objects.order_by("org", "uploaded_at"))
+    for n, snap in enumerate(snaps):
+        nextsnap = snaps[n + 1] if n + 1 < len(snaps) else None
+        retired_at = (
+            nextsnap.uploaded_at
+            if nextsnap and nextsnap.org_id == snap.org_id
+            else None
+        )
+        Totals = {}
+        recs = SAP_SOHRecs.objects.filter(
+            Q(retired_at__isnull=True) | Q(retired_at__gt=snap.uploaded_at),
+            org_id=snap.org_id,
+            uploaded_at__lte=snap.uploaded_at,
+        ).order_by("pk")
+        for rec in recs.iterator():
+            T = Totals.setdefault(rec.Material, [0.0, 0.0, "", []])
+            T[0] += (rec.Amount or 0.0) * UOMMult.get(rec.BaseUnitofMeasure, 1.0)
+            T[1] += rec.ValueUnrestricted or 0.0
+            if rec.Currency:
+                T[2] = rec.Currency
+            T[3].append([rec.StorageLocation, rec.Amount or 0.0, rec.BaseUnitofMeasure])
+        SAP_SOHTotals.objects.bulk_create(
+            [
+                SAP_SOHTotals(
+                    org_id=snap.org_id,
+                    uploaded_at=snap.uploaded_at,
+                    retired_at=retired_at,
+                    Material=Matl,
+                    Qty=T[0],
+                    Value=T[1],
+                    Currency=T[2],
+                    StorageLocations=T[3],
+                )
+                for Matl, T in Totals.items()
+            ],
+            batch_size=2000,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("WICS", "0023_sap_snapshot_stats_and_indexes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SAP_SOHTotals",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("uploaded_at", models.DateField()),
+                ("retired_at", models.DateField(blank=True, null=True)),
+                ("Material", models.CharField(max_length=100)),
+                ("Qty", models.FloatField(default=0)),
+                ("Value", models.FloatField(default=0)),
+                ("Currency", models.CharField(blank=True, max_length=20)),
+                ("StorageLocations", models.JSONField(blank=True, default=list)),
+                (
+                    "org",
+                    models.ForeignKey(
+                        blank=True,
+                        on_delete=django.db.models.deletion.RESTRICT,
+                        to="WICS.organizations",
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ["org", "uploaded_at", "Material"],
+            },
+        ),
+        migrations.AddIndex(
+            model_name="sap_sohtotals",
+            index=models.Index(
+                fields=["org", "uploaded_at", "Material"],
+                name="SAPTotIDX_org_upld_Matl",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="sap_sohtotals",
+            index=models.Index(
+                fields=["org", "Material", "uploaded_at"],
+                name="SAPTotIDX_org_Matl_upld",
+            ),
+        ),
+        migrations.RunPython(build_totals, migrations.RunPython.noop),
+    ]
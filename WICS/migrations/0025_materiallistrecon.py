@@ -0,0 +1,62 @@
+# Generated by Django 4.1.13 on 2026-10-18 02:52
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("WICS", "0024_sap_sohtotals"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MaterialListRecon",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("Action", models.CharField(max_length=10)),
+                ("Material", models.CharField(max_length=100)),
+                ("Description", models.CharField(blank=True, max_length=250)),
+                ("SAPMaterialType", models.CharField(blank=True, max_length=100)),
+                ("SAPMaterialGroup", models.CharField(blank=True, max_length=100)),
+                ("Price", models.FloatField(blank=True, null=True)),
+                ("PriceUnit", models.PositiveIntegerField(blank=True, null=True)),
+                ("Changes", models.JSONField(blank=True, default=dict)),
+                ("Approved", models.BooleanField(blank=True, default=False)),
+                (
+                    "MaterialRec",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="WICS.materiallist",
+                    ),
+                ),
+                (
+                    "job",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="WICS.uploadjobs",
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ["job", "Material"],
+            },
+        ),
+        migrations.AddIndex(
+            model_name="materiallistrecon",
+            index=models.Index(
+                fields=["job", "Action", "Material"], name="MatlReconIDX_job_Act_Matl"
+            ),
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 4.1.13 on 2026-10-18 02:55
+
+import django.core.serializers.json
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("WICS", "0025_materiallistrecon"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="UploadJobRowResults",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("rowNum", models.IntegerField()),
+                ("isError", models.BooleanField(default=False)),
+                (
+                    "Result",
+                    models.JSONField(
+                        blank=True,
+                        default=dict,
+                        encoder=django.core.serializers.json.DjangoJSONEncoder,
+                    ),
+                ),
+                (
+                    "job",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="WICS.uploadjobs",
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ["job", "rowNum", "id"],
+            },
+        ),
+        migrations.AddIndex(
+            model_name="uploadjobrowresults",
+            index=models.Index(fields=["job", "rowNum"], name="UpldRowResIDX_job_row"),
+        ),
+    ]
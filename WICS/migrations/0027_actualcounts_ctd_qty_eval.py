@@ -0,0 +1,25 @@
+# Generated by Django 4.1.13 on 2026-10-18 03:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("WICS", "0026_uploadjobrowresults"),
+    ]
+
+    # the counts already on file are left at CTD_QTY_Status '' (not evaluated) - evaluating them here would tie
+    # this migration to whatever the expression parser does today.  manage.py backfill_ctd_qty_eval fills them in
+    operations = [
+        migrations.AddField(
+            model_name="actualcounts",
+            name="CTD_QTY_Eval",
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="actualcounts",
+            name="CTD_QTY_Status",
+            field=models.CharField(blank=True, max_length=10),
+        ),
+    ]
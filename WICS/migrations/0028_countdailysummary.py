@@ -0,0 +1,68 @@
+# Generated by Django 4.1.13 on 2026-10-18 03:18
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("WICS", "0027_actualcounts_ctd_qty_eval"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="CountDailySummary",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("CountDate", models.DateField()),
+                ("Category", models.CharField(blank=True, max_length=1)),
+                ("nCounts", models.IntegerField(default=0)),
+                ("nLocationOnly", models.IntegerField(default=0)),
+                ("CountTotal", models.FloatField(default=0)),
+                ("Scheduled", models.BooleanField(default=False)),
+                ("SchedCounter", models.CharField(blank=True, max_length=250)),
+                ("ReasonScheduled", models.CharField(blank=True, max_length=250)),
+                ("CMPrintFlag", models.BooleanField(default=False)),
+                ("SchedNotes", models.CharField(blank=True, max_length=250)),
+                ("SAPDate", models.DateField(blank=True, null=True)),
+                ("SAPTotal", models.FloatField(default=0)),
+                ("SAPStorageLocations", models.JSONField(blank=True, default=list)),
+                ("Accuracy", models.FloatField(default=0)),
+                (
+                    "Material",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="WICS.materiallist",
+                    ),
+                ),
+                (
+                    "org",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="WICS.organizations",
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ["org", "CountDate", "Material"],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name="countdailysummary",
+            constraint=models.UniqueConstraint(
+                models.F("org"),
+                models.F("CountDate"),
+                models.F("Material"),
+                name="CtSumUNQ_org_CDate_Material",
+            ),
+        ),
+    ]
@@ -0,0 +1,16 @@
+# Generated by Django 4.1.13 on 2026-10-18 03:46
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("WICS", "0028_countdailysummary"),
+    ]
+
+    operations = [
+        migrations.DeleteModel(
+            name="tmpMaterialListUpdate",
+        ),
+    ]
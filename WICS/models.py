@@ -1,5 +1,8 @@
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
 # from django.db.models import Value
+from mathematical_expressions_parser.eval import evaluate_many
 
 # Create your models here.
 # I'm quite happy with automaintained pk fields, so I don't specify any
@@ -63,13 +66,28 @@ class MaterialList(models.Model):
     def __str__(self) -> str:
         return self.Material
         # return super().__str__()
-class tmpMaterialListUpdate(models.Model):
-    Material = models.CharField(primary_key=True, max_length=100, blank=False)
-    Description = models.CharField(max_length=250, blank=True)
+
+class MaterialListRecon(models.Model):
+    # one row per difference between an uploaded SAP Material List and MaterialList, held for review
+    # until the changes are applied.  See procs_SAP.fnUpdateMatlListfromSAP
+    job = models.ForeignKey('UploadJobs', on_delete=models.CASCADE)
+    Action = models.CharField(max_length=10)       # NEW, CHANGED, REMOVED
+    Material = models.CharField(max_length=100)
+    MaterialRec = models.ForeignKey(MaterialList, null=True, blank=True, on_delete=models.CASCADE)     # None for NEW
+    Description = models.CharField(max_length=250, blank=True)      # the uploaded values (NEW and CHANGED)
     SAPMaterialType = models.CharField(max_length=100, blank=True)
     SAPMaterialGroup = models.CharField(max_length=100, blank=True)
     Price = models.FloatField(null=True, blank=True)
     PriceUnit = models.PositiveIntegerField(null=True, blank=True)
+    Changes = models.JSONField(default=dict, blank=True)            # CHANGED: {field: [MaterialList value, uploaded value]}
+    Approved = models.BooleanField(blank=True, default=False)
+    objects = models.Manager()
+
+    class Meta:
+        ordering = ['job', 'Material']
+        indexes = [
+                models.Index(fields=['job', 'Action', 'Material'], name='MatlReconIDX_job_Act_Matl'),
+            ]
 
 
 class CountSchedule(models.Model):
@@ -93,6 +111,17 @@ class CountSchedule(models.Model):
         return str(self.pk) + ": " + str(self.CountDate) + " / " + str(self.Material) + " / " + str(self.Counter)
         # return super().__str__()
 
+    def save(self, *args, **kwargs):
+        was = CountSchedule.objects.filter(pk=self.pk).values_list('CountDate', 'Material_id').first() if self.pk else None
+        super().save(*args, **kwargs)
+        fnCountSummaryTouched(self.org, [was, (self.CountDate, self.Material_id)])
+
+    def delete(self, *args, **kwargs):
+        key = (self.CountDate, self.Material_id)
+        retval = super().delete(*args, **kwargs)
+        fnCountSummaryTouched(self.org, [key])
+        return retval
+
 
 class ActualCounts(models.Model):
     # oldWICSID = models.IntegerField(null=True, blank=True)      # kill this field once data is tied to new ID in WICS2
@@ -104,6 +133,8 @@ class ActualCounts(models.Model):
     Counter = models.CharField(max_length=250, blank=False, null=False)
     LocationOnly = models.BooleanField(blank=True, default=False)
     CTD_QTY_Expr = models.CharField(max_length=500, blank=True)
+    CTD_QTY_Eval = models.FloatField(null=True, blank=True)         # CTD_QTY_Expr evaluated; null unless CTD_QTY_Status is OK
+    CTD_QTY_Status = models.CharField(max_length=10, blank=True)    # OK, EMPTY (no expression) or INVALID; '' until evaluated (see fnEvalCTDQty)
     BLDG = models.CharField(max_length=100, blank=True)
     LOCATION = models.CharField(max_length=250, blank=True)
     PKGID_Desc = models.CharField(max_length=250, blank=True)
@@ -120,6 +151,41 @@ class ActualCounts(models.Model):
         return str(self.pk) + ": " + str(self.CountDate) + " / " + str(self.Material) + " / " + str(self.Counter) + " / " + str(self.BLDG) + "_" + str(self.LOCATION)
         # return super().__str__()
 
+    def save(self, *args, **kwargs):
+        fnEvalCTDQty([self])
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'CTD_QTY_Expr' in update_fields:
+            kwargs['update_fields'] = set(update_fields) | {'CTD_QTY_Eval', 'CTD_QTY_Status'}
+        was = ActualCounts.objects.filter(pk=self.pk).values_list('CountDate', 'Material_id').first() if self.pk else None
+        super().save(*args, **kwargs)
+        fnCountSummaryTouched(self.org, [was, (self.CountDate, self.Material_id)])
+
+    def delete(self, *args, **kwargs):
+        key = (self.CountDate, self.Material_id)
+        retval = super().delete(*args, **kwargs)
+        fnCountSummaryTouched(self.org, [key])
+        return retval
+
+def fnEvalCTDQty(recs):
+    """
+    set CTD_QTY_Eval and CTD_QTY_Status of each of recs (ActualCounts) from its CTD_QTY_Expr.  Doesn't save them -
+    save() calls this itself; anything that bypasses save() (bulk_create, bulk_update) must call it first
+    """
+    for rec, QtyEval in zip(recs, evaluate_many([rec.CTD_QTY_Expr for rec in recs])):
+        if not (rec.CTD_QTY_Expr or '').strip():
+            rec.CTD_QTY_Eval, rec.CTD_QTY_Status = None, 'EMPTY'
+        elif QtyEval.error is None:
+            rec.CTD_QTY_Eval, rec.CTD_QTY_Status = QtyEval.value, 'OK'
+        else:
+            rec.CTD_QTY_Eval, rec.CTD_QTY_Status = None, 'INVALID'
+    return recs
+
+def fnCountSummaryTouched(org, keys):
+    # CountDailySummary is kept from ActualCounts, CountSchedule and the SAP totals by procs_CountSummary
+    # (imported here, not at the top, since it imports this module)
+    from WICS.procs_CountSummary import fnCountSummaryUpdate
+    fnCountSummaryUpdate(org, [K for K in keys if K])
+
 def LastFoundAt(matl):
     try:
         lastCountDate = ActualCounts.objects.filter(Material=matl).latest('CountDate').CountDate
@@ -139,6 +205,28 @@ def LastFoundAt(matl):
     
     return {'lastCountDate': lastCountDate, 'lastFoundAt': LFAString, 'lastFoundAt_list': LFAList}
 
+def LastFoundAtMany(matls):
+    """
+    LastFoundAt for each of matls (MaterialList records or their ids) in one query,
+    as {Material_id: LastFoundAt()}.  A Material never counted is left out
+    """
+    ids = [getattr(m, 'pk', m) for m in matls]
+    lastCount = ActualCounts.objects.filter(Material=models.OuterRef('Material')).order_by('-CountDate').values('CountDate')[:1]
+    countrecs = ActualCounts.objects.filter(Material_id__in=ids, CountDate=models.Subquery(lastCount))\
+                .order_by('Material_id','BLDG','LOCATION')\
+                .values('Material_id','CountDate','BLDG','LOCATION')\
+                .distinct()
+    LFA = {}
+    for rec in countrecs:
+        L = LFA.get(rec['Material_id'])
+        if L is None:
+            L = LFA[rec['Material_id']] = {'lastCountDate': rec['CountDate'], 'lastFoundAt': '', 'lastFoundAt_list': []}
+        if L['lastFoundAt']: L['lastFoundAt'] += ', '
+        L['lastFoundAt'] += rec['BLDG'] + '_' + rec['LOCATION']
+        L['lastFoundAt_list'].append({'BLDG':rec['BLDG'],'LOCATION':rec['LOCATION']})
+
+    return LFA
+
 def FoundAt(matl):
     # get Dict of all dates this material counted
     FA_qs =  ActualCounts.objects.filter(Material=matl)\
@@ -164,6 +252,34 @@ def FoundAt(matl):
     return FA_qs
 
 
+class CountDailySummary(models.Model):
+    # the Count Summary report, one row per (org, CountDate, Material) that was counted or scheduled.
+    # Kept up to date as counts, schedules and SAP snapshots change (see procs_CountSummary), so the report just reads it
+    org = models.ForeignKey(Organizations, on_delete=models.CASCADE)
+    CountDate = models.DateField()
+    Material = models.ForeignKey(MaterialList, on_delete=models.CASCADE)
+    Category = models.CharField(max_length=1, blank=True)       # A Scheduled and Counted, B UnScheduled, C Scheduled but Not Counted, '' location-only counts
+    nCounts = models.IntegerField(default=0)                    # not LocationOnly
+    nLocationOnly = models.IntegerField(default=0)
+    CountTotal = models.FloatField(default=0)                   # sum of the counts' CTD_QTY_Eval
+    Scheduled = models.BooleanField(default=False)
+    SchedCounter = models.CharField(max_length=250, blank=True)
+    ReasonScheduled = models.CharField(max_length=250, blank=True)
+    CMPrintFlag = models.BooleanField(default=False)
+    SchedNotes = models.CharField(max_length=250, blank=True)
+    SAPDate = models.DateField(null=True, blank=True)           # the SAP snapshot CountDate is compared to
+    SAPTotal = models.FloatField(default=0)
+    SAPStorageLocations = models.JSONField(default=list, blank=True)
+    Accuracy = models.FloatField(default=0)
+    objects = models.Manager()
+
+    class Meta:
+        ordering = ['org', 'CountDate', 'Material']
+        constraints = [
+                models.UniqueConstraint('org', 'CountDate', 'Material', name='CtSumUNQ_org_CDate_Material'),
+            ]
+
+
 class SAP_SOHRecs(models.Model):
     uploaded_at = models.DateField()
     org = models.ForeignKey(Organizations, on_delete=models.RESTRICT, blank=True)
@@ -178,10 +294,58 @@ class SAP_SOHRecs(models.Model):
     ValueUnrestricted = models.FloatField(blank=True)
     SpecialStock = models.CharField(max_length=20, blank=True)
     Batch = models.CharField(max_length=20, blank=True)
+    # a record is part of every snapshot from uploaded_at up to (not including) retired_at
+    # None means it is still in the latest snapshot.  See procs_SAP.fnSAPSnapshotRecs
+    retired_at = models.DateField(null=True, blank=True)
 
     class Meta:
         get_latest_by = 'uploaded_at'
         ordering = ['uploaded_at', 'org', 'Material']
+        indexes = [
+                models.Index(fields=['org', 'uploaded_at', 'Material'], name='SAPRecIDX_org_upld_Matl'),
+                models.Index(fields=['org', 'Material', 'uploaded_at'], name='SAPRecIDX_org_Matl_upld'),
+            ]
+
+class SAP_SOHTotals(models.Model):
+    # per-Material totals of each SAP SOH snapshot, written by the upload (procs_SAP.fnSAPIngest) so reports
+    # don't re-add the SAP records.  Kept over snapshot runs the same way as SAP_SOHRecs (uploaded_at - retired_at)
+    org = models.ForeignKey(Organizations, on_delete=models.RESTRICT, blank=True)
+    uploaded_at = models.DateField()
+    retired_at = models.DateField(null=True, blank=True)
+    Material = models.CharField(max_length=100)
+    Qty = models.FloatField(default=0)              # Amount * UnitsOfMeasure.Multiplier1
+    Value = models.FloatField(default=0)
+    Currency = models.CharField(max_length=20, blank=True)
+    StorageLocations = models.JSONField(default=list, blank=True)      # [StorageLocation, Amount, BaseUnitofMeasure] for each SAP record
+    objects = models.Manager()
+
+    class Meta:
+        ordering = ['org', 'uploaded_at', 'Material']
+        indexes = [
+                models.Index(fields=['org', 'uploaded_at', 'Material'], name='SAPTotIDX_org_upld_Matl'),
+                models.Index(fields=['org', 'Material', 'uploaded_at'], name='SAPTotIDX_org_Matl_upld'),
+            ]
+
+class SAP_SOHSnapshots(models.Model):
+    # one row per SAP SOH upload.  This, not SAP_SOHRecs, is the list of snapshot dates
+    org = models.ForeignKey(Organizations, on_delete=models.RESTRICT, blank=True)
+    uploaded_at = models.DateField()
+    DeltaStorage = models.BooleanField(blank=True, default=False)     # only the changes from the previous snapshot were stored
+    RowCount = models.IntegerField(default=0)                           # records in the snapshot (not records stored)
+    LoadSeconds = models.FloatField(null=True, blank=True)
+    LoadedAt = models.DateTimeField(auto_now=True)
+    SourceFileHash = models.CharField(max_length=64, blank=True)        # sha256 of the uploaded file
+    objects = models.Manager()
+
+    class Meta:
+        get_latest_by = 'uploaded_at'
+        ordering = ['org', 'uploaded_at']
+        constraints = [
+                models.UniqueConstraint('org', 'uploaded_at', name='SAPSnapUNQ_org_uploaded_at'),
+            ]
+
+    def __str__(self) -> str:
+        return str(self.org) + " / " + str(self.uploaded_at)
 
 class UnitsOfMeasure(models.Model):
     UOM = models.CharField(max_length=50, unique=True)
@@ -201,6 +365,53 @@ class Location_WorksheetZone(models.Model):
 
 
 
+class UploadJobs(models.Model):
+    # one row per spreadsheet upload (SAP SOH, Material List, Count Entry).  See procs_UploadJobs
+    org = models.ForeignKey(Organizations, on_delete=models.CASCADE)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL)
+    JobType = models.CharField(max_length=50)
+    Status = models.CharField(max_length=20, default='QUEUED')     # QUEUED, RUNNING, DONE, FAILED
+    Params = models.JSONField(default=dict, blank=True, encoder=DjangoJSONEncoder)
+    FileName = models.CharField(max_length=250, blank=True)
+    FileData = models.BinaryField(null=True, blank=True)          # cleared once the job has run
+    RowsTotal = models.IntegerField(null=True, blank=True)
+    RowsProcessed = models.IntegerField(default=0)
+    nErrors = models.IntegerField(default=0)
+    Results = models.JSONField(null=True, blank=True, encoder=DjangoJSONEncoder)
+    ErrorText = models.TextField(blank=True)
+    QueuedAt = models.DateTimeField(auto_now_add=True)
+    StartedAt = models.DateTimeField(null=True, blank=True)
+    FinishedAt = models.DateTimeField(null=True, blank=True)
+    objects = models.Manager()
+
+    class Meta:
+        ordering = ['QueuedAt']
+        indexes = [
+                models.Index(fields=['Status', 'QueuedAt'], name='UpldJobIDX_Status_Queued'),
+            ]
+
+    def __str__(self) -> str:
+        return str(self.pk) + ": " + self.JobType + " / " + self.Status
+
+
+class UploadJobRowResults(models.Model):
+    # per-row results of an upload (UploadJobTypes with rowresults), shown a page at a time on the job's results page
+    job = models.ForeignKey(UploadJobs, on_delete=models.CASCADE)
+    rowNum = models.IntegerField()
+    isError = models.BooleanField(default=False)
+    Result = models.JSONField(default=dict, blank=True, encoder=DjangoJSONEncoder)
+    objects = models.Manager()
+
+    class Meta:
+        ordering = ['job', 'rowNum', 'id']
+        indexes = [
+                models.Index(fields=['job', 'rowNum'], name='UpldRowResIDX_job_row'),
+            ]
+
+    def __str__(self) -> str:
+        return str(self.job_id) + " / row " + str(self.rowNum)
+
+
 class WICSPermissions(models.Model):
     class Meta:
         managed = False  # No database table creation or deletion  \
@@ -1,8 +1,11 @@
+import bisect
 import datetime
-import os, uuid
+import itertools
 from django import forms
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
+from django.db import transaction
+from django.db.models import Count, Q, Sum
 from django.db.models.query import QuerySet
 from django.http import HttpResponseRedirect, HttpResponse, HttpRequest
 from django.urls import reverse
@@ -10,13 +13,18 @@ from django.shortcuts import render
 from django.views.generic import ListView
 from typing import *
 from cMenu.models import getcParm
-from cMenu.utils import makebool, isDate, WrapInQuotes, calvindate
-from mathematical_expressions_parser.eval import evaluate
-from openpyxl import load_workbook
+from cMenu.utils import makebool, isDate, calvindate
+from mathematical_expressions_parser.eval import evaluate, evaluate_many
 from userprofiles.models import WICSuser
 from WICS.forms import CountEntryForm, RelatedMaterialInfo, RelatedScheduleInfo
-from WICS.models import ActualCounts, MaterialList, CountSchedule, WhsePartTypes
-from WICS.procs_SAP import fnSAPList
+from WICS.models import ActualCounts, MaterialList, CountSchedule, CountDailySummary, WhsePartTypes, UploadJobRowResults, fnEvalCTDQty
+from WICS.models import SAP_SOHSnapshots, SAP_SOHTotals
+from WICS.procs_CountSummary import COUNTSUMMARY_CHUNKSIZE, fnCountSummaryUpdate, fnCountSummaryRebuild, fnCountSummaryAccuracy
+from WICS.procs_SAP import fnSAPSnapshotDate
+from WICS.procs_UploadJobs import fnSubmitUploadJob
+from WICS.report_engine import ReportRowClass, fnGroupedReport
+from WICS.sprsht_reader import SprshtReader
+from WICS.sprsht_writer import fnExportFormat, SprshtExportResponse
 
 
 
@@ -253,10 +261,43 @@ def fnCountEntryForm(req, recNum = 0,
 ##############################################################
 ##############################################################
 
+CountSprsht_SSName_TableName_map = {
+        'CountDate': 'CountDate',
+        'Counter': 'Counter',
+        'BLDG': 'BLDG',
+        'LOCATION': 'LOCATION',
+        'Material': 'Material',
+        'LocationOnly': 'LocationOnly',
+        'CTD_QTY_Expr': 'CTD_QTY_Expr',
+        'TypicalContainerQty': 'TypicalContainerQty',
+        'TypicalPalletQty': 'TypicalPalletQty',
+        'Notes': 'Notes',
+        }
+# the LocationOnly spellings the count sheet takes (as makebool reads them); anything else is a row error
+CountSprsht_LocationOnlyValues = {'TRUE', 'YES', 'ON', '1', 'FALSE', 'NO', 'OFF', '0'}
+
 @login_required
 def fnUploadActCountSprsht(req):
     _userorg = WICSuser.objects.get(user=req.user).org
 
+    if req.method == 'POST':
+        return fnSubmitUploadJob(req, 'CountSprsht', req.FILES['CEFile'], {'ValidateOnly': 'ValidateOnly' in req.POST})
+    else:
+        cntext = {'orgname':_userorg.orgname, 'uname':req.user.get_full_name()
+                }
+        templt = 'frm_UploadCountEntrySprdsht.html'
+    #endif
+
+    return render(req, templt, cntext)
+
+
+def procUploadActCountSprsht(org, upldfile, Params, progress=None):
+    """
+    UploadJobs proc for the Count Entry spreadsheet.  Params: {'ValidateOnly'}
+    With ValidateOnly, the sheet is checked (header, dates, materials, CTD_QTY_Expr, and rows that
+    duplicate another row or an existing count) but nothing is saved; only the errors are recorded
+    """
+
     def validatefld(fld, val):
         if   fld == 'CountDate': 
             if isinstance(val,(calvindate, datetime.date, datetime.datetime)):
@@ -273,7 +314,7 @@ def fnUploadActCountSprsht(req):
             retval = True
         elif fld == 'LocationOnly': 
             if isinstance(val,str):
-                retval = str.isnumeric()
+                retval = (val.strip().upper() in CountSprsht_LocationOnlyValues)
             elif isinstance(val,(float,int)):
                 retval = True
             else:                
@@ -291,7 +332,7 @@ def fnUploadActCountSprsht(req):
             if val == '' or val == None: 
                 retval = True   # this will be converted to 0
             elif isinstance(val,str):
-                retval = str.isnumeric()
+                retval = val.strip().isnumeric()
             elif isinstance(val,(float,int)):
                 retval = True
             else:                
@@ -301,51 +342,83 @@ def fnUploadActCountSprsht(req):
         
         return retval
 
-    if req.method == 'POST':
-        # save the file so we can open it as an excel file
-        CountSprshtFile = req.FILES['CEFile']
-        svdir = getcParm('SAP-FILELOC')
-        fName = svdir+"tmpCE"+str(uuid.uuid4())+".xlsx"
-        with open(fName, "wb") as destination:
-            for chunk in CountSprshtFile.chunks():
-                destination.write(chunk)
-
-        wb = load_workbook(filename=fName, read_only=True)
-        ws = wb['Counts']
-
-        CountSprshtcolmnNames = ws[1]
-        CountSprshtcolmnMap = {'Material': None,'CountDate':None, 'Counter':None, 'BLDG':None}
-        CountSprsht_SSName_TableName_map = {
-                'CountDate': 'CountDate',
-                'Counter': 'Counter',
-                'BLDG': 'BLDG',
-                'LOCATION': 'LOCATION',
-                'Material': 'Material',
-                'LocationOnly': 'LocationOnly',
-                'CTD_QTY_Expr': 'CTD_QTY_Expr',
-                'TypicalContainerQty': 'TypicalContainerQty',
-                'TypicalPalletQty': 'TypicalPalletQty',
-                'Notes': 'Notes',
-                }
-        for col in CountSprshtcolmnNames:
-            if col.value in CountSprsht_SSName_TableName_map:
-                CountSprshtcolmnMap[CountSprsht_SSName_TableName_map[col.value]] = col.column - 1
-        if (CountSprshtcolmnMap['Material'] == None) \
-          or (CountSprshtcolmnMap['CountDate'] == None) \
-          or (CountSprshtcolmnMap['Counter'] == None) \
-          or (CountSprshtcolmnMap['BLDG'] == None):
-            raise Exception('SAP Spreadsheet has bad header row.  See Calvin to fix this.')
-
-        UplResults = []
-        nRows = 0
-        rowNum=1
-        MAX_COUNT_ROWS = 5000
-        for row in ws.iter_rows(min_row=rowNum+1, max_row=MAX_COUNT_ROWS, values_only=True):
-            rowNum += 1
-            try:
-                MatObj = MaterialList.objects.get(org=_userorg, Material=row[CountSprshtcolmnMap['Material']])
-            except:
+    COUNTUPL_CHUNKSIZE = 1000
+    ValidateOnly = Params.get('ValidateOnly', False)
+    try:
+        CountSprshtRdr = SprshtReader(upldfile, CountSprsht_SSName_TableName_map, 
+                    requiredFields=('Material', 'CountDate', 'Counter', 'BLDG'), 
+                    sheetName='Counts',
+                    numericFields=('TypicalContainerQty', 'TypicalPalletQty'))
+    except Exception as err:
+        if not ValidateOnly: raise
+        UploadJobRowResults.objects.create(job_id=Params['jobID'], rowNum=1, isError=True, Result={'error':str(err), 'rowNum':1})
+        return {'ValidateOnly':True, 'nRowsRead':0, 'nRowsAdded':0, 'nErrors':1}
+
+    # one query for the org's materials instead of one per row.  The db may compare
+    # Material case-insensitively, so fall back to a casefolded lookup
+    MatlMap = {M.Material: M for M in MaterialList.objects.filter(org=org)}
+    MatlMapCI = {Matl.strip().casefold(): M for Matl, M in MatlMap.items()}
+    ActCtFlds = [F for F in ActualCounts._meta.concrete_fields]
+    ActCtFldMap = {F.attname: F for F in ActCtFlds}
+
+    # the sheet is handled COUNTUPL_CHUNKSIZE result rows at a time; the per-row results
+    # go to UploadJobRowResults rather than the job's Results, so there is no limit on the sheet size
+    ChunkResults = []
+    NewCounts = []      # (ActualCounts rec, its result row) in this chunk
+    ChangedMatls = {}   # MaterialList pk -> MatObj whose TypicalQty changed, written at the end
+    SummaryKeys = set() # (CountDate, Material_id) of the counts added, for CountDailySummary at the end
+    nRows = 0
+    nErrors = 0
+    rowNum=1
+
+    DupKeyFlds = ('CountDate', 'Material_id', 'Counter', 'BLDG', 'LOCATION', 'LocationOnly', 'CTD_QTY_Expr')
+    SheetKeys = {}      # ValidateOnly: DupKey -> rowNum of its first row
+
+    def flagDuplicates():
+        # ValidateOnly: a row that repeats an earlier row, or a count already on file, is an error
+        nonlocal nRows, nErrors
+        Keyed = [(tuple(ActCtFldMap[F].to_python(getattr(SRec, F)) for F in DupKeyFlds), SRec, res) for SRec, res in NewCounts]
+        OnFile = {R[1:]: R[0] for R in ActualCounts.objects.filter(org=org,
+                        CountDate__in={K[0] for K, SRec, res in Keyed}, Material_id__in={K[1] for K, SRec, res in Keyed},
+                        ).values_list('pk', *DupKeyFlds)}
+        for K, SRec, res in Keyed:
+            if K in OnFile:
+                res['error'] = f'duplicates Count Record {OnFile[K]}, already on file'
+            elif K in SheetKeys:
+                res['error'] = f'duplicates sheet row {SheetKeys[K]}'
+            else:
+                SheetKeys[K] = res['rowNum']
+                continue
+            nRows -= 1
+            nErrors += 1
+
+    def flushChunk():
+        fnEvalCTDQty([SRec for SRec, res in NewCounts])     # bulk_create doesn't call save()
+        if ValidateOnly:
+            flagDuplicates()
+        else:
+            ActualCounts.objects.bulk_create([SRec for SRec, res in NewCounts], batch_size=COUNTUPL_CHUNKSIZE)
+            SummaryKeys.update((SRec.CountDate, SRec.Material_id) for SRec, res in NewCounts)
+        for SRec, res in NewCounts:
+            # the saved row, as .values() would return it, without reading it back
+            # (id is None on dbs that don't return pk's from a bulk insert)
+            qs = {F.attname: F.to_python(getattr(SRec, F.attname)) for F in ActCtFlds}
+            qs['CountDate'] = str(qs['CountDate'])
+            res.update(qs)
+        UploadJobRowResults.objects.bulk_create(
+            [UploadJobRowResults(job_id=Params['jobID'], rowNum=res['rowNum'], isError=bool(res['error']), Result=res) 
+                for res in ChunkResults if res['error'] or not ValidateOnly], 
+            batch_size=COUNTUPL_CHUNKSIZE)
+        NewCounts.clear()
+        ChunkResults.clear()
+
+    # the whole sheet goes in, or none of it
+    with transaction.atomic():
+        for rowNum, row in CountSprshtRdr:
+            if row.Material is None:
                 MatObj = None
+            else:
+                MatObj = MatlMap.get(str(row.Material)) or MatlMapCI.get(str(row.Material).strip().casefold())
 
             if MatObj:
                 requiredFields={
@@ -355,10 +428,9 @@ def fnUploadActCountSprsht(req):
                         'BLDG': False,
                         'Both LocationOnly and CTD_QTY': False,
                         }
-                MatChanged = False
-                SRec = ActualCounts(org = _userorg)
-                for fldName, colNum in CountSprshtcolmnMap.items():
-                    V = row[colNum]
+                MatChanges = {}
+                SRec = ActualCounts(org = org)
+                for fldName, V in zip(row._fields, row):
                     if V!=None: 
                         if validatefld(fldName, V):
                             if   fldName == 'CountDate': 
@@ -375,7 +447,7 @@ def fnUploadActCountSprsht(req):
                                 requiredFields['BLDG'] = True
                             elif fldName == 'LOCATION': setattr(SRec, fldName, V)
                             elif fldName == 'LocationOnly': 
-                                setattr(SRec, fldName, makebool(V))
+                                setattr(SRec, fldName, bool(makebool(V)))   # makebool hands back a truthy string as is
                                 requiredFields['Both LocationOnly and CTD_QTY'] = True
                             elif fldName == 'CTD_QTY_Expr': 
                                 setattr(SRec, fldName, V)
@@ -385,49 +457,66 @@ def fnUploadActCountSprsht(req):
                             or fldName == 'TypicalPalletQty':
                                 if V == '' or V == None: V = 0
                                 if V != 0 and V != getattr(MatObj,fldName,0): 
-                                    setattr(MatObj, fldName, V)
-                                    MatChanged = True
+                                    MatChanges[fldName] = V
                         else:
-                            UplResults.append({'error':str(V)+' is invalid for '+fldName, 'rowNum':rowNum})
-                            
+                            ChunkResults.append({'error':str(V)+' is invalid for '+fldName, 'rowNum':rowNum})
+                            nErrors += 1
+                        
 
                 # are all required fields present?
                 AllRequiredPresent = True
                 for keyname, Prsnt in requiredFields.items():
                     AllRequiredPresent = AllRequiredPresent and Prsnt
                     if not Prsnt:
-                        UplResults.append({'error':keyname+' missing', 'rowNum':rowNum})
+                        ChunkResults.append({'error':keyname+' missing', 'rowNum':rowNum})
+                        nErrors += 1
 
                 if AllRequiredPresent:
-                    SRec.save()
-                    if MatChanged: MatObj.save()
-                    qs = type(SRec).objects.filter(pk=SRec.pk).values().first()
-                    res = {'error': False, 'rowNum':rowNum, 'TypicalQty':MatChanged, 'MaterialNum': row[CountSprshtcolmnMap['Material']] }
-                    res.update(qs)
-                    UplResults.append(res)
+                    # MatObj is shared by every row of this Material, so only accepted rows change it
+                    for fldName, V in MatChanges.items(): setattr(MatObj, fldName, V)
+                    if MatChanges: ChangedMatls[MatObj.pk] = MatObj
+                    res = {'error': False, 'rowNum':rowNum, 'TypicalQty':bool(MatChanges), 'MaterialNum': row.Material }
+                    NewCounts.append((SRec, res))
+                    ChunkResults.append(res)
                     nRows += 1
             else:
-                if row[CountSprshtcolmnMap['Material']]:
-                    UplResults.append({'error':row[CountSprshtcolmnMap['Material']]+' does not exist in MaterialList', 'rowNum':rowNum})
-
-        if rowNum >= MAX_COUNT_ROWS:
-            UplResults.insert(0,{'error':f'Data in spreadsheet rows {MAX_COUNT_ROWS+1} and beyond are being ignored.'})
-
-        # close and kill temp files
-        wb.close()
-        os.remove(fName)
-
-        cntext = {'UplResults':UplResults, 'nRowsRead':rowNum, 'nRowsAdded':nRows,
-                'orgname':_userorg.orgname, 'uname':req.user.get_full_name()
-                }
-        templt = 'frm_uploadCountEntry_Success.html'
-    else:
-        cntext = {'orgname':_userorg.orgname, 'uname':req.user.get_full_name()
-                }
-        templt = 'frm_UploadCountEntrySprdsht.html'
-    #endif
-
-    return render(req, templt, cntext)
+                if row.Material:
+                    ChunkResults.append({'error':row.Material+' does not exist in MaterialList', 'rowNum':rowNum})
+                    nErrors += 1
+            if len(ChunkResults) >= COUNTUPL_CHUNKSIZE: flushChunk()
+            if progress: progress(rowNum-1, nErrors, CountSprshtRdr.rowsTotal)
+        flushChunk()
+        if not ValidateOnly:
+            MaterialList.objects.bulk_update(ChangedMatls.values(), ['TypicalContainerQty', 'TypicalPalletQty'], batch_size=COUNTUPL_CHUNKSIZE)
+            fnCountSummaryUpdate(org, SummaryKeys)
+
+    CountSprshtRdr.close()
+    if progress: progress(rowNum-1, nErrors, force=True)
+
+    return {'ValidateOnly':ValidateOnly, 'nRowsRead':rowNum, 'nRowsAdded':nRows, 'nErrors':nErrors}
+
+def fnCTDQtyEvalBackfill(org, redo=False, chunksize=2000):
+    """
+    fill CTD_QTY_Eval and CTD_QTY_Status of org's ActualCounts that haven't been evaluated yet
+    (or all of them, if redo - e.g. after the expression parser changes).  Returns the number of records written.
+    bulk_update skips ActualCounts.save, so the CountDailySummary rows whose totals moved are rebuilt at the end
+    """
+    qs = ActualCounts.objects.filter(org=org)
+    if not redo: qs = qs.filter(CTD_QTY_Status='')
+    nRecs = 0
+    lastpk = 0
+    SummaryKeys = set()     # (CountDate, Material_id) of the counts whose CTD_QTY_Eval changed
+    while True:
+        # by pk, since the records written drop out of qs when not redo
+        chunk = list(qs.filter(pk__gt=lastpk).order_by('pk').only('pk', 'CountDate', 'Material_id', 'CTD_QTY_Expr', 'CTD_QTY_Eval')[:chunksize])
+        if not chunk: break
+        WasEval = [rec.CTD_QTY_Eval for rec in chunk]
+        ActualCounts.objects.bulk_update(fnEvalCTDQty(chunk), ['CTD_QTY_Eval', 'CTD_QTY_Status'])
+        SummaryKeys.update((rec.CountDate, rec.Material_id) for rec, Was in zip(chunk, WasEval) if rec.CTD_QTY_Eval != Was)
+        nRecs += len(chunk)
+        lastpk = chunk[-1].pk
+    if SummaryKeys: fnCountSummaryUpdate(org, SummaryKeys)
+    return nRecs
 
 #####################################################################
 #####################################################################
@@ -461,188 +550,139 @@ class ActualCountListForm(LoginRequiredMixin, ListView):
 #####################################################################
 #####################################################################
 
+def fnCTDQtyShown(CTD_QTY_Expr, CTD_QTY_Eval, CTD_QTY_Status):
+    # a count's CTD_QTY_Eval as the reports show it: a whole number without the .0, "????" if the expression is bad
+    if CTD_QTY_Status == 'OK':
+        return int(CTD_QTY_Eval) if CTD_QTY_Eval == int(CTD_QTY_Eval) else CTD_QTY_Eval
+    elif CTD_QTY_Status == '':
+        # not evaluated yet (on file before migration 0027, or written without save() - see manage.py backfill_ctd_qty_eval)
+        CTDQty = evaluate_many([CTD_QTY_Expr])[0]
+        return CTDQty.value if CTDQty.error is None else "????"
+    return "????"
+
+# A: Scheduled and Counted, B: UnScheduled, C: Scheduled but Not Counted (see procs_CountSummary)
+CountSummarySections = (('A', 'Scheduled and Counted'), ('B', 'UnScheduled'), ('C', 'Scheduled but Not Counted'))
+CountSummaryDetailRow = ReportRowClass('CountSummaryDetailRow', 'Detail', (
+        'Material', 'SchedCounter', 'CycCtID', 'ActCounter', 'BLDG', 'LOCATION', 'PKGID', 'TAGQTY',
+        'PossNotRec', 'MovDurCt', 'CTD_QTY_Expr', 'CTD_QTY_Eval', 'ActCountNotes'))
+CountSummarySummaryRow = ReportRowClass('CountSummarySummaryRow', 'Summary', (
+        'SAPNum', 'TypicalContainerQty', 'TypicalPalletQty', 'Material', 'PartType', 'CountTotal', 'SAPTotal',
+        'Diff', 'Accuracy', 'CMFlag', 'ReasonScheduled', 'SchedNotes', 'MatlNotes'))
+# (column heading, field of the report's rows) of the Count Summary export
+CountSummaryExportCols = (
+        ('Material', 'Material'), ('Part Type', 'PartType'),
+        ('Sched Counter', 'SchedCounter'), ('CycCtID', 'CycCtID'), ('Counter', 'ActCounter'),
+        ('BLDG', 'BLDG'), ('LOCATION', 'LOCATION'), ('PKGID', 'PKGID'), ('TAGQTY', 'TAGQTY'),
+        ('Poss Not Rec', 'PossNotRec'), ('Mov During Ct', 'MovDurCt'),
+        ('CTD QTY Expr', 'CTD_QTY_Expr'), ('CTD QTY', 'CTD_QTY_Eval'), ('Count Notes', 'ActCountNotes'),
+        ('Count Total', 'CountTotal'), ('SAP Total', 'SAPTotal'), ('Diff', 'Diff'), ('Accuracy', 'Accuracy'),
+        ('SAP Locations', 'SAPNum'), ('Typical Container Qty', 'TypicalContainerQty'), ('Typical Pallet Qty', 'TypicalPalletQty'),
+        ('CM Flag', 'CMFlag'), ('Reason Scheduled', 'ReasonScheduled'), ('Sched Notes', 'SchedNotes'), ('Material Notes', 'MatlNotes'),
+        )
+CountSummaryExportFlds = [fld for hdg, fld in CountSummaryExportCols]
+
 @login_required
 def fnCountSummaryRpt (req, passedCountDate='CURRENT_DATE'):
     _userorg = WICSuser.objects.get(user=req.user).org
 
-    # get the SAP data
     dtobj_pDate = isDate(passedCountDate)
     if not dtobj_pDate: dtobj_pDate = calvindate().as_datetime()
-    SAP_SOH = fnSAPList(_userorg,dtobj_pDate)
-    
-    def CreateOutputRows(raw_qs, Eval_CTDQTY=True):
-        def SummaryLine(lastrow):
-            # summarize last Matl
-            # total SAP Numbers
-            SAPTot = 0
-            outputline = dict()
-            outputline['type'] = 'Summary'
-            outputline['SAPNum'] = []
-            for SAProw in SAP_SOH['SAPTable'].filter(Material=lastrow['Material']): 
-                outputline['SAPNum'].append((SAProw.StorageLocation, SAProw.Amount, SAProw.BaseUnitofMeasure))
-                SAPTot += SAProw.Amount*SAProw.mult
-            outputline['TypicalContainerQty'] = lastrow['TypicalContainerQty']
-            outputline['TypicalPalletQty'] = lastrow['TypicalPalletQty']
-            outputline['Material'] = lastrow['Material']
-            outputline['PartType'] = lastrow['PartType']
-            outputline['CountTotal'] = lastrow['TotalCounted']
-            outputline['SAPTotal'] = SAPTot
-            outputline['Diff'] = lastrow['TotalCounted'] - SAPTot
-            divsr = 1
-            if lastrow['TotalCounted']!=0 or SAPTot!=0: divsr = max(lastrow['TotalCounted'], SAPTot)
-            outputline['Accuracy'] = min(lastrow['TotalCounted'], SAPTot) / divsr * 100
-            outputline['CMFlag'] = lastrow['CMFlag']
-            outputline['ReasonScheduled'] = lastrow['ReasonScheduled']
-            outputline['SchedNotes'] = lastrow['SchedNotes']
-            outputline['MatlNotes'] = lastrow['MatlNotes']
-            #outputrows.append(outputline)
-
-            return outputline
-
-        def CreateLastrow(rawrow):
-            lastrow = dict()
-            lastrow['Material'] = rawrow.Matl_PartNum
-            lastrow['PartType'] = rawrow.PartType
-            lastrow['TotalCounted'] = 0
-            lastrow['CMFlag'] = rawrow.cs_CMPrintFlag
-            lastrow['SchedNotes'] = rawrow.cs_Notes
-            lastrow['TypicalContainerQty'] = rawrow.TypicalContainerQty
-            lastrow['TypicalPalletQty'] = rawrow.TypicalPalletQty
-            lastrow['MatlNotes'] = rawrow.mtl_Notes
-            lastrow['ReasonScheduled'] = rawrow.cs_ReasonScheduled
-
-            return lastrow
-
-        def DetailLine(rawrow, Eval_CTDQTY=True):
-            outputline = dict()
-            outputline['type'] = 'Detail'
-            outputline['CycCtID'] = rawrow.ac_CycCtID
-            outputline['Material'] = rawrow.Matl_PartNum
-            outputline['SchedCounter'] = rawrow.cs_Counter
-            outputline['ActCounter'] = rawrow.ac_Counter
-            outputline['BLDG'] = rawrow.ac_BLDG
-            outputline['LOCATION'] = rawrow.ac_LOCATION
-            outputline['PKGID'] = rawrow.ac_PKGID_Desc
-            outputline['TAGQTY'] = rawrow.ac_TAGQTY
-            outputline['PossNotRec'] = rawrow.FLAG_PossiblyNotRecieved
-            outputline['MovDurCt'] = rawrow.FLAG_MovementDuringCount
-            outputline['CTD_QTY_Expr'] = rawrow.ac_CTD_QTY_Expr
-            if Eval_CTDQTY:
-                try:
-                    outputline['CTD_QTY_Eval'] = evaluate(rawrow.ac_CTD_QTY_Expr)   # yes, I know the risks - Ill write my own parser later ...
-                    # do next line at caller
-                    # lastrow['TotalCounted'] += outputline['CTD_QTY_Eval']
-                except:
-                    # Exception('bad expression:'+rawrow.ac_CTD_QTY_Expr)
-                    outputline['CTD_QTY_Eval'] = "????"
-            else:
-                outputline['CTD_QTY_Eval'] = "----"
-            outputline['ActCountNotes'] = rawrow.ac_Notes
-            # outputrows.append(outputline)
-
-            return outputline
-        
-        outputrows = []
-        lastrow = {'Material': None}
-        for rawrow in raw_qs:
-            if rawrow.Matl_PartNum != lastrow['Material']:     # new Matl
-                if outputrows:
-                    outputrows.append(SummaryLine(lastrow))
-                # no else -  if outputrows is empty, this is the first row, so keep going
-
-                # this new material is now the "old" one; save values for when it switches, and we do the above block
-                # this whole block becomes
-                lastrow = CreateLastrow(rawrow)
-            #endif
-
-            # process this row
-            outputline = DetailLine(rawrow, Eval_CTDQTY)
-            outputrows.append(outputline)
-            if isinstance(outputline['CTD_QTY_Eval'],(int,float)): lastrow['TotalCounted'] += outputline['CTD_QTY_Eval']
-        # endfor
-        # need to do the summary on the last row
-        if outputrows:
-            # summarize last Matl
-            outputrows.append(SummaryLine(lastrow))
-        
-        return outputrows
-        
-    ### main body of fnCountSummaryRpt
-
-    fldlist = "0 as id, cs.id as cs_id, cs.CountDate as cs_CountDate , cs.Counter as cs_Counter" \
-        ", cs.Priority as cs_Priority, cs.ReasonScheduled as cs_ReasonScheduled, cs.CMPrintFlag as cs_CMPrintFlag" \
-        ", cs.Notes as cs_Notes" \
-        ", ac.id as ac_id, ac.CountDate as ac_CountDate, ac.CycCtID as ac_CycCtID, ac.Counter as ac_Counter" \
-        ", ac.LocationOnly as ac_LocationOnly, ac.CTD_QTY_Expr as ac_CTD_QTY_Expr, ac.BLDG as ac_BLDG" \
-        ", ac.LOCATION as ac_LOCATION, ac.PKGID_Desc as ac_PKGID_Desc, ac.TAGQTY as ac_TAGQTY" \
-        ", ac.FLAG_PossiblyNotRecieved, ac.FLAG_MovementDuringCount, ac.Notes as ac_Notes" \
-        ", mtl.Material as Matl_PartNum, (SELECT WhsePartType FROM WICS_whseparttypes WHERE id=mtl.PartType_id) as PartType" \
-        ", mtl.Description, mtl.TypicalContainerQty, mtl.TypicalPalletQty, mtl.Notes as mtl_Notes"
-    org_condition = '(ac.org_id = ' + str(_userorg.pk) + ' OR cs.org_id = ' + str(_userorg.pk) + ') '
-    if isDate(passedCountDate): datestr = WrapInQuotes(passedCountDate,"'","'")
-    else: datestr = passedCountDate
-    date_condition = '(ac.CountDate = ' + datestr + ' OR cs.CountDate = ' + datestr + ') '
-    order_by = 'Matl_PartNum'
-
-    SummaryReport = []
-
-    A_Sched_Ctd_from = 'WICS_countschedule cs INNER JOIN WICS_materiallist mtl INNER JOIN WICS_actualcounts ac'    
-    A_Sched_Ctd_joinon = 'cs.CountDate=ac.CountDate AND cs.Material_id=ac.Material_id AND ac.Material_id=mtl.id'    
-    A_Sched_Ctd_where = ''
-    A_Sched_Ctd_sql = 'SELECT ' + fldlist + \
-        ' FROM ' + A_Sched_Ctd_from + \
-        ' ON ' + A_Sched_Ctd_joinon + \
-        ' WHERE NOT ac.LocationOnly AND ' + org_condition + ' AND ' + date_condition + \
-        ' ORDER BY ' + order_by
-        # + ' AND ' + A_Sched_Ctd_where
-    A_Sched_Ctd_qs = CountSchedule.objects.raw(A_Sched_Ctd_sql)
-    # build display lines
-    SummaryReport.append({
-                'Title':'Scheduled and Counted',
-                'outputrows': CreateOutputRows(A_Sched_Ctd_qs)
-                })
-
-    B_UnSched_Ctd_from = 'WICS_countschedule cs RIGHT JOIN' \
-        ' (WICS_actualcounts ac INNER JOIN WICS_materiallist mtl ON ac.Material_id=mtl.id)'
-    B_UnSched_Ctd_joinon = 'cs.CountDate=ac.CountDate AND cs.Material_id=ac.Material_id'
-    B_UnSched_Ctd_where = '(cs.id IS NULL)'
-    B_UnSched_Ctd_sql = 'SELECT ' + fldlist + ' ' + \
-        ' FROM ' + B_UnSched_Ctd_from + \
-        ' ON ' + B_UnSched_Ctd_joinon + \
-        ' WHERE NOT ac.LocationOnly AND ' + org_condition + ' AND ' + date_condition + \
-        ' AND ' + B_UnSched_Ctd_where + \
-        ' ORDER BY ' + order_by
-    B_UnSched_Ctd_qs = CountSchedule.objects.raw(B_UnSched_Ctd_sql)
-    SummaryReport.append({
-                'Title':'UnScheduled',
-                'outputrows': CreateOutputRows(B_UnSched_Ctd_qs)
-                })
-    
-    C_Sched_NotCtd_Ctd_from = '(WICS_countschedule cs INNER JOIN WICS_materiallist mtl ON cs.Material_id=mtl.id)' \
-        ' LEFT JOIN WICS_actualcounts ac'
-    C_Sched_NotCtd_Ctd_joinon = 'cs.CountDate=ac.CountDate AND cs.Material_id=ac.Material_id'
-    C_Sched_NotCtd_Ctd_where = '(ac.id IS NULL)'
-    C_Sched_NotCtd_Ctd_sql = 'SELECT ' + fldlist + ' ' + \
-        ' FROM ' + C_Sched_NotCtd_Ctd_from + \
-        ' ON ' + C_Sched_NotCtd_Ctd_joinon + \
-        ' WHERE ' + org_condition + ' AND ' + date_condition + \
-        ' AND ' + C_Sched_NotCtd_Ctd_where + \
-        ' ORDER BY ' + order_by
-    C_Sched_NotCtd_Ctd_qs = CountSchedule.objects.raw(C_Sched_NotCtd_Ctd_sql)
-    SummaryReport.append({
-                'Title':'Scheduled but Not Counted',
-                'outputrows': CreateOutputRows(C_Sched_NotCtd_Ctd_qs, Eval_CTDQTY=False)
-                })
-    AccuracyCutoff = { 
-                'DANGER': float(getcParm('ACCURACY-DANGER')),
-                'SUCCESS': float(getcParm('ACCURACY-SUCCESS')),
-                'WARNING': float(getcParm('ACCURACY-WARNING')),
-                }
+    CountDate = calvindate(dtobj_pDate).as_datetime().date()
+
+    def SummaryLine(key, firstrow, totals, looked):
+        # the totals, schedule and SAP numbers, as kept in CountDailySummary
+        SumRow = firstrow[0]
+        Matl = SumRow.Material
+        SAPTot = SumRow.SAPTotal if SumRow.SAPStorageLocations else 0
+        CountTotal = SumRow.CountTotal
+        if CountTotal == int(CountTotal): CountTotal = int(CountTotal)
+        return CountSummarySummaryRow(
+            SAPNum = [tuple(SL) for SL in SumRow.SAPStorageLocations],
+            TypicalContainerQty = Matl.TypicalContainerQty,
+            TypicalPalletQty = Matl.TypicalPalletQty,
+            Material = Matl.Material,
+            PartType = Matl.PartType.WhsePartType if Matl.PartType else None,
+            CountTotal = CountTotal,
+            SAPTotal = SAPTot,
+            Diff = CountTotal - SAPTot,
+            Accuracy = SumRow.Accuracy,
+            CMFlag = SumRow.CMPrintFlag,
+            ReasonScheduled = SumRow.ReasonScheduled,
+            SchedNotes = SumRow.SchedNotes,
+            MatlNotes = Matl.Notes,
+            )
+
+    def DetailLine(row):
+        # one count of SumRow's Material, or the schedule line of a Material that wasn't counted (ac None)
+        SumRow, ac = row
+        if ac is None and SumRow.Category != 'C': return None
+        SchedCounter = SumRow.SchedCounter if SumRow.Scheduled else None
+        if ac is None:
+            return CountSummaryDetailRow(Material=SumRow.Material.Material, SchedCounter=SchedCounter, CTD_QTY_Eval="----")
+        return CountSummaryDetailRow(Material=SumRow.Material.Material, SchedCounter=SchedCounter,
+                CycCtID=ac.CycCtID, ActCounter=ac.Counter, BLDG=ac.BLDG, LOCATION=ac.LOCATION, PKGID=ac.PKGID_Desc,
+                TAGQTY=ac.TAGQTY, PossNotRec=ac.FLAG_PossiblyNotRecieved, MovDurCt=ac.FLAG_MovementDuringCount,
+                CTD_QTY_Expr=ac.CTD_QTY_Expr, CTD_QTY_Eval=fnCTDQtyShown(ac.CTD_QTY_Expr, ac.CTD_QTY_Eval, ac.CTD_QTY_Status),
+                ActCountNotes=ac.Notes)
+
+    def SectionSource(Category):
+        # (CountDailySummary row, count) for each count of the section's Materials, in Material order,
+        # (row, None) for a Material without counts.  The summary rows and the counts are read in the
+        # same order, a chunk of Materials at a time, and walked together
+        SumRows = CountDailySummary.objects.filter(org=_userorg, CountDate=CountDate, Category=Category) \
+                    .select_related('Material', 'Material__PartType').order_by('Material__Material', 'Material_id')
+        SumIter = SumRows.iterator(chunk_size=COUNTSUMMARY_CHUNKSIZE)
+        while True:
+            chunk = list(itertools.islice(SumIter, COUNTSUMMARY_CHUNKSIZE))
+            if not chunk: break
+            ChunkCounts = iter(())
+            if Category != 'C':
+                ChunkCounts = ActualCounts.objects.filter(org=_userorg, CountDate=CountDate, LocationOnly=False,
+                                    Material_id__in=[SumRow.Material_id for SumRow in chunk]) \
+                                .order_by('Material__Material', 'Material_id', 'pk').iterator(chunk_size=COUNTSUMMARY_CHUNKSIZE)
+            ac = next(ChunkCounts, None)
+            for SumRow in chunk:
+                if ac is None or ac.Material_id != SumRow.Material_id:
+                    yield (SumRow, None)
+                while ac is not None and ac.Material_id == SumRow.Material_id:
+                    yield (SumRow, ac)
+                    ac = next(ChunkCounts, None)
+
+    def SectionLines(Category):
+        return fnGroupedReport(SectionSource(Category), groupkey=lambda row: row[0].Material_id,
+                               detail=DetailLine, summary=SummaryLine)
+
+    def ExportRows():
+        for Category, Title in CountSummarySections:
+            for outputline in SectionLines(Category):
+                Vals = [outputline.get(fld) for hdg, fld in CountSummaryExportCols]
+                if outputline.type == 'Summary':
+                    Vals[CountSummaryExportFlds.index('SAPNum')] = ', '.join('%s: %s %s' % SL for SL in outputline.SAPNum)
+                yield [Title, outputline.type] + Vals
+
+    # a date from before CountDailySummary was kept (or changed behind its back) is built the first time it's asked for
+    Counted = set(ActualCounts.objects.filter(org=_userorg, CountDate=CountDate, LocationOnly=False)
+                    .values_list('Material_id', flat=True).distinct())
+    SumCategories = CountDailySummary.objects.filter(org=_userorg, CountDate=CountDate).values_list('Material_id', 'Category')
+    Summarized = {Material_id for Material_id, Category in SumCategories if Category in ('A', 'B')}
+    if not Summarized.issuperset(Counted) \
+    or (not SumCategories and CountSchedule.objects.filter(org=_userorg, CountDate=CountDate).exists()):
+        fnCountSummaryRebuild(_userorg, CountDate)
+
+    ExportFmt = fnExportFormat(req)
+    if ExportFmt:
+        header = ['Section', 'Line'] + [hdg for hdg, fld in CountSummaryExportCols]
+        return SprshtExportResponse(ExportFmt, 'CountSummary-%s' % CountDate, header, ExportRows(), 'Count Summary')
+
+    SAPDate = fnSAPSnapshotDate(_userorg, CountDate)
+
+    SummaryReport = [{'Title':Title, 'outputrows': list(SectionLines(Cat))} for Cat, Title in CountSummarySections]
+    AccuracyCutoff = fnAccuracyCutoff()
 
     # display the form
     cntext = {
             'CountDate': dtobj_pDate,
-            'SAPDate': SAP_SOH['SAPDate'],
+            'SAPDate': SAPDate,
             'AccuracyCutoff': AccuracyCutoff,
             'SummaryReport': SummaryReport,
             'orgname':_userorg.orgname, 'uname':req.user.get_full_name()
@@ -654,3 +694,148 @@ def fnCountSummaryRpt (req, passedCountDate='CURRENT_DATE'):
     return render(req, templt, cntext)
 
 
+#####################################################################
+#####################################################################
+#####################################################################
+
+COUNTACCURACY_SAPCHUNK = 500    # Materials per SAP_SOHTotals query in fnCountAccuracy
+
+class CountAccuracyRptForm(forms.Form):
+    FromDate = forms.DateField(required=True)
+    ToDate = forms.DateField(required=True)
+    PartType = forms.ModelChoiceField(queryset=WhsePartTypes.objects.none(), required=False, empty_label='(all)')
+    Material = forms.CharField(required=False, label='Material contains')
+
+    def __init__(self, org, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields['PartType'].queryset = WhsePartTypes.objects.filter(org=org).order_by('WhsePartType')
+
+
+def fnCountAccuracy(org, FromDate, ToDate, PartType=None, Material=None):
+    """
+    count accuracy of org's counts from FromDate to ToDate (inclusive), optionally only PartType (a WhsePartTypes)
+    and Materials containing Material.  Each (Material, CountDate) is compared to the SAP snapshot for its date
+    (see fnSAPSnapshotDate), as in the Count Summary report.
+    The counts come from the db already totalled per Material and date (CTD_QTY_Eval), in Material, date order,
+    and are matched to the SAP totals by walking both in date order, a chunk of Materials at a time.
+    Only counts whose CTD_QTY_Status is OK are totalled; the others are tallied as nNotEvaluated, and a
+    Material/date with no OK count at all is left out of the accuracy figures rather than taken as a count of 0
+    returns {'ByDay': [...], 'ByMaterial': [...]} - see the cntext of fnCountAccuracyRpt
+    """
+    Counts = ActualCounts.objects.filter(org=org, CountDate__gte=FromDate, CountDate__lte=ToDate, LocationOnly=False)
+    if PartType: Counts = Counts.filter(Material__PartType=PartType)
+    if Material: Counts = Counts.filter(Material__Material__icontains=Material)
+    Groups = Counts.values('Material_id', 'Material__Material', 'Material__PartType__WhsePartType', 'CountDate') \
+                .annotate(CountTotal=Sum('CTD_QTY_Eval', filter=Q(CTD_QTY_Status='OK')), nCounts=Count('id'),
+                          nNotEvaluated=Count('id', filter=~Q(CTD_QTY_Status='OK'))) \
+                .order_by('Material__Material', 'Material_id', 'CountDate')
+
+    SnapDates = list(SAP_SOHSnapshots.objects.filter(org=org).order_by('uploaded_at').values_list('uploaded_at', flat=True))
+    def SAPDateFor(CountDate):
+        # fnSAPSnapshotDate, without the trip to the cache
+        n = bisect.bisect_right(SnapDates, CountDate)
+        if n: return SnapDates[n-1]
+        return SnapDates[0] if SnapDates else None
+
+    AccuracyCutoff = fnAccuracyCutoff()
+    ByDay = {}
+    ByMaterial = []
+
+    def Finish(MatlGroups):
+        # MatlGroups: [(Material, PartType, [group, ...] in date order)] - one SAP_SOHTotals query for all of them
+        SAPRuns = {}
+        SAPDates = [SAPDateFor(G['CountDate']) for M, PT, Gs in MatlGroups for G in Gs[:1] + Gs[-1:]]
+        if SnapDates and MatlGroups:
+            for R in SAP_SOHTotals.objects.filter(org=org, Material__in=[M for M, PT, Gs in MatlGroups],
+                            uploaded_at__lte=max(SAPDates)).exclude(retired_at__lte=min(SAPDates)) \
+                            .values_list('Material', 'uploaded_at', 'retired_at', 'Qty'):
+                SAPRuns.setdefault(R[0], []).append(R[1:])
+        for Matl, PartType, Gs in MatlGroups:
+            Runs = sorted(SAPRuns.get(Matl, []), key=lambda Run: Run[0])
+            r = 0
+            MatlRow = {'Material': Matl, 'PartType': PartType, 'nDays': 0, 'nNotEvaluated': 0, 'AccuracySum': 0.0, 'MinAccuracy': None,
+                        'LastCountDate': None, 'LastCountTotal': None, 'LastSAPTotal': None, 'LastAccuracy': None}
+            for G in Gs:
+                SAPDate = SAPDateFor(G['CountDate'])
+                Day = ByDay.setdefault(G['CountDate'], {'CountDate': G['CountDate'], 'SAPDate': SAPDate,
+                            'nMaterials': 0, 'nCounts': 0, 'nNotEvaluated': 0, 'CountTotal': 0.0, 'SAPTotal': 0.0, 'AccuracySum': 0.0,
+                            'nDanger': 0, 'nWarning': 0, 'nSuccess': 0})
+                Day['nCounts'] += G['nCounts']
+                Day['nNotEvaluated'] += G['nNotEvaluated']
+                MatlRow['nNotEvaluated'] += G['nNotEvaluated']
+                # none of the day's counts could be evaluated - its accuracy is unknown, not 0
+                if G['nNotEvaluated'] == G['nCounts']: continue
+
+                # the SAP run for SAPDate - Gs is in date order, so SAPDate never goes backwards
+                while r+1 < len(Runs) and Runs[r+1][0] <= SAPDate: r += 1
+                SAPQty = 0
+                if r < len(Runs) and Runs[r][0] <= SAPDate and (Runs[r][1] is None or Runs[r][1] > SAPDate):
+                    SAPQty = Runs[r][2]
+                CountTotal = G['CountTotal'] or 0
+                Accuracy = fnCountSummaryAccuracy(CountTotal, SAPQty)
+
+                Day['nMaterials'] += 1
+                Day['CountTotal'] += CountTotal
+                Day['SAPTotal'] += SAPQty
+                Day['AccuracySum'] += Accuracy
+                if Accuracy < AccuracyCutoff['DANGER']: Day['nDanger'] += 1
+                elif Accuracy > AccuracyCutoff['SUCCESS']: Day['nSuccess'] += 1
+                elif Accuracy > AccuracyCutoff['WARNING']: Day['nWarning'] += 1
+
+                MatlRow['nDays'] += 1
+                MatlRow['AccuracySum'] += Accuracy
+                if MatlRow['MinAccuracy'] is None or Accuracy < MatlRow['MinAccuracy']: MatlRow['MinAccuracy'] = Accuracy
+                MatlRow['LastCountDate'], MatlRow['LastCountTotal'], MatlRow['LastSAPTotal'], MatlRow['LastAccuracy'] = \
+                    G['CountDate'], CountTotal, SAPQty, Accuracy
+            MatlRow['Accuracy'] = MatlRow['AccuracySum'] / MatlRow['nDays'] if MatlRow['nDays'] else None
+            ByMaterial.append(MatlRow)
+        MatlGroups.clear()
+
+    MatlGroups = []
+    LastMatlID = None
+    for G in Groups.iterator():
+        if G['Material_id'] != LastMatlID:
+            if len(MatlGroups) >= COUNTACCURACY_SAPCHUNK: Finish(MatlGroups)
+            MatlGroups.append((G['Material__Material'], G['Material__PartType__WhsePartType'], []))
+            LastMatlID = G['Material_id']
+        MatlGroups[-1][2].append(G)
+    Finish(MatlGroups)
+
+    for Day in ByDay.values():
+        Day['Accuracy'], Day['TotalAccuracy'] = None, None
+        if Day['nMaterials']:
+            Day['Accuracy'] = Day['AccuracySum'] / Day['nMaterials']
+            Day['TotalAccuracy'] = fnCountSummaryAccuracy(Day['CountTotal'], Day['SAPTotal'])
+    return {'ByDay': [ByDay[D] for D in sorted(ByDay)], 'ByMaterial': ByMaterial}
+
+
+def fnAccuracyCutoff():
+    return { 
+        'DANGER': float(getcParm('ACCURACY-DANGER')),
+        'SUCCESS': float(getcParm('ACCURACY-SUCCESS')),
+        'WARNING': float(getcParm('ACCURACY-WARNING')),
+        }
+
+
+@login_required
+def fnCountAccuracyRpt(req):
+    _userorg = WICSuser.objects.get(user=req.user).org
+
+    Today = calvindate().as_datetime().date()
+    fltrFm = CountAccuracyRptForm(_userorg, req.GET or None,
+                    initial={'FromDate': Today - datetime.timedelta(days=30), 'ToDate': Today})
+    Accuracy = {'ByDay': [], 'ByMaterial': []}
+    if fltrFm.is_valid():
+        Accuracy = fnCountAccuracy(_userorg, fltrFm.cleaned_data['FromDate'], fltrFm.cleaned_data['ToDate'],
+                        fltrFm.cleaned_data['PartType'], fltrFm.cleaned_data['Material'])
+
+    cntext = {
+            'fltrFm': fltrFm,
+            'ByDay': Accuracy['ByDay'],
+            'ByMaterial': Accuracy['ByMaterial'],
+            'AccuracyCutoff': fnAccuracyCutoff(),
+            'orgname':_userorg.orgname, 'uname':req.user.get_full_name()
+            }
+    templt = 'rpt_CountAccuracy.html'
+    return render(req, templt, cntext)
+
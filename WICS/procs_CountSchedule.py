@@ -15,7 +15,7 @@ from userprofiles.models import WICSuser
 from WICS.forms import CountScheduleRecordForm, RelatedMaterialInfo
 from WICS.models import MaterialList, CountSchedule, \
                         WhsePartTypes, LastFoundAt, WorksheetZones, Location_WorksheetZone
-from WICS.procs_SAP import fnSAPList
+from WICS.procs_SAP import fnSAPList, fnSAPSnapshotTotals
 from typing import *
 # below: skip Sat, Sun using dateutil, dateutil.rrule, dateutil.rruleset
 # implement skipping holidays
@@ -306,6 +306,7 @@ class CountWorksheetReport(LoginRequiredMixin, ListView):
     def get_queryset(self) -> QuerySet[Any]:
         SAP_SOH = fnSAPList(self._userorg,self.CountDate)
         self.SAPDate = SAP_SOH['SAPDate']
+        SAPTotals = fnSAPSnapshotTotals(self._userorg, self.SAPDate)
         qs = CountSchedule.objects.filter(org=self._userorg, CountDate=self.CountDate).order_by('Counter', 'Material').select_related('Material','Material__PartType')   # figure out how to pass in self.ordering
         qs = qs.annotate(LastFoundAt=Value(''), SAPQty=Value(0), MaterialBarCode=Value(''))
         Mat3char = None
@@ -331,8 +332,7 @@ class CountWorksheetReport(LoginRequiredMixin, ListView):
                 if regex.search(lz['location'],rec.LastFoundAt['lastFoundAt']):    #if lz['location'] in rec.LastFoundAt['lastFoundAt']: 
                     zoneList.append(lz['zone'])
             rec.Zones = zoneList
-            for SAProw in SAP_SOH['SAPTable'].filter(Material=rec.Material): 
-                rec.SAPQty += SAProw.Amount*SAProw.mult
+            if strMatlNum in SAPTotals: rec.SAPQty = SAPTotals[strMatlNum]['Qty']
 
         return qs
 
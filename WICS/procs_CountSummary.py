@@ -0,0 +1,136 @@
+import datetime
+from django.db import transaction
+from django.db.models import Count, Q, Sum
+from cMenu.utils import calvindate
+from WICS.models import ActualCounts, CountSchedule, MaterialList, CountDailySummary
+from WICS.procs_SAP import fnSAPSnapshotDate, fnSAPSnapshotDateIn, fnSAPSnapshotDates, fnSAPSnapshotTotals
+
+
+# CountDailySummary - the Count Summary report (procs_ActualCounts.fnCountSummaryRpt), kept up to date as
+#   counts and schedules are saved or deleted (ActualCounts/CountSchedule .save and .delete, the count
+#   spreadsheet upload) and SAP snapshots are loaded (procs_SAP.fnSAPIngest, fnSAPTotalsRebuild)
+# manage.py rebuild_count_summary rebuilds it from scratch
+
+COUNTSUMMARY_CHUNKSIZE = 500    # Materials per query when a date's summary rows are updated
+
+def _asdate(D):
+    if isinstance(D, datetime.datetime): return D.date()
+    if isinstance(D, datetime.date): return datetime.date(D.year, D.month, D.day)
+    return calvindate(D).as_datetime().date()
+
+
+def fnCountSummaryAccuracy(CountTotal, SAPTotal):
+    # as the report has always figured it; a negative SAP total against no count is 0%, not a division by 0
+    divsr = 1
+    if CountTotal!=0 or SAPTotal!=0: divsr = max(CountTotal, SAPTotal)
+    if divsr == 0: return 0.0
+    return min(CountTotal, SAPTotal) / divsr * 100
+
+
+def fnCountSummaryUpdate(org, keys):
+    """
+    rebuild org's CountDailySummary rows for keys, an iterable of (CountDate, Material_id),
+    from its ActualCounts, CountSchedule and SAP totals.  A key with no counts and no schedule loses its row
+    """
+    byDate = {}
+    for CountDate, Material_id in keys:
+        byDate.setdefault(_asdate(CountDate), set()).add(Material_id)
+
+    with transaction.atomic():
+        for CountDate, MatlIDs in byDate.items():
+            MatlIDs = sorted(MatlIDs)
+            for n in range(0, len(MatlIDs), COUNTSUMMARY_CHUNKSIZE):
+                _CountSummaryBuild(org, CountDate, MatlIDs[n:n+COUNTSUMMARY_CHUNKSIZE])
+
+
+def _CountSummaryBuild(org, CountDate, MatlIDs=None):
+    # (re)write the summary rows of org, CountDate for MatlIDs (None: every Material counted or scheduled that day)
+    Counts = ActualCounts.objects.filter(org=org, CountDate=CountDate)
+    Scheds = CountSchedule.objects.filter(org=org, CountDate=CountDate)
+    Existing = CountDailySummary.objects.filter(org=org, CountDate=CountDate)
+    if MatlIDs is not None:
+        Counts = Counts.filter(Material_id__in=MatlIDs)
+        Scheds = Scheds.filter(Material_id__in=MatlIDs)
+        Existing = Existing.filter(Material_id__in=MatlIDs)
+
+    CountTots = {R['Material_id']: R for R in Counts.values('Material_id').annotate(
+                    CountTotal=Sum('CTD_QTY_Eval', filter=Q(LocationOnly=False)),
+                    nCounts=Count('id', filter=Q(LocationOnly=False)),
+                    nLocationOnly=Count('id', filter=Q(LocationOnly=True)),
+                    ).order_by()}
+    SchedRecs = {S.Material_id: S for S in Scheds}
+    MatlIDs = set(CountTots) | set(SchedRecs)
+    MatlNums = dict(MaterialList.objects.filter(pk__in=MatlIDs).values_list('pk', 'Material')) if MatlIDs else {}
+    SAPDate = fnSAPSnapshotDate(org, CountDate, cached=False)
+    SAPTotals = fnSAPSnapshotTotals(org, SAPDate, set(MatlNums.values())) if MatlNums else {}
+
+    NewRows = []
+    for Material_id in MatlIDs:
+        C = CountTots.get(Material_id, {'CountTotal': None, 'nCounts': 0, 'nLocationOnly': 0})
+        S = SchedRecs.get(Material_id)
+        if C['nCounts']: Category = 'A' if S else 'B'
+        elif S and not C['nLocationOnly']: Category = 'C'
+        else: Category = ''
+        T = SAPTotals.get(MatlNums[Material_id], {})
+        Row = CountDailySummary(org=org, CountDate=CountDate, Material_id=Material_id, Category=Category,
+                nCounts=C['nCounts'], nLocationOnly=C['nLocationOnly'], CountTotal=C['CountTotal'] or 0,
+                Scheduled=S is not None)
+        if S:
+            Row.SchedCounter, Row.ReasonScheduled, Row.CMPrintFlag, Row.SchedNotes = S.Counter, S.ReasonScheduled, S.CMPrintFlag, S.Notes
+        _CountSummarySetSAP(Row, SAPDate, T)
+        NewRows.append(Row)
+
+    Existing.delete()
+    CountDailySummary.objects.bulk_create(NewRows)
+
+
+def _CountSummarySetSAP(Row, SAPDate, T):
+    Row.SAPDate = SAPDate
+    Row.SAPTotal = T.get('Qty', 0)
+    Row.SAPStorageLocations = T.get('StorageLocations', [])
+    Row.Accuracy = fnCountSummaryAccuracy(Row.CountTotal, Row.SAPTotal)
+
+
+def fnCountSummaryRebuild(org, CountDate=None):
+    """
+    rebuild org's CountDailySummary for CountDate, or for every date if CountDate is None
+    returns the number of dates rebuilt
+    """
+    if CountDate is not None:
+        Dates = [_asdate(CountDate)]
+    else:
+        Dates = set(ActualCounts.objects.filter(org=org).values_list('CountDate', flat=True).distinct()) \
+              | set(CountSchedule.objects.filter(org=org).values_list('CountDate', flat=True).distinct())
+    with transaction.atomic():
+        if CountDate is None: CountDailySummary.objects.filter(org=org).delete()
+        for D in sorted(Dates):
+            _CountSummaryBuild(org, D)
+    return len(Dates)
+
+
+def fnCountSummarySAPRefresh(org, FromDate=None, ToDate=None):
+    """
+    refresh the SAP totals and accuracy of org's CountDailySummary rows with FromDate <= CountDate < ToDate
+    (None: no limit) - the dates a SAP snapshot load can change.  Returns the number of rows refreshed
+    """
+    Rows = CountDailySummary.objects.filter(org=org)
+    if FromDate: Rows = Rows.filter(CountDate__gte=FromDate)
+    if ToDate: Rows = Rows.filter(CountDate__lt=ToDate)
+    nRows = 0
+    lastpk = 0
+    SnapDates = fnSAPSnapshotDates(org.pk)     # not the cache - see fnSAPSnapshotDate
+    with transaction.atomic():
+        while True:
+            chunk = list(Rows.filter(pk__gt=lastpk).order_by('pk').select_related('Material')[:COUNTSUMMARY_CHUNKSIZE])
+            if not chunk: break
+            bySAPDate = {}
+            for Row in chunk:
+                bySAPDate.setdefault(fnSAPSnapshotDateIn(SnapDates, Row.CountDate), []).append(Row)
+            for SAPDate, SAPRows in bySAPDate.items():
+                SAPTotals = fnSAPSnapshotTotals(org, SAPDate, {Row.Material.Material for Row in SAPRows})
+                for Row in SAPRows:
+                    _CountSummarySetSAP(Row, SAPDate, SAPTotals.get(Row.Material.Material, {}))
+            CountDailySummary.objects.bulk_update(chunk, ['SAPDate', 'SAPTotal', 'SAPStorageLocations', 'Accuracy'])
+            nRows += len(chunk)
+            lastpk = chunk[-1].pk
+    return nRows
@@ -1,4 +1,5 @@
 import datetime
+import itertools
 from datetime import MINYEAR
 from operator import attrgetter
 #import dateutil.utils
@@ -7,7 +8,8 @@ from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.db import models
-from django.db.models import Value, Sum
+from django.db.models import Exists, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
 from django.db.models.query import QuerySet
 from django.forms import inlineformset_factory, formset_factory
 from django.http import HttpResponse, HttpRequest, HttpResponseRedirect
@@ -15,11 +17,11 @@ from django.shortcuts import render
 from django.views.generic import ListView
 from cMenu.models import getcParm
 from cMenu.utils import calvindate
-from mathematical_expressions_parser.eval import evaluate
 from userprofiles.models import WICSuser
-from WICS.models import org_queryset, MaterialList, ActualCounts, CountSchedule, SAP_SOHRecs, \
-                        WhsePartTypes, LastFoundAt, FoundAt
-from WICS.procs_SAP import fnSAPList
+from WICS.models import org_queryset, MaterialList, ActualCounts, CountSchedule, \
+                        WhsePartTypes, LastFoundAt, LastFoundAtMany, FoundAt, SAP_SOHTotals
+from WICS.procs_SAP import fnSAPList, fnSAPSnapshotDate, fnSAPSnapshotTotals, fnSAPValidOn
+from WICS.sprsht_writer import fnExportFormat, SprshtExportResponse
 from typing import Any, Dict
 
 
@@ -214,43 +216,30 @@ def fnMaterialForm(req, recNum = -1, gotoMatl=None, gotoRec=False, newRec=False)
                     queryset=CountSchedule.objects.order_by('-CountDate'))
     # endif
 
-    # count summary subform
-    SAPTotals = SAP_SOHRecs.objects.filter(org=_userorg).values('uploaded_at','Material').annotate(SAPQty=Sum('Amount')).order_by('uploaded_at', 'Material')
-    raw_countdata = ActualCounts.objects.filter(Material=currRec).order_by('Material','-CountDate').annotate(QtyEval=Value(0, output_field=models.IntegerField()))
-    LastMaterial = None ; LastCountDate = None
+    # count summary subform - the db totals CTD_QTY_Eval (null for a bad expression, so it counts as 0)
+    countdata = ActualCounts.objects.filter(Material=currRec).values('CountDate').annotate(PIQty=Sum('CTD_QTY_Eval')).order_by('-CountDate')
     initdata = []
-    for r in raw_countdata:
-        try:
-            r.QtyEval = evaluate(r.CTD_QTY_Expr)
-        # except (ValueError, SyntaxError):
-        except:
-            r.QtyEval = 0
-        if (r.Material != LastMaterial or r.CountDate != LastCountDate):
-            LastMaterial = r.Material ; LastCountDate = r.CountDate
-            if SAPTotals.filter(Material=r.Material,uploaded_at__lte=r.CountDate).exists():
-                SAPDate = SAPTotals.filter(Material=r.Material,uploaded_at__lte=r.CountDate).latest()['uploaded_at']
-                SAPQty = SAPTotals.filter(Material=r.Material,uploaded_at__lte=r.CountDate).latest()['SAPQty']
-            else:
-                if SAPTotals.filter(Material=r.Material).exists():
-                    SAPDate = SAPTotals.filter(Material=r.Material).first()['uploaded_at']
-                    SAPQty = SAPTotals.filter(Material=r.Material).first()['SAPQty']
-                else:
-                    SAPDate = ''
-                    SAPQty = 0
-
-            initdata.append({
-                'Material': r.Material,
-                'CountDate': r.CountDate,
-                'CountQTY_Eval': 0,
-                'SAPDate': SAPDate,
-                'SAPQty': SAPQty,
-            })
-        PIQty = initdata[-1]['CountQTY_Eval'] + r.QtyEval
-        initdata[-1]['CountQTY_Eval'] = PIQty
-        initdata[-1]['Diff'] = PIQty - SAPQty
+    for r in countdata:
+        SAPDate = fnSAPSnapshotDate(_userorg, r['CountDate'])
+        if SAPDate:
+            SAPTotal = fnSAPSnapshotTotals(_userorg, SAPDate, currRec.Material).get(currRec.Material)
+            SAPQty = SAPTotal['Qty'] if SAPTotal else 0
+        else:
+            SAPDate = ''
+            SAPQty = 0
+        PIQty = r['PIQty'] or 0
+        if PIQty == int(PIQty): PIQty = int(PIQty)
         divsr = 1
         if PIQty!=0 or SAPQty!=0: divsr = max(PIQty, SAPQty)
-        initdata[-1]['Accuracy'] = f"{min(PIQty, SAPQty) / divsr * 100:.2f}%"
+        initdata.append({
+            'Material': currRec,
+            'CountDate': r['CountDate'],
+            'CountQTY_Eval': PIQty,
+            'SAPDate': SAPDate,
+            'SAPQty': SAPQty,
+            'Diff': PIQty - SAPQty,
+            'Accuracy': f"{min(PIQty, SAPQty) / divsr * 100:.2f}%",
+        })
     subFm_class = formset_factory(MaterialCountSummary,extra=0)
     summarySet = subFm_class(initial=initdata, prefix='summaryset')
 
@@ -277,6 +266,8 @@ def fnMaterialForm(req, recNum = -1, gotoMatl=None, gotoRec=False, newRec=False)
 #####################################################################
 #####################################################################
 
+MATLLIST_EXPORT_CHUNKSIZE = 500     # Materials per LastFoundAtMany query when a Material list is exported
+
 class MaterialListCommonView(LoginRequiredMixin, ListView):
     #login_url = reverse('WICSlogin')
     context_object_name = 'MatlList'
@@ -292,12 +283,12 @@ class MaterialListCommonView(LoginRequiredMixin, ListView):
         # it's more efficient to pull this all now and store it for the upcoming qs request
         SAP = fnSAPList(self._userorg)
         self.SAPDate = SAP['SAPDate']
-        rawsums = SAP['SAPTable'].values('Material','mult','Currency').annotate(TotalAmount=Sum('Amount',default=0), TotalValue=Sum('ValueUnrestricted',default=0))
-        for x in rawsums:
-            self.SAPSums[x['Material']] = {
-                'Qty': x['TotalAmount']*x['mult'],
-                'Value': x['TotalValue'],
-                'Currency': x['Currency'],
+        self.SAPSums = {}
+        for Matl, T in fnSAPSnapshotTotals(self._userorg, self.SAPDate).items():
+            self.SAPSums[Matl] = {
+                'Qty': T['Qty'],
+                'Value': T['Value'],
+                'Currency': T['Currency'],
                 }
 
         return super().setup(req, *args, **kwargs)
@@ -321,6 +312,37 @@ class MaterialListCommonView(LoginRequiredMixin, ListView):
 
         return qs
 
+    def get(self, req: HttpRequest, *args: Any, **kwargs: Any) -> HttpResponse:
+        ExportFmt = fnExportFormat(req)
+        if ExportFmt:
+            return SprshtExportResponse(ExportFmt, self.rptName.replace(' ', ''), list(self.ExportCols), self.export_rows(), self.rptName)
+        return super().get(req, *args, **kwargs)
+
+    # the export - the same Materials in the same order, but sorted by the db and read a chunk at a time
+    ExportCols = ('ID', 'Material', 'Description', 'Part Type', 'Last Count Date', 'Last Found At',
+                  'SAP Qty', 'SAP Value', 'SAP Currency', 'Notes')
+
+    def export_queryset(self) -> QuerySet[Any]:
+        return org_queryset(MaterialList,self._userorg).select_related('PartType').order_by(*self.ordering)
+
+    def SAPTotalsOf(self, fld):
+        # Subquery of the SAP total fld of the outer Material, in the report's snapshot
+        Totals = SAP_SOHTotals.objects.filter(fnSAPValidOn(self.SAPDate), org=self._userorg, Material=OuterRef('Material'))
+        return Subquery(Totals.values(fld)[:1])
+
+    def export_rows(self):
+        MatlIter = self.export_queryset().iterator(chunk_size=MATLLIST_EXPORT_CHUNKSIZE)
+        while True:
+            chunk = list(itertools.islice(MatlIter, MATLLIST_EXPORT_CHUNKSIZE))
+            if not chunk: break
+            LFA = LastFoundAtMany(chunk)
+            for rec in chunk:
+                L = LFA.get(rec.pk, {})
+                S = self.SAPSums.get(rec.Material, {})
+                yield [rec.pk, rec.Material, rec.Description, rec.PartType.WhsePartType if rec.PartType else None,
+                       L.get('lastCountDate'), L.get('lastFoundAt', ''),
+                       S.get('Qty'), S.get('Value'), S.get('Currency'), rec.Notes]
+
     def get_context_data(self, **kwargs: Any) -> Dict[str, Any]:
         cntext = super().get_context_data(**kwargs)
         cntext['SAPDate'] = self.SAPDate
@@ -362,6 +384,13 @@ class MaterialByLastCountDate(MaterialListCommonView):
         q_list.sort(key=attrgetter('HasSAPQty'),reverse=True)
         return q_list
 
+    def export_queryset(self) -> QuerySet[Any]:
+        qs = super().export_queryset().annotate(
+                LFADate=Subquery(ActualCounts.objects.filter(Material=OuterRef('pk')).order_by('-CountDate').values('CountDate')[:1]),
+                HasSAPQty=Exists(self.SAPTotalsOf('pk')) if self.SAPDate else Value(False),
+                )
+        return qs.order_by(F('HasSAPQty').desc(), F('LFADate').asc(nulls_first=True), 'Material')
+
 #####################################################################
 
 class MaterialByDESCValue(MaterialListCommonView):
@@ -381,6 +410,11 @@ class MaterialByDESCValue(MaterialListCommonView):
         q_list.sort(key=attrgetter('SAPValue'),reverse=True)
         return q_list
 
+    def export_queryset(self) -> QuerySet[Any]:
+        if not self.SAPDate: return super().export_queryset()
+        qs = super().export_queryset().annotate(SAPValue=Coalesce(self.SAPTotalsOf('Value'), Value(0.0)))
+        return qs.order_by('-SAPValue', 'Material')
+
 
 #####################################################################
 #####################################################################
@@ -1,18 +1,50 @@
-import os, uuid
+import bisect, datetime, hashlib, threading, time
 # from datetime import datetime
 # from dateutil import parser
 from django import forms
 from django.contrib.auth.decorators import login_required
-from django.db.models import Max, OuterRef, Subquery
+from django.core.paginator import Paginator
+from django.db import transaction
+from django.db.models import Count, Exists, Max, OuterRef, Q, Subquery
+from django.http import Http404, HttpResponseRedirect
 from django.shortcuts import render
-from openpyxl import load_workbook
 from cMenu.models import getcParm
-from cMenu.utils import calvindate
+from cMenu.utils import calvindate, makebool
 from userprofiles.models import WICSuser
-from WICS.models import SAP_SOHRecs, UnitsOfMeasure
-from WICS.models import WhsePartTypes, MaterialList, tmpMaterialListUpdate
+from WICS.models import SAP_SOHRecs, SAP_SOHSnapshots, SAP_SOHTotals, UnitsOfMeasure
+from WICS.models import WhsePartTypes, MaterialList, MaterialListRecon, ActualCounts, CountSchedule, UploadJobs, UploadJobRowResults
+from WICS.procs_UploadJobs import fnSubmitUploadJob
+from WICS.sprsht_reader import SprshtReader
+from WICS.sprsht_writer import fnExportFormat, SprshtExportResponse
 
 ExcelWorkbook_fileext = ".XLSX"
+SAP_INGEST_CHUNKSIZE = 2000     # SAP_SOHRecs per bulk insert
+SAP_DATECACHE_CHECK = 1         # seconds between checks that an org's cached snapshot dates are still current (see SAPSnapshotDateCache)
+SAP_TOTALS_INLIST_MAX = 500     # more Materials than this, and fnSAPSnapshotTotals reads the whole snapshot instead of an IN list
+
+SAP_SSName_TableName_map = {
+        'Material': 'Material', 
+        'Material description': 'Description', 
+        'Plant': 'Plant',
+        'Material type': 'MaterialType',
+        'Storage location': 'StorageLocation',
+        'Base Unit of Measure': 'BaseUnitofMeasure',
+        'Unrestricted': 'Amount',
+        'Currency': 'Currency',
+        'Value Unrestricted': 'ValueUnrestricted',
+        'Special Stock': 'SpecialStock',
+        'Batch': 'Batch',
+        }
+SAP_DataFields = tuple(SAP_SSName_TableName_map.values())
+SAP_NumericFields = ('Amount', 'ValueUnrestricted')
+MatlList_SSName_TableName_map = {
+        'Material': 'Material', 
+        'Material description': 'Description', 
+        'Material type': 'SAPMaterialType',
+        'Material Group': 'SAPMaterialGroup',
+        'Price': 'Price',
+        'Price unit': 'PriceUnit',
+        }
 
 
 @login_required
@@ -23,7 +55,17 @@ def fnShowSAP(req, reqDate=calvindate().today()):
     _myDtFmt = '%Y-%m-%d'
 
     SAP_tbl = fnSAPList(_userorg,for_date=reqDate)
-    SAPDatesRaw = choices=SAP_SOHRecs.objects.filter(org=_userorg).order_by('-uploaded_at').values('uploaded_at').distinct()
+
+    ExportFmt = fnExportFormat(req)
+    if ExportFmt:
+        # the snapshot with the SAP SOH report's own column names, so it can be uploaded again
+        def ExportRows():
+            for SAProw in SAP_tbl['SAPTable'].iterator(chunk_size=SAP_INGEST_CHUNKSIZE):
+                yield [getattr(SAProw, fld) for fld in SAP_DataFields]
+        SAPDate = SAP_tbl['SAPDate'].strftime(_myDtFmt) if SAP_tbl['SAPDate'] else 'none'
+        return SprshtExportResponse(ExportFmt, 'SAP-%s' % SAPDate, list(SAP_SSName_TableName_map), ExportRows(), 'SAP')
+
+    SAPDatesRaw = SAP_SOHSnapshots.objects.filter(org=_userorg).order_by('-uploaded_at').values('uploaded_at')
     SAPDates = []
     for D in SAPDatesRaw:
         SAPDates.append(D['uploaded_at'].strftime(_myDtFmt))
@@ -46,7 +88,8 @@ def fnShowSAP(req, reqDate=calvindate().today()):
 
 class UploadSAPForm(forms.Form):
     uploaded_at = forms.DateField()
-    SAPFile = forms.FileField()
+    SAPFile = forms.FileField(widget=forms.ClearableFileInput(attrs={'accept': '.xlsx,.csv,.tsv,.txt'}))
+    ValidateOnly = forms.BooleanField(required=False, label='Check the spreadsheet only - nothing is saved')
 
 @login_required
 def fnUploadSAP(req):
@@ -55,82 +98,424 @@ def fnUploadSAP(req):
     if req.method == 'POST':
         form = UploadSAPForm(req.POST, req.FILES)
         if form.is_valid():
-            # save the file so we can open it as an excel file
-            SAPFile = req.FILES['SAPFile']
-            svdir = getcParm('SAP-FILELOC')
-            fName = svdir+"tmpSAP"+str(uuid.uuid4())+".xlsx"
-            with open(fName, "wb") as destination:
-                for chunk in SAPFile.chunks():
-                    destination.write(chunk)
-
-            wb = load_workbook(filename=fName, read_only=True)
-            ws = wb.active
-
-            SAPcolmnNames = ws[1]
-            SAPcolmnMap = {'Material': None}
-            SAP_SSName_TableName_map = {
-                    'Material': 'Material', 
-                    'Material description': 'Description', 
-                    'Plant': 'Plant',
-                    'Material type': 'MaterialType',
-                    'Storage location': 'StorageLocation',
-                    'Base Unit of Measure': 'BaseUnitofMeasure',
-                    'Unrestricted': 'Amount',
-                    'Currency': 'Currency',
-                    'Value Unrestricted': 'ValueUnrestricted',
-                    'Special Stock': 'SpecialStock',
-                    'Batch': 'Batch',
-                    }
-            for col in SAPcolmnNames:
-                if col.value in SAP_SSName_TableName_map:
-                    SAPcolmnMap[SAP_SSName_TableName_map[col.value]] = col.column - 1
-            if (SAPcolmnMap['Material'] == None):   # or SAPcol['StorageLocation'] == None or SAPcol['Amount'] == None):
-                raise Exception('SAP Spreadsheet has bad header row.  See Calvin to fix this.')
-
-            # if SAP SOH records exist for this date, kill them; only one set of SAP SOH records per day
+            # if SAP SOH records exist for this date, they will be replaced; only one set of SAP SOH records per day
             # (this was signed off on by user before coming here)
-            UplDate = calvindate(req.POST['uploaded_at']).as_datetime()
-            SAP_SOHRecs.objects.filter(org=_userorg, uploaded_at=UplDate).delete()
-
-            nRows = 0
-            for row in ws.iter_rows(min_row=2, values_only=True):
-                if row[SAPcolmnMap['Material']]==None: MatNum = ''
-                else: MatNum = row[SAPcolmnMap['Material']]
-                if len(str(MatNum)):
-                    SRec = SAP_SOHRecs(
-                                org = _userorg,
-                                uploaded_at = UplDate
-                                )
-                    for fldName, colNum in SAPcolmnMap.items():
-                        if row[colNum]==None: setval = ''
-                        else: setval = row[colNum]
-                        setattr(SRec, fldName, setval)
-                    SRec.save()
-                    nRows += 1
-
-            # close and kill temp files
-            wb.close()
-            os.remove(fName)
-
-            cntext = {'uploaded_at':UplDate, 'nRows':nRows,
-                    'orgname':_userorg.orgname, 'uname':req.user.get_full_name()
-                    }
-            templt = 'frm_upload_SAP_Success.html'
+            return fnSubmitUploadJob(req, 'SAP', req.FILES['SAPFile'], 
+                        {'uploaded_at': req.POST['uploaded_at'], 'ValidateOnly': form.cleaned_data['ValidateOnly']})
+        # else fall through and show the form again, with its errors
     else:
-        LastSAPUpload = SAP_SOHRecs.objects.filter(org=_userorg).aggregate(LastSAPDate=Max('uploaded_at'))
-        # .first().values('LastSAPDate')['LastSAPDate']
-
         form = UploadSAPForm()
-        cntext = {'form': form, 
-                'LastSAPUploadDate': LastSAPUpload['LastSAPDate'],
-                'orgname':_userorg.orgname, 'uname':req.user.get_full_name()
-                }
-        templt = 'frm_upload_SAP.html'
     #endif
 
+    LastSAPUpload = SAP_SOHSnapshots.objects.filter(org=_userorg).order_by('-uploaded_at').first()
+
+    cntext = {'form': form, 
+            'LastSAPUploadDate': LastSAPUpload.uploaded_at if LastSAPUpload else None,
+            'LastSAPUpload': LastSAPUpload,
+            'orgname':_userorg.orgname, 'uname':req.user.get_full_name()
+            }
+    templt = 'frm_upload_SAP.html'
+
     return render(req, templt, cntext)
 
 
+def procUploadSAP(org, upldfile, Params, progress=None):
+    """
+    UploadJobs proc for the SAP SOH spreadsheet.  Params: {'uploaded_at', 'ValidateOnly'}
+    With ValidateOnly the sheet is only checked (see fnSAPValidate)
+    """
+    UplDate = calvindate(Params['uploaded_at']).as_datetime()
+    FileHash = fnUploadFileHash(upldfile)
+    SameFileSnap = SAP_SOHSnapshots.objects.filter(org=org, SourceFileHash=FileHash).exclude(uploaded_at=UplDate.date()).order_by('-uploaded_at').first()
+    if Params.get('ValidateOnly'):
+        Results = fnSAPValidate(org, UplDate, upldfile, Params['jobID'], progress=progress)
+        Results['SameFileAs'] = SameFileSnap.uploaded_at.strftime('%Y-%m-%d') if SameFileSnap else None
+        return Results
+    with SprshtReader(upldfile, SAP_SSName_TableName_map, requiredFields=('Material',), 
+                numericFields=SAP_NumericFields) as SAPRdr:
+        IngestStats = fnSAPIngest(org, UplDate, SAPRdr, progress=progress, SourceFileHash=FileHash)
+
+    return {'uploaded_at':UplDate.strftime('%Y-%m-%d'), 'nRows':IngestStats['nRows'],
+            'nStored':IngestStats['nStored'], 'DeltaStorage':IngestStats['DeltaStorage'],
+            'elapsed':IngestStats['elapsed'], 'rowsPerSec':IngestStats['rowsPerSec'],
+            'SameFileAs':SameFileSnap.uploaded_at.strftime('%Y-%m-%d') if SameFileSnap else None,
+            }
+
+
+def fnSAPValidate(org, UplDate, upldfile, jobID, chunksize=SAP_INGEST_CHUNKSIZE, progress=None):
+    """
+    check a SAP SOH spreadsheet without loading it: the header, whether a snapshot can be loaded for UplDate,
+    and the numeric fields (which must be there, and not blank - fnSAPIngest can't store those) are errors; Materials that are not in MaterialList and rows that repeat an earlier row
+    are noted (they load fine).  The problems go to UploadJobRowResults for jobID, chunksize at a time
+    returns {'ValidateOnly', 'uploaded_at', 'nRows', 'nErrors', 'nNotInMatlList', 'ReplacesSnapshot'}
+    """
+    if isinstance(UplDate, datetime.datetime): UplDate = UplDate.date()
+    Results = {'ValidateOnly': True, 'uploaded_at': UplDate.strftime('%Y-%m-%d'), 
+            'nRows': 0, 'nErrors': 0, 'nNotInMatlList': 0, 
+            'ReplacesSnapshot': SAP_SOHSnapshots.objects.filter(org=org, uploaded_at=UplDate).exists(),
+            }
+    Problems = []
+
+    def problem(rowNum, msg, isError=True):
+        Problems.append(UploadJobRowResults(job_id=jobID, rowNum=rowNum, isError=isError, Result={'error': msg, 'rowNum': rowNum}))
+        if isError: Results['nErrors'] += 1
+
+    NextSnap = SAP_SOHSnapshots.objects.filter(org=org, uploaded_at__gt=UplDate).order_by('uploaded_at').first()
+    if NextSnap and NextSnap.DeltaStorage:
+        problem(1, f'The SAP snapshot for {NextSnap.uploaded_at} was stored as changes only, '
+                    f'so a snapshot for the earlier date {UplDate} cannot be loaded')
+    try:
+        SAPRdr = SprshtReader(upldfile, SAP_SSName_TableName_map, requiredFields=('Material',), numericFields=SAP_NumericFields)
+    except Exception as err:
+        problem(1, str(err))
+        UploadJobRowResults.objects.bulk_create(Problems)
+        return Results
+
+    for fldName in SAP_NumericFields:
+        if fldName not in SAPRdr.fields: problem(1, f'the sheet has no column for {fldName}')
+    NumericFields = [fldName for fldName in SAP_NumericFields if fldName in SAPRdr.fields]
+
+    # MaterialList may compare Material case-insensitively; so does this check
+    MatlSet = {M.strip().casefold() for M in MaterialList.objects.filter(org=org).values_list('Material', flat=True)}
+    SheetRows = {}      # hash of the row's values -> rowNum of its first appearance; an int, not the row, per row
+    with SAPRdr:
+        for rowNum, row in SAPRdr:
+            if row.Material is None or not len(str(row.Material)): continue
+            Results['nRows'] += 1
+            for fldName in NumericFields:
+                V = getattr(row, fldName)
+                if V is None or (isinstance(V, str) and not V.strip()):
+                    problem(rowNum, f'{fldName} is blank')
+                elif isinstance(V, str):
+                    problem(rowNum, f'{V} is invalid for {fldName}')
+            if str(row.Material).strip().casefold() not in MatlSet:
+                Results['nNotInMatlList'] += 1
+                problem(rowNum, f'{row.Material} does not exist in MaterialList', isError=False)   # loads fine; just so they know
+            RowHash = hash(row)
+            if RowHash in SheetRows:
+                problem(rowNum, f'same as sheet row {SheetRows[RowHash]}', isError=False)
+            else:
+                SheetRows[RowHash] = rowNum
+            if len(Problems) >= chunksize:
+                UploadJobRowResults.objects.bulk_create(Problems)
+                Problems.clear()
+            if progress and rowNum % chunksize == 0: progress(rowNum-1, Results['nErrors'], SAPRdr.rowsTotal)
+    UploadJobRowResults.objects.bulk_create(Problems)
+    if progress: progress(Results['nRows'], Results['nErrors'], force=True)
+
+    return Results
+
+
+def fnUploadFileHash(upldfile):
+    # sha256 of the uploaded file, for SAP_SOHSnapshots.SourceFileHash
+    H = hashlib.sha256()
+    upldfile.seek(0)
+    for chunk in iter(lambda: upldfile.read(1024*1024), b''):
+        H.update(chunk)
+    upldfile.seek(0)
+    return H.hexdigest()
+
+
+def fnSAPIngest(org, UplDate, SAPRdr, chunksize=SAP_INGEST_CHUNKSIZE, progress=None, DeltaStorage=None, SourceFileHash=''):
+    """
+    load one SAP SOH snapshot (org, UplDate) from SAPRdr (a SprshtReader over SAP_SSName_TableName_map)
+    records are built chunksize at a time and written with one bulk insert per chunk.  The
+    whole load, including removal of any existing snapshot for UplDate, is one transaction,
+    so a failure part-way through leaves the previous snapshot intact
+
+    a SAP_SOHRecs record is kept once for the whole run of snapshots it is part of (uploaded_at up to retired_at).
+    In full storage every record is written and all of the previous snapshot's records are retired.
+    With DeltaStorage (default: cParm SAP-DELTA-STORAGE) only new or changed records are written, and only
+    the previous records that changed or disappeared are retired, so an unchanged day costs nothing.
+    Any date can be (re)loaded as long as the next later snapshot, if there is one, was stored in full;
+    delta snapshots have to be loaded in date order (re-loading the latest one is fine)
+    the snapshot is recorded in SAP_SOHSnapshots, with its row count, load time and SourceFileHash,
+    and its per-Material totals are written to SAP_SOHTotals (see fnSAPTotalsStore)
+
+    progress, if given, is called after each chunk (see procs_UploadJobs.UploadJobProgress)
+    returns {'nRows', 'nStored', 'nRetired', 'DeltaStorage', 'elapsed' (seconds), 'rowsPerSec'}
+    """
+    if DeltaStorage is None: DeltaStorage = makebool(getcParm('SAP-DELTA-STORAGE'))
+    DeltaStorage = bool(DeltaStorage)      # makebool hands back a truthy string as is
+    if isinstance(UplDate, datetime.datetime): UplDate = UplDate.date()
+
+    tStart = time.perf_counter()
+    nRows = 0
+    nStored = 0
+    nRetired = 0
+    with transaction.atomic():
+        Snapshots = SAP_SOHSnapshots.objects.select_for_update().filter(org=org)
+        NextSnap = Snapshots.filter(uploaded_at__gt=UplDate).order_by('uploaded_at').first()
+        if NextSnap and NextSnap.DeltaStorage:
+            raise Exception(f'The SAP snapshot for {NextSnap.uploaded_at} was stored as changes only, '
+                            f'so a snapshot for the earlier date {UplDate} cannot be loaded')
+        NextDate = NextSnap.uploaded_at if NextSnap else None
+        PrevSnap = Snapshots.filter(uploaded_at__lt=UplDate).order_by('-uploaded_at').first()
+
+        # take out any existing snapshot for UplDate; whatever it retired carries on to NextDate
+        SAP_SOHRecs.objects.filter(org=org, uploaded_at=UplDate).delete()
+        SAP_SOHRecs.objects.filter(org=org, retired_at=UplDate).update(retired_at=NextDate)
+        SAP_SOHTotals.objects.filter(org=org, uploaded_at=UplDate).delete()
+        SAP_SOHTotals.objects.filter(org=org, retired_at=UplDate).update(retired_at=NextDate)
+        Snapshots.filter(uploaded_at=UplDate).delete()
+
+        # the records this snapshot replaces
+        if PrevSnap: PrevRecs = fnSAPSnapshotRecs(org, PrevSnap.uploaded_at)
+        else: PrevRecs = SAP_SOHRecs.objects.none()
+        PrevKeys = {}
+        if DeltaStorage:
+            for R in PrevRecs.values_list('pk', *SAP_DataFields):
+                PrevKeys.setdefault(R[1:], []).append(R[0])
+        else:
+            nRetired = PrevRecs.update(retired_at=UplDate)
+
+        UOMMult = fnUOMMultipliers()
+        Totals = {}
+        chunk = []
+        for rowNum, row in SAPRdr:
+            if row.Material==None: MatNum = ''
+            else: MatNum = row.Material
+            if len(str(MatNum)):
+                nRows += 1
+                SRec = SAP_SOHRecs(
+                            org = org,
+                            uploaded_at = UplDate,
+                            retired_at = NextDate,
+                            )
+                for fldName, V in zip(row._fields, row):
+                    # set values as they will come back from the db, so they compare equal to PrevKeys
+                    if V==None: setval = ''
+                    elif fldName in SAP_NumericFields: setval = float(V)
+                    else: setval = str(V)
+                    setattr(SRec, fldName, setval)
+                fnSAPTotalsAdd(Totals, SRec, UOMMult)
+                if DeltaStorage:
+                    PrevPKs = PrevKeys.get(tuple(getattr(SRec, fldName) for fldName in SAP_DataFields))
+                    if PrevPKs:
+                        PrevPKs.pop()       # unchanged - the existing record carries on
+                        SRec = None
+                if SRec: chunk.append(SRec)
+                if len(chunk) >= chunksize:
+                    SAP_SOHRecs.objects.bulk_create(chunk)
+                    nStored += len(chunk)
+                    chunk = []
+                    if progress: progress(nRows, RowsTotal=SAPRdr.rowsTotal)
+        if chunk:
+            SAP_SOHRecs.objects.bulk_create(chunk)
+            nStored += len(chunk)
+
+        if DeltaStorage:
+            # whatever wasn't matched has changed or is gone
+            RetirePKs = [pk for PrevPKs in PrevKeys.values() for pk in PrevPKs]
+            for n in range(0, len(RetirePKs), chunksize):
+                nRetired += SAP_SOHRecs.objects.filter(pk__in=RetirePKs[n:n+chunksize]).update(retired_at=UplDate)
+
+        fnSAPTotalsStore(org, UplDate, Totals, PrevSnap.uploaded_at if PrevSnap else None, NextDate, DeltaStorage, chunksize)
+        SAP_SOHSnapshots(org=org, uploaded_at=UplDate, DeltaStorage=DeltaStorage, RowCount=nRows,
+                LoadSeconds=time.perf_counter() - tStart, SourceFileHash=SourceFileHash).save()
+        transaction.on_commit(lambda: SAPDateCache.invalidate(org))
+        # the count dates compared to this snapshot now, once the date cache knows it
+        # (imported here since procs_CountSummary imports this module)
+        from WICS.procs_CountSummary import fnCountSummarySAPRefresh
+        transaction.on_commit(lambda: fnCountSummarySAPRefresh(org, UplDate if PrevSnap else None, NextDate))
+        if progress: progress(nRows, RowsTotal=SAPRdr.rowsTotal, force=True)
+    # end transaction
+
+    elapsed = time.perf_counter() - tStart
+    rowsPerSec = nRows / elapsed if elapsed > 0 else 0
+    return {'nRows': nRows, 'nStored': nStored, 'nRetired': nRetired, 'DeltaStorage': DeltaStorage,
+            'elapsed': elapsed, 'rowsPerSec': rowsPerSec}
+
+
+class SAPSnapshotDateCache:
+    """
+    per-process cache of each org's SAP snapshot dates (SAP_SOHSnapshots), and of the snapshot date
+    already resolved for each requested date, so fnSAPSnapshotDate doesn't go to the db on every call.
+    An org's entry is dropped when a SAP upload for it commits in this process (see fnSAPIngest).  Uploads run
+    by other processes (other web workers, runuploadjobs) are caught by checking the org's snapshot count and
+    last LoadedAt - one small aggregate query - at most every check seconds, and reloading if they moved.
+    stats() gives the hit/miss counts
+    """
+    def __init__(self, check):
+        self.check = check
+        self._lock = threading.Lock()
+        self._orgs = {}         # org_id: {'checkedAt', 'version', 'dates' (ascending), 'resolved' {for_date: SAPDate}}
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.checks = 0
+
+    def _entry(self, org_id):
+        now = time.monotonic()
+        entry = self._orgs.get(org_id)
+        if entry is None or now - entry['checkedAt'] > self.check:
+            version = fnSAPSnapshotsVersion(org_id)
+            self.checks += 1
+            if entry is None or entry['version'] != version:
+                entry = {'version': version, 'dates': fnSAPSnapshotDates(org_id), 'resolved': {}}
+                self._orgs[org_id] = entry
+                self.loads += 1
+            entry['checkedAt'] = now
+        return entry
+
+    def resolve(self, org, for_date):
+        for_date = datetime.date(for_date.year, for_date.month, for_date.day)
+        with self._lock:
+            entry = self._entry(org.pk)
+            if for_date in entry['resolved']:
+                self.hits += 1
+                return entry['resolved'][for_date]
+            self.misses += 1
+            SAPDate = fnSAPSnapshotDateIn(entry['dates'], for_date)
+            entry['resolved'][for_date] = SAPDate
+            return SAPDate
+
+    def invalidate(self, org=None):
+        with self._lock:
+            if org is None: self._orgs.clear()
+            else: self._orgs.pop(org.pk, None)
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'loads': self.loads, 'checks': self.checks, 'orgs': len(self._orgs)}
+
+SAPDateCache = SAPSnapshotDateCache(SAP_DATECACHE_CHECK)
+
+
+def fnSAPSnapshotsVersion(org_id):
+    # changes whenever a snapshot of org's is added, replaced (LoadedAt is auto_now) or deleted
+    Agg = SAP_SOHSnapshots.objects.filter(org_id=org_id).aggregate(n=Count('id'), last=Max('LoadedAt'))
+    return (Agg['n'], Agg['last'])
+
+
+def fnSAPSnapshotDates(org_id):
+    # org's SAP snapshot dates, ascending, straight from the db
+    return list(SAP_SOHSnapshots.objects.filter(org_id=org_id).order_by('uploaded_at').values_list('uploaded_at', flat=True))
+
+
+def fnSAPSnapshotDateIn(dates, for_date):
+    # fnSAPSnapshotDate, from the list of snapshot dates (ascending)
+    for_date = datetime.date(for_date.year, for_date.month, for_date.day)
+    n = bisect.bisect_right(dates, for_date)
+    if n: return dates[n-1]
+    if dates: return dates[0]
+    return None
+
+
+def fnSAPSnapshotDate(org, for_date, cached=True):
+    """
+    the date of the last SAP snapshot on or before for_date (or of the first one, if they are all later)
+    None if there are no SAP snapshots at all
+    cached=False goes to the db - for anything written down (CountDailySummary), since the cache
+    can be up to SAP_DATECACHE_CHECK behind an upload made by another process
+    """
+    if not cached: return fnSAPSnapshotDateIn(fnSAPSnapshotDates(org.pk), calvindate(for_date))
+    return SAPDateCache.resolve(org, calvindate(for_date))
+
+
+def fnSAPValidOn(SAPDate):
+    # Q selecting the SAP_SOHRecs (or SAP_SOHTotals) that are part of the snapshot for SAPDate
+    return Q(uploaded_at__lte=SAPDate) & (Q(retired_at__isnull=True) | Q(retired_at__gt=SAPDate))
+
+
+def fnSAPSnapshotRecs(org, SAPDate):
+    """
+    the SAP_SOHRecs making up the snapshot for SAPDate, which must be a snapshot date (see fnSAPSnapshotDate)
+    """
+    return SAP_SOHRecs.objects.filter(fnSAPValidOn(SAPDate), org=org)
+
+
+def fnSAPSnapshotTotals(org, SAPDate, matl=None):
+    """
+    the per-Material totals (SAP_SOHTotals) of the snapshot for SAPDate, as
+    {Material: {'Qty', 'Value', 'Currency', 'StorageLocations'}}.  Qty is already UOM-normalized
+    matl is a Material string or an iterable of them, or None for all.  Either way it is one query
+    """
+    if SAPDate is None: return {}
+    qs = SAP_SOHTotals.objects.filter(fnSAPValidOn(SAPDate), org=org)
+    wanted = None
+    if matl:
+        if isinstance(matl,str): qs = qs.filter(Material=matl)
+        else:
+            wanted = set(matl)
+            # a long IN list is slower than the snapshot (and can pass the db's parameter limit), so pick them out here
+            if len(wanted) <= SAP_TOTALS_INLIST_MAX: qs = qs.filter(Material__in=wanted)
+    return {T['Material']: T for T in qs.values('Material', 'Qty', 'Value', 'Currency', 'StorageLocations')
+                if wanted is None or T['Material'] in wanted}
+
+
+def fnUOMMultipliers():
+    return {U['UOM']: U['Multiplier1'] for U in UnitsOfMeasure.objects.values('UOM', 'Multiplier1')}
+
+
+def fnSAPTotalsAdd(Totals, SRec, UOMMult):
+    """
+    add SAP record SRec into Totals {Material: [Qty, Value, Currency, StorageLocations]}
+    a BaseUnitofMeasure missing from UnitsOfMeasure counts as a multiplier of 1
+    """
+    T = Totals.get(SRec.Material)
+    if T is None: T = Totals[SRec.Material] = [0.0, 0.0, '', []]
+    Amount = SRec.Amount or 0.0
+    T[0] += Amount * UOMMult.get(SRec.BaseUnitofMeasure, 1.0)
+    T[1] += SRec.ValueUnrestricted or 0.0
+    if SRec.Currency: T[2] = SRec.Currency
+    T[3].append([SRec.StorageLocation, Amount, SRec.BaseUnitofMeasure])
+
+
+def fnSAPTotalsStore(org, UplDate, Totals, PrevDate, NextDate, DeltaStorage, chunksize=SAP_INGEST_CHUNKSIZE):
+    """
+    write the Totals (built by fnSAPTotalsAdd) of the snapshot for UplDate to SAP_SOHTotals, retiring
+    the totals of the snapshot for PrevDate that it replaces - all of them, or with DeltaStorage only
+    the ones that changed or are gone.  Must be called in the caller's transaction
+    """
+    PrevTotals = SAP_SOHTotals.objects.filter(fnSAPValidOn(PrevDate), org=org) if PrevDate else SAP_SOHTotals.objects.none()
+    PrevKeys = {}
+    if DeltaStorage:
+        for pk, Matl, Qty, Value, Currency, StorageLocations in PrevTotals.values_list(
+                    'pk', 'Material', 'Qty', 'Value', 'Currency', 'StorageLocations'):
+            PrevKeys[Matl] = (pk, [Qty, Value, Currency, StorageLocations])
+    else:
+        PrevTotals.update(retired_at=UplDate)
+
+    chunk = []
+    RetirePKs = []
+    for Matl, T in Totals.items():
+        if DeltaStorage:
+            Prev = PrevKeys.pop(Matl, None)
+            if Prev and Prev[1] == T: continue      # unchanged - the existing totals carry on
+            if Prev: RetirePKs.append(Prev[0])
+        chunk.append(SAP_SOHTotals(org=org, uploaded_at=UplDate, retired_at=NextDate, Material=Matl,
+                    Qty=T[0], Value=T[1], Currency=T[2], StorageLocations=T[3]))
+    SAP_SOHTotals.objects.bulk_create(chunk, batch_size=chunksize)
+    if DeltaStorage:
+        RetirePKs += [Prev[0] for Prev in PrevKeys.values()]
+        for n in range(0, len(RetirePKs), chunksize):
+            SAP_SOHTotals.objects.filter(pk__in=RetirePKs[n:n+chunksize]).update(retired_at=UplDate)
+
+
+def fnSAPTotalsRebuild(org):
+    """
+    rebuild all of org's SAP_SOHTotals from SAP_SOHRecs - needed if UnitsOfMeasure multipliers change
+    returns the number of snapshots rebuilt
+    """
+    UOMMult = fnUOMMultipliers()
+    nSnaps = 0
+    with transaction.atomic():
+        SAP_SOHTotals.objects.filter(org=org).delete()
+        PrevDate = None
+        for Snap in SAP_SOHSnapshots.objects.filter(org=org).order_by('uploaded_at'):
+            Totals = {}
+            for SRec in fnSAPSnapshotRecs(org, Snap.uploaded_at).order_by('pk').iterator():
+                fnSAPTotalsAdd(Totals, SRec, UOMMult)
+            # loaded in date order, so each snapshot is the latest when it is stored
+            fnSAPTotalsStore(org, Snap.uploaded_at, Totals, PrevDate, None, Snap.DeltaStorage)
+            PrevDate = Snap.uploaded_at
+            nSnaps += 1
+        from WICS.procs_CountSummary import fnCountSummarySAPRefresh
+        fnCountSummarySAPRefresh(org)
+    return nSnaps
+
+
 # read the last SAP list before for_date into a list of SAP_SOHRecs
 def fnSAPList(org, for_date = calvindate().today(), matl = None):
     """
@@ -150,20 +535,19 @@ def fnSAPList(org, for_date = calvindate().today(), matl = None):
     # else:
     #     dateObj = for_date
 
-    if SAP_SOHRecs.objects.filter(org=_userorg, uploaded_at__lte=dateObj).exists():
-        SAPDate = SAP_SOHRecs.objects.filter(org=_userorg, uploaded_at__lte=dateObj).latest().uploaded_at
-    else:
-        SAPDate = SAP_SOHRecs.objects.filter(org=_userorg).order_by('uploaded_at').first().uploaded_at
+    SAPDate = fnSAPSnapshotDate(_userorg, dateObj)
 
     SList = {'reqDate': for_date, 'SAPDate': SAPDate, 'SAPTable':[]}
 
-    if not matl:
-        STable = SAP_SOHRecs.objects.filter(org=_userorg, uploaded_at=SAPDate).order_by('Material')
+    if SAPDate is None:
+        STable = SAP_SOHRecs.objects.none()
+    elif not matl:
+        STable = fnSAPSnapshotRecs(_userorg, SAPDate).order_by('Material')
     else:
         if isinstance(matl,str):
-            STable = SAP_SOHRecs.objects.filter(org=_userorg, uploaded_at=SAPDate, Material=matl).order_by('Material')
+            STable = fnSAPSnapshotRecs(_userorg, SAPDate).filter(Material=matl).order_by('Material')
         else:   # it better be an iterable!
-            STable = SAP_SOHRecs.objects.filter(org=_userorg, uploaded_at=SAPDate, Material__in=matl).order_by('Material')
+            STable = fnSAPSnapshotRecs(_userorg, SAPDate).filter(Material__in=matl).order_by('Material')
     # UOM = UnitsOfMeasure.objects.filter(UOM=OuterRef('BaseUnitofMeasure'))
     STable = STable.annotate(mult=Subquery(UnitsOfMeasure.objects.filter(UOM=OuterRef('BaseUnitofMeasure')).values('Multiplier1')))
     # STb = STable.annotate(mult=Subquery(UnitsOfMeasure.objects.filter(UOM=OuterRef('BaseUnitofMeasure'))))    # nope - can only get a single field
@@ -187,79 +571,62 @@ def fnSAPList(org, for_date = calvindate().today(), matl = None):
     Price = Price
     PriceUnit = Price unit
 """
+MatlList_ReconFields = ('Description', 'SAPMaterialType', 'SAPMaterialGroup', 'Price', 'PriceUnit')
+MatlList_ReconActions = ('NEW', 'CHANGED', 'REMOVED')
+MATLRECON_PAGESIZE = 100
+
 @login_required
-def fnUpdateMatlListfromSAP(req):
+def fnUpdateMatlListfromSAP(req, jobID=None):
+    """
+    phase0: ask for the SAP MM60 spreadsheet
+    02-Upl-Sprsht: run procUpdateMatlListfromSAP as an upload job; when it is done the user lands back here with its jobID
+    review (GET with jobID): page through the differences found, by Action
+    03-Select: record which differences on the page (or in a whole Action) are approved,
+        and with ApplyChanges, apply the approved differences to MaterialList
+    """
     _userorg = WICSuser.objects.get(user=req.user).org
 
+    if jobID is not None:
+        job = UploadJobs.objects.filter(org=_userorg, pk=jobID, JobType='MatlList').defer('FileData').first()
+        if not job: raise Http404('No such Material List upload')
+    Action = req.GET.get('Action', '')
+    if Action not in MatlList_ReconActions: Action = ''
+
     if req.method == 'POST':
         if req.POST['NextPhase']=='02-Upl-Sprsht':
-            SAPFile = req.FILES['SAPFile']
-            svdir = getcParm('SAP-FILELOC')
-            fName = svdir+"tmpMatlList"+str(uuid.uuid4())+".xlsx"
-            with open(fName, "wb") as destination:
-                for chunk in SAPFile.chunks():
-                    destination.write(chunk)
-
-            tmpMaterialListUpdate.objects.all().delete()
-
-            wb = load_workbook(filename=fName, read_only=True)
-            ws = wb.active
-            SAPcolmnNames = ws[1]
-            SAPcol = {'Material': None}
-            SAP_SSName_TableName_map = {
-                    'Material': 'Material', 
-                    'Material description': 'Description', 
-                    'Material type': 'SAPMaterialType',
-                    'Material Group': 'SAPMaterialGroup',
-                    'Price': 'Price',
-                    'Price unit': 'PriceUnit',
-                    }
-            for col in SAPcolmnNames:
-                if col.value in SAP_SSName_TableName_map:
-                    SAPcol[SAP_SSName_TableName_map[col.value]] = col.column - 1
-            if (SAPcol['Material'] == None):   # or SAPcol['StorageLocation'] == None or SAPcol['Amount'] == None):
-                raise Exception('SAP Spreadsheet has bad header row.  See Calvin to fix this.')
-
-            for row in ws.iter_rows(min_row=2, values_only=True):
-                tmpMaterialListUpdate(
-                                Material = row[SAPcol['Material']], 
-                                Description = row[SAPcol['Description']], 
-                                SAPMaterialType = row[SAPcol['SAPMaterialType']],
-                                SAPMaterialGroup = row[SAPcol['SAPMaterialGroup']],
-                                Price = row[SAPcol['Price']],
-                                PriceUnit = row[SAPcol['PriceUnit']]
-                                ).save()
-            # endfor
-
-            
-            # later, save (FileMatList - MaterialList) and (MaterialList - FileMatList)
-            # ask permission to correct each to the other
-            # that will involve a temp table 
-            # almost there now that I've created tmpMaterialListUpdate
-
-            # for now ...
-            AddedMatls = tmpMaterialListUpdate.objects.exclude(Material__in=MaterialList.objects.filter(org=_userorg).values('Material'))
-            # one day django will implement insert ... select.  Until then ...
-            for newRec in AddedMatls:
-                MaterialList (
-                        org = _userorg,
-                        Material = newRec.Material,
-                        Description = newRec.Description,
-                        PartType = WhsePartTypes.objects.get(WhsePartType='UNKNOWN'),
-                        SAPMaterialType = newRec.SAPMaterialType,
-                        SAPMaterialGroup = newRec.SAPMaterialGroup,
-                        Price = newRec.Price,
-                        PriceUnit = newRec.PriceUnit
-                        ).save()
-
-            # delete the temporary table and the temporary file
-            tmpMaterialListUpdate.objects.all().delete()
-            wb.close()
-            os.remove(fName)
-
+            return fnSubmitUploadJob(req, 'MatlList', req.FILES['SAPFile'], {})
         # endif req.POST['NextPhase']=='02-Upl-Sprsht'
-        cntext = {'AddedMatls':AddedMatls}
+        # NextPhase=='03-Select'
+        if jobID is None: raise Http404('No Material List upload to select from')
+        ReconRecs = MaterialListRecon.objects.filter(job=job)
+        if 'SelectAll' in req.POST or 'SelectNone' in req.POST:
+            if req.POST.get('SelectAction') in MatlList_ReconActions: ReconRecs = ReconRecs.filter(Action=req.POST['SelectAction'])
+            ReconRecs.update(Approved=('SelectAll' in req.POST))
+        else:
+            PageIDs = req.POST.getlist('PageIDs')
+            Selected = req.POST.getlist('Selected')
+            ReconRecs.filter(pk__in=PageIDs).update(Approved=False)
+            ReconRecs.filter(pk__in=Selected).update(Approved=True)
+        if 'ApplyChanges' not in req.POST:
+            return HttpResponseRedirect(req.get_full_path())
+        # Apply: the checks on this page are saved, now apply everything approved
+        cntext = fnMatlListReconApply(_userorg, job)
         templt = 'frmUpdateMatlListfromSAP_done.html'
+    elif jobID is not None:
+        ReconRecs = MaterialListRecon.objects.filter(job=job)
+        Counts = {A: {'n': 0, 'nApproved': 0} for A in MatlList_ReconActions}
+        for C in ReconRecs.values('Action', 'Approved').annotate(n=Count('pk')):
+            Counts[C['Action']]['n'] += C['n']
+            if C['Approved']: Counts[C['Action']]['nApproved'] += C['n']
+        if Action: ReconRecs = ReconRecs.filter(Action=Action)
+        ReconPage = Paginator(ReconRecs.order_by('Material', 'Action'), MATLRECON_PAGESIZE).get_page(req.GET.get('page'))
+        cntext = {
+            'job': job,
+            'Action': Action,
+            'Counts': Counts,
+            'ReconPage': ReconPage,
+            }
+        templt = 'frmUpdateMatlListfromSAP_review.html'
     else:
         # (hopefully,) this is the initial phase; all others will be part of a POST request
         cntext = {}
@@ -270,3 +637,139 @@ def fnUpdateMatlListfromSAP(req):
     cntext['uname'] = req.user.get_full_name()
     return render(req, templt, cntext)
 
+
+def fnMatlListNumber(V):
+    if V is None or V == '': return None
+    try:
+        return float(V)
+    except (TypeError, ValueError):
+        return None
+
+
+def fnMatlListKey(Material):
+    # Materials are matched the way the MaterialList unique constraint sees them on a case-insensitive
+    # db collation - so ' abc-01 ' in the sheet is the abc-01 (or ABC-01) already in MaterialList
+    return Material.strip().casefold()
+
+
+def procUpdateMatlListfromSAP(org, upldfile, Params, progress=None):
+    """
+    UploadJobs proc for the SAP Material List (MM60) spreadsheet
+    the sheet is compared to MaterialList (fnMatlListReconcile) and the differences are saved in
+    MaterialListRecon for review.  Nothing is changed in MaterialList until they are applied (fnMatlListReconApply)
+    Only the MatlList_ReconFields that are columns of the sheet are compared; a missing column changes nothing
+    """
+    # if a Material is in the sheet more than once, the last row wins
+    FileMatls = {}
+    nRows = 0
+    with SprshtReader(upldfile, MatlList_SSName_TableName_map, requiredFields=('Material',), 
+                numericFields=('Price', 'PriceUnit')) as SAPRdr:
+        SheetFields = [fldName for fldName in MatlList_ReconFields if fldName in SAPRdr.fields]
+        for rowNum, row in SAPRdr:
+            nRows += 1
+            if row.Material is None or not str(row.Material).strip(): continue
+            FileRec = {fldName: '' for fldName in MatlList_ReconFields}
+            FileRec.update(row._asdict())
+            FileRec['Material'] = str(FileRec['Material']).strip()
+            for fldName in ('Description', 'SAPMaterialType', 'SAPMaterialGroup'):
+                FileRec[fldName] = '' if FileRec[fldName] is None else str(FileRec[fldName])
+            FileRec['Price'] = fnMatlListNumber(FileRec['Price'])
+            FileRec['PriceUnit'] = fnMatlListNumber(FileRec['PriceUnit'])
+            if FileRec['PriceUnit'] is not None: FileRec['PriceUnit'] = int(FileRec['PriceUnit'])
+            FileMatls[fnMatlListKey(FileRec['Material'])] = FileRec
+            if progress and nRows % SAP_INGEST_CHUNKSIZE == 0: progress(nRows, RowsTotal=SAPRdr.rowsTotal)
+        # endfor
+
+    # both sides sorted here, not by the db, so the merge doesn't depend on the db's collation
+    MatlKey = lambda R: fnMatlListKey(R['Material'])
+    FileRecs = sorted(FileMatls.values(), key=MatlKey)
+    WICSRecs = sorted(MaterialList.objects.filter(org=org).values('id', 'Material', *MatlList_ReconFields), key=MatlKey)
+
+    # earlier uploads not yet applied are stale now
+    MaterialListRecon.objects.filter(job__org=org).exclude(job_id=Params['jobID']).delete()
+    ReconRecs = []
+    Counts = {A: 0 for A in MatlList_ReconActions}
+    for Action, Material, FileRec, WICSRec, Changes in fnMatlListReconcile(FileRecs, WICSRecs, SheetFields):
+        Counts[Action] += 1
+        R = MaterialListRecon(job_id=Params['jobID'], Action=Action, Material=Material, Changes=Changes,
+                    MaterialRec_id=WICSRec['id'] if WICSRec else None,
+                    Approved=(Action != 'REMOVED'))         # removing a Material must be asked for
+        if FileRec:
+            for fldName in MatlList_ReconFields: setattr(R, fldName, FileRec[fldName])
+        ReconRecs.append(R)
+    MaterialListRecon.objects.bulk_create(ReconRecs, batch_size=SAP_INGEST_CHUNKSIZE)
+    if progress: progress(nRows, force=True)
+
+    return {'nRows': nRows, 'Counts': Counts}
+
+
+def fnMatlListReconcile(FileRecs, WICSRecs, fields=MatlList_ReconFields):
+    """
+    one sorted-merge pass over FileRecs (from the sheet) and WICSRecs (MaterialList .values()), both
+    dicts sorted by fnMatlListKey(Material).  Yields (Action, Material, FileRec, WICSRec, Changes) for each difference:
+    NEW (only in the sheet), REMOVED (only in MaterialList) or CHANGED, where Changes is
+    {field: [MaterialList value, sheet value]} for the fields that differ
+    """
+    FileIter = iter(FileRecs)
+    WICSIter = iter(WICSRecs)
+    F = next(FileIter, None)
+    W = next(WICSIter, None)
+    while F is not None or W is not None:
+        FKey = fnMatlListKey(F['Material']) if F is not None else None
+        WKey = fnMatlListKey(W['Material']) if W is not None else None
+        if W is None or (F is not None and FKey < WKey):
+            yield 'NEW', F['Material'], F, None, {}
+            F = next(FileIter, None)
+        elif F is None or WKey < FKey:
+            yield 'REMOVED', W['Material'], None, W, {}
+            W = next(WICSIter, None)
+        else:
+            Changes = {fldName: [W[fldName], F[fldName]] for fldName in fields if W[fldName] != F[fldName]}
+            if Changes: yield 'CHANGED', F['Material'], F, W, Changes
+            F = next(FileIter, None)
+            W = next(WICSIter, None)
+
+
+def fnMatlListReconApply(org, job):
+    """
+    apply the Approved MaterialListRecon rows of job, in bulk: NEW Materials are added with PartType UNKNOWN,
+    CHANGED ones get the uploaded values, and REMOVED ones are deleted - unless they have counts or
+    schedules, which are kept and listed in NotRemovedMatls.  The job's MaterialListRecon rows are then cleared
+    returns the context for frmUpdateMatlListfromSAP_done.html
+    """
+    Approved = MaterialListRecon.objects.filter(job=job, Approved=True)
+    with transaction.atomic():
+        AddedMatls = list(Approved.filter(Action='NEW').values('Material', *MatlList_ReconFields))
+        if AddedMatls:
+            UnknownPartType = WhsePartTypes.objects.get(org=org, WhsePartType='UNKNOWN')
+            MaterialList.objects.bulk_create([
+                MaterialList (org = org, PartType = UnknownPartType, **newRec)
+                for newRec in AddedMatls
+                ], batch_size=SAP_INGEST_CHUNKSIZE, ignore_conflicts=True)
+
+        # only the fields that changed somewhere - a field that wasn't in the sheet is never among them,
+        # and where one record's field didn't change, its uploaded value is the one already there
+        ChangedMatls = list(Approved.filter(Action='CHANGED', MaterialRec__isnull=False).values('MaterialRec_id', 'Material', 'Changes', *MatlList_ReconFields))
+        ChangedFlds = [fldName for fldName in MatlList_ReconFields if any(fldName in chgRec['Changes'] for chgRec in ChangedMatls)]
+        if ChangedFlds:
+            MaterialList.objects.bulk_update([
+                    MaterialList(pk=chgRec['MaterialRec_id'], **{fldName: chgRec[fldName] for fldName in ChangedFlds})
+                    for chgRec in ChangedMatls
+                    ], ChangedFlds, batch_size=SAP_INGEST_CHUNKSIZE)
+
+        RemoveRecs = MaterialList.objects.filter(org=org,
+                    pk__in=Approved.filter(Action='REMOVED').values('MaterialRec_id'))
+        InUse = Exists(ActualCounts.objects.filter(Material=OuterRef('pk'))) | Exists(CountSchedule.objects.filter(Material=OuterRef('pk')))
+        NotRemovedMatls = list(RemoveRecs.filter(InUse).order_by('Material').values_list('Material', flat=True))
+        RemovedMatls = list(RemoveRecs.exclude(InUse).order_by('Material').values_list('Material', flat=True))
+        RemoveRecs.exclude(InUse).delete()
+
+        MaterialListRecon.objects.filter(job=job).delete()
+    # end transaction
+
+    return {
+        'AddedMatls': AddedMatls,
+        'ChangedMatls': ChangedMatls,
+        'RemovedMatls': RemovedMatls,
+        'NotRemovedMatls': NotRemovedMatls,
+        }
@@ -0,0 +1,242 @@
+import datetime, io, time, traceback
+from django.contrib.auth.decorators import login_required
+from django.core.paginator import Paginator
+from django.db import connections, DEFAULT_DB_ALIAS, DatabaseError, close_old_connections
+from django.http import Http404, HttpResponseRedirect, JsonResponse
+from django.shortcuts import render
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from cMenu.models import getcParm
+from cMenu.utils import makebool
+from userprofiles.models import WICSuser
+from WICS.models import UploadJobs, UploadJobRowResults
+
+
+# JobType: the function that does the work, and the template that shows its results
+# (or, with resultview, the url name of the view the user goes on to, passed the jobID).
+# With rowresults, the proc writes its per-row results to UploadJobRowResults, and the template
+# gets them a page at a time as UplResults
+# each proc is called as proc(org, upldfile, Params, progress) and returns the (JSON-friendly) template context.
+# Params always includes jobID
+UploadJobTypes = {
+    'SAP': {
+        'proc': 'WICS.procs_SAP.procUploadSAP',
+        'template': 'frm_upload_SAP_Success.html',
+        'rowresults': True,
+        },
+    'MatlList': {
+        'proc': 'WICS.procs_SAP.procUpdateMatlListfromSAP',
+        'template': 'frmUpdateMatlListfromSAP_done.html',
+        'resultview': 'UpdateMatlListfromSAP-Review',
+        },
+    'CountSprsht': {
+        'proc': 'WICS.procs_ActualCounts.procUploadActCountSprsht',
+        'template': 'frm_uploadCountEntry_Success.html',
+        'rowresults': True,
+        },
+    }
+
+PROGRESS_DB_ALIAS = 'WICS-uploadprogress'
+PROGRESS_INTERVAL = 1.0     # seconds between progress writes
+ROWRESULTS_PAGESIZE = 200
+UPLOADJOB_TIMEOUT = 60*60   # seconds a job may stay RUNNING before it is taken to have died with its worker
+UPLOADJOB_STALECHECK = 60   # seconds between each worker's looks for such jobs
+
+
+class NamedBytesIO(io.BytesIO):
+    # stands in for the uploaded file when a queued job runs - SprshtReader looks at the name to pick the format
+    def __init__(self, data, name):
+        super().__init__(data)
+        self.name = name
+
+
+def fnUploadJobQueueEnabled():
+    return makebool(getcParm('UPLOAD-JOBQUEUE'))
+
+
+def _progress_db():
+    # progress is written on its own connection so it is visible while the job's
+    # own transaction (see fnSAPIngest) is still open
+    if PROGRESS_DB_ALIAS not in connections.settings:
+        dbsettings = dict(connections.settings[DEFAULT_DB_ALIAS])
+        if dbsettings['ENGINE'].endswith('sqlite3'):
+            # sqlite locks the whole file while the job writes; don't sit out the busy timeout for a progress update
+            dbsettings['OPTIONS'] = dict(dbsettings.get('OPTIONS', {}), timeout=0.05)
+        connections.settings[PROGRESS_DB_ALIAS] = dbsettings
+    return PROGRESS_DB_ALIAS
+
+
+class UploadJobProgress:
+    """
+    handed to the job proc, which calls it as it goes: progress(RowsProcessed, nErrors, RowsTotal)
+    the counts are written to the UploadJobs row at most once every PROGRESS_INTERVAL seconds
+    (not at all with writeDB False - nobody can be polling a job that runs inside their own request)
+    """
+    def __init__(self, jobID, writeDB=True):
+        self.jobID = jobID
+        self.writeDB = writeDB
+        self.RowsProcessed = 0
+        self.nErrors = 0
+        self.RowsTotal = None
+        self._lastWrite = 0.0
+
+    def __call__(self, RowsProcessed, nErrors=0, RowsTotal=None, force=False):
+        self.RowsProcessed = RowsProcessed
+        self.nErrors = nErrors
+        if RowsTotal is not None: self.RowsTotal = RowsTotal
+        now = time.monotonic()
+        if self.writeDB and (force or now - self._lastWrite >= PROGRESS_INTERVAL):
+            self._lastWrite = now
+            try:
+                UploadJobs.objects.using(_progress_db()).filter(pk=self.jobID).update(
+                        RowsProcessed=self.RowsProcessed, nErrors=self.nErrors, RowsTotal=self.RowsTotal)
+            except DatabaseError:
+                pass    # progress is only a nicety; never let it kill the upload
+
+
+def fnRunUploadJob(job, upldfile=None):
+    """
+    run job (already marked RUNNING).  upldfile is the live upload when the job runs inside the request;
+    a queued job runs from the copy saved in job.FileData
+    """
+    JobDef = UploadJobTypes[job.JobType]
+    proc = import_string(JobDef['proc'])
+    progress = UploadJobProgress(job.pk, writeDB=(upldfile is None))
+    if upldfile is None: upldfile = NamedBytesIO(bytes(job.FileData), job.FileName)
+
+    try:
+        job.Results = proc(job.org, upldfile, dict(job.Params, jobID=job.pk), progress)
+        job.Status = 'DONE'
+    except Exception as err:
+        job.Status = 'FAILED'
+        job.ErrorText = str(err) + '\n\n' + traceback.format_exc()
+    job.RowsProcessed = progress.RowsProcessed
+    job.nErrors = progress.nErrors
+    job.RowsTotal = progress.RowsTotal
+    job.FileData = None
+    job.FinishedAt = timezone.now()
+    job.save()
+
+    return job
+
+
+def fnSubmitUploadJob(req, JobType, upldfile, Params):
+    """
+    the upload views hand their work to this instead of doing it themselves.
+    If cParm UPLOAD-JOBQUEUE is on, the upload is saved with a QUEUED job for the runuploadjobs worker
+    and the user gets the progress page right away.  Otherwise the job runs now, in this request
+    """
+    _userorg = WICSuser.objects.get(user=req.user).org
+
+    job = UploadJobs(org=_userorg, user=req.user, JobType=JobType, Params=Params, FileName=upldfile.name)
+    if fnUploadJobQueueEnabled():
+        job.FileData = b''.join(upldfile.chunks())
+        job.save()
+    else:
+        job.Status = 'RUNNING'
+        job.StartedAt = timezone.now()
+        job.save()
+        fnRunUploadJob(job, upldfile)
+
+    # redirect, so the results page (and its pager's relative links) lives at its own url, not the upload's
+    return HttpResponseRedirect(reverse('UploadJobResult', args=[job.pk]))
+
+
+def fnClaimNextUploadJob():
+    # the conditional update makes sure only one worker gets any given job
+    for jobID in UploadJobs.objects.filter(Status='QUEUED').order_by('QueuedAt').values_list('pk', flat=True)[:10]:
+        if UploadJobs.objects.filter(pk=jobID, Status='QUEUED').update(Status='RUNNING', StartedAt=timezone.now()):
+            return UploadJobs.objects.select_related('org').get(pk=jobID)
+    return None
+
+
+def fnFailStaleUploadJobs(jobID=None, timeout=UPLOADJOB_TIMEOUT):
+    """
+    mark FAILED the jobs (or just jobID) RUNNING since more than timeout seconds ago - their worker thread or
+    process died (restart, OOM, deploy), so nothing will ever finish them.  They aren't requeued: the job may be
+    what killed its worker, and one run inside a request has no FileData to run again.  Returns how many
+    """
+    now = timezone.now()
+    Stale = UploadJobs.objects.filter(Status='RUNNING', StartedAt__lt=now - datetime.timedelta(seconds=timeout))
+    if jobID is not None: Stale = Stale.filter(pk=jobID)
+    return Stale.update(Status='FAILED', FileData=None, FinishedAt=now,
+                ErrorText=f'the upload was still running after {timeout} seconds; its worker must have stopped. Please upload it again')
+
+
+def fnUploadJobWorker(stopEvent, pollSeconds=2.0, exitWhenIdle=False):
+    # body of each runuploadjobs worker thread
+    lastStaleCheck = None
+    while not stopEvent.is_set():
+        close_old_connections()
+        if lastStaleCheck is None or time.monotonic() - lastStaleCheck >= UPLOADJOB_STALECHECK:
+            fnFailStaleUploadJobs()
+            lastStaleCheck = time.monotonic()
+        job = fnClaimNextUploadJob()
+        if job:
+            fnRunUploadJob(job)
+            continue
+        if exitWhenIdle: break
+        stopEvent.wait(pollSeconds)
+    connections.close_all()
+
+
+#####################################################################
+#####################################################################
+#####################################################################
+
+def _getUploadJob(req, jobID):
+    _userorg = WICSuser.objects.get(user=req.user).org
+    job = UploadJobs.objects.filter(org=_userorg, pk=jobID).defer('FileData').first()
+    if not job: raise Http404('No such upload')
+    return _userorg, job
+
+
+@login_required
+def fnUploadJobStatus(req, jobID):
+    _userorg, job = _getUploadJob(req, jobID)
+    # whoever is polling a dead job (say, one run inside a request, with no worker around to notice) finds out here
+    if job.Status == 'RUNNING' and fnFailStaleUploadJobs(job.pk):
+        _userorg, job = _getUploadJob(req, jobID)
+
+    ETA = None
+    if job.Status == 'RUNNING' and job.StartedAt and job.RowsTotal and job.RowsProcessed:
+        elapsed = (timezone.now() - job.StartedAt).total_seconds()
+        ETA = max(job.RowsTotal - job.RowsProcessed, 0) * elapsed / job.RowsProcessed
+
+    return JsonResponse({
+        'jobID': job.pk,
+        'JobType': job.JobType,
+        'Status': job.Status,
+        'RowsProcessed': job.RowsProcessed,
+        'RowsTotal': job.RowsTotal,
+        'nErrors': job.nErrors,
+        'ETA': ETA,
+        'ErrorText': job.ErrorText.split('\n')[0] if job.ErrorText else '',
+        'resultURL': reverse('UploadJobResult', args=[job.pk]),
+        })
+
+
+@login_required
+def fnUploadJobResult(req, jobID):
+    _userorg, job = _getUploadJob(req, jobID)
+    JobDef = UploadJobTypes[job.JobType]
+
+    if job.Status == 'DONE' and 'resultview' in JobDef:
+        return HttpResponseRedirect(reverse(JobDef['resultview'], args=[job.pk]))
+    if job.Status == 'DONE':
+        cntext = dict(job.Results or {})
+        if JobDef.get('rowresults'):
+            RowResults = UploadJobRowResults.objects.filter(job=job).order_by('rowNum', 'id')
+            if req.GET.get('errorsonly'): RowResults = RowResults.filter(isError=True)
+            cntext['UplResults'] = Paginator(RowResults, ROWRESULTS_PAGESIZE).get_page(req.GET.get('page'))
+            cntext['errorsonly'] = bool(req.GET.get('errorsonly'))
+    else:
+        cntext = {'jobPending': True}
+    cntext.update({
+            'job': job,
+            'statusURL': reverse('UploadJobStatus', args=[job.pk]),
+            'orgname':_userorg.orgname, 'uname':req.user.get_full_name()
+            })
+    templt = JobDef['template']
+    return render(req, templt, cntext)
@@ -0,0 +1,98 @@
+import itertools
+
+
+# the grouped detail/summary reports (Count Summary, adhoc-2023-02-01-001): source rows come in already sorted
+# by group; each row becomes a detail line, and each group ends with a summary line of its totals.
+# fnGroupedReport makes the one pass over the rows, keeping only the lines of the current chunk of groups
+# in hand, and fetches what the summary lines look up (SAP totals...) once per chunk instead of once per group
+
+GROUPEDREPORT_CHUNKSIZE = 500   # groups per lookups() call
+GROUPEDREPORT_MAXLINES = 10000  # ... or fewer, if their detail lines waiting to go out reach this
+
+
+class ReportRow:
+    """
+    a line of a grouped report.  The subclasses made by ReportRowClass have __slots__ for their fields, so a
+    row costs about what a tuple does, and templates read the fields as attributes.  Fields not given are None
+    """
+    __slots__ = ()
+    type = None
+
+    def __init__(self, **fields):
+        for fld in self.__slots__:
+            setattr(self, fld, fields.get(fld))
+
+    def get(self, fld, default=None):
+        return getattr(self, fld, default)
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join('%s=%r' % (fld, getattr(self, fld)) for fld in self.__slots__))
+
+
+def ReportRowClass(name, rowtype, fields):
+    """
+    a ReportRow subclass called name with fields (a sequence of field names); its rows' .type is rowtype
+    """
+    return type(name, (ReportRow,), {'__slots__': tuple(fields), 'type': rowtype})
+
+
+class Aggregate:
+    """
+    a total kept per group: start is its value at the start of each group, and step(total, row) the value after row
+    """
+    __slots__ = ('name', 'start', 'step')
+
+    def __init__(self, name, step, start=0):
+        self.name, self.step, self.start = name, step, start
+
+
+def SumOf(name, value):
+    # total of value(row) over the group; a value that isn't a number ("????") is left out
+    def step(total, row):
+        V = value(row)
+        return total + V if isinstance(V, (int, float)) and not isinstance(V, bool) else total
+    return Aggregate(name, step)
+
+def CountOf(name, test=None):
+    # number of rows in the group (for which test(row) is true)
+    return Aggregate(name, lambda total, row: total + 1 if test is None or test(row) else total)
+
+
+def fnGroupedReport(rows, groupkey, detail=None, summary=None, aggregates=(), lookups=None,
+                    chunksize=GROUPEDREPORT_CHUNKSIZE, maxlines=GROUPEDREPORT_MAXLINES):
+    """
+    the lines of a grouped report, as a generator, in one pass over rows, which must be in group order
+
+    groupkey(row) is the group of row.  detail(row) gives the detail line of row (None: no line), and after
+    the last row of each group, summary(key, firstrow, totals, looked) gives its summary line; totals is
+    {Aggregate.name: total} for the aggregates.  lookups(keys), if given, is called with the keys of each chunk
+    of groups (chunksize groups, or fewer if their detail lines reach maxlines) and returns {key: whatever};
+    looked is the group's entry (None if it has none, or there are no lookups)
+    """
+    chunk = []      # (key, firstrow, totals, detail lines) of the groups waiting for their lookups
+    nLines = 0
+
+    def Flush():
+        if not chunk: return
+        looked = lookups([key for key, firstrow, totals, lines in chunk]) if lookups else {}
+        for key, firstrow, totals, lines in chunk:
+            yield from lines
+            if summary: yield summary(key, firstrow, totals, looked.get(key))
+
+    for key, grouprows in itertools.groupby(rows, key=groupkey):
+        firstrow = None
+        totals = [Agg.start for Agg in aggregates]
+        lines = []
+        for row in grouprows:
+            if firstrow is None: firstrow = row
+            for n, Agg in enumerate(aggregates):
+                totals[n] = Agg.step(totals[n], row)
+            if detail:
+                outputline = detail(row)
+                if outputline is not None: lines.append(outputline)
+        chunk.append((key, firstrow, {Agg.name: T for Agg, T in zip(aggregates, totals)}, lines))
+        nLines += len(lines)
+        if not lookups or len(chunk) >= chunksize or nLines >= maxlines:
+            yield from Flush()
+            chunk, nLines = [], 0
+    yield from Flush()
@@ -0,0 +1,168 @@
+import csv, io, os, tempfile
+from collections import namedtuple
+from openpyxl import load_workbook
+
+
+SPOOL_MAX_SIZE = 8*1024*1024        # non-seekable uploads are buffered in memory up to this size, then on disk
+
+BadHeaderMsg = 'SAP Spreadsheet has bad header row.  See Calvin to fix this.'
+
+DelimitedText_fileexts = {'.csv': ',', '.tsv': '\t', '.txt': None}     # None - sniff the delimiter from the header line
+
+
+def DelimitedTextNumber(V):
+    """
+    convert a number from a delimited text export to float.
+    SAP writes thousands separators and may put the minus sign last (1,234.500-)
+    if V can't be converted, it is returned unchanged so the caller's validation can flag it
+    """
+    S = V.strip().replace(',', '')
+    if S.endswith('-'): S = '-' + S[:-1]
+    try:
+        return float(S)
+    except ValueError:
+        return V
+
+
+class SprshtReader:
+    """
+    reads the rows of an uploaded spreadsheet straight from the upload (no copy to SAP-FILELOC)
+
+    upldfile is the uploaded file object (req.FILES[...]); if it can't seek, it is spooled into a
+    SpooledTemporaryFile first.  An .xlsx workbook is opened read-only, so rows are streamed, not loaded.
+    A .csv, .tsv or .txt upload (or anything that isn't a zip/xlsx) is read with the csv module instead,
+    which is much faster; empty fields become None and numericFields are converted to float, so rows
+    look the same as they do from a workbook
+
+    SSName_TableName_map maps spreadsheet column names to table field names.  Only the mapped columns
+    found in the header row are returned; if any of requiredFields is missing, an Exception is raised
+
+    iterating the reader yields (rowNum, row), where rowNum is the spreadsheet row number and row is a
+    namedtuple whose fields are the table field names (in the same order as self.fields)
+    """
+
+    def __init__(self, upldfile, SSName_TableName_map, requiredFields=('Material',), sheetName=None, max_row=None, numericFields=()):
+        self._spool = None
+        self._wb = None
+        self._text = None
+        if hasattr(upldfile, 'seek') and getattr(upldfile, 'seekable', lambda: True)():
+            upldfile.seek(0)
+            srcfile = upldfile
+        else:
+            self._spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+            if hasattr(upldfile, 'chunks'):
+                for chunk in upldfile.chunks():
+                    self._spool.write(chunk)
+            else:
+                self._spool.write(upldfile.read())
+            self._spool.seek(0)
+            srcfile = self._spool
+        self.max_row = max_row
+        self.rowsTotal = None       # number of data rows, if it can be known (or estimated) up front
+
+        fileext = os.path.splitext(str(getattr(upldfile, 'name', '') or ''))[1].lower()
+        self.format = 'xlsx'
+        if fileext in DelimitedText_fileexts:
+            self.format = 'text'
+        elif fileext not in ('.xlsx', '.xlsm'):
+            # no help from the name - an xlsx file is a zip archive
+            if srcfile.read(4) != b'PK\x03\x04': self.format = 'text'
+            srcfile.seek(0)
+
+        if self.format == 'xlsx':
+            self._wb = load_workbook(filename=srcfile, read_only=True)
+            if sheetName: self._ws = self._wb[sheetName]
+            else: self._ws = self._wb.active
+            headerrow = next(self._ws.iter_rows(min_row=1, max_row=1, values_only=True), ())
+            # taken from the sheet's dimension record, which most writers (including SAP) fill in
+            if self._ws.max_row: self.rowsTotal = self._ws.max_row - 1
+        else:
+            # SAP's unconverted text export is UTF-16 with a BOM; everything else is taken as UTF-8
+            encoding = 'utf-8-sig'
+            if srcfile.read(2) in (b'\xff\xfe', b'\xfe\xff'): encoding = 'utf-16'
+            srcfile.seek(0)
+            nLines = 0
+            lastchunk = b''
+            for chunk in iter(lambda: srcfile.read(1024*1024), b''):
+                nLines += chunk.count(b'\n')
+                lastchunk = chunk
+            if lastchunk and not lastchunk.rstrip(b'\x00').endswith(b'\n'): nLines += 1    # no newline after the last line
+            srcfile.seek(0)
+            self.rowsTotal = max(nLines - 1, 0)
+            self._text = io.TextIOWrapper(srcfile, encoding=encoding, errors='replace', newline='')
+            delimiter = DelimitedText_fileexts.get(fileext)
+            if delimiter is None:
+                headerline = self._text.readline()
+                self._text.seek(0)
+                delimiter = '\t' if '\t' in headerline else ','
+            self._csv = csv.reader(self._text, delimiter=delimiter)
+            headerrow = [colName.strip().lstrip('\ufeff') for colName in next(self._csv, [])]
+
+        self.colmnMap = {}
+        for colNum, colName in enumerate(headerrow):
+            if colName in SSName_TableName_map:
+                self.colmnMap[SSName_TableName_map[colName]] = colNum
+        for fld in requiredFields:
+            if fld not in self.colmnMap:
+                self.close()
+                raise Exception(BadHeaderMsg)
+
+        if self.rowsTotal is not None and max_row: self.rowsTotal = min(self.rowsTotal, max_row - 1)
+
+        self.fields = tuple(self.colmnMap)
+        self._colNums = tuple(self.colmnMap.values())
+        self._numericFields = frozenset(numericFields)
+        self.RowType = namedtuple('SprshtRow', self.fields)
+
+    def __iter__(self):
+        if self.format == 'xlsx': return self._iter_xlsx()
+        else: return self._iter_text()
+
+    def _iter_xlsx(self):
+        colNums = self._colNums
+        RowType = self.RowType
+        rowNum = 1
+        for rawrow in self._ws.iter_rows(min_row=2, max_row=self.max_row, values_only=True):
+            rowNum += 1
+            nCols = len(rawrow)
+            yield rowNum, RowType._make(rawrow[c] if c < nCols else None for c in colNums)
+
+    def _iter_text(self):
+        # (colNum, isNumeric) for each field, so the per-cell work is one tuple unpack
+        colSpecs = tuple((c, fld in self._numericFields) for fld, c in self.colmnMap.items())
+        RowType = self.RowType
+        max_row = self.max_row
+        rowNum = 1
+        for rawrow in self._csv:
+            rowNum += 1
+            if max_row and rowNum > max_row: break
+            nCols = len(rawrow)
+            vals = []
+            for c, isNumeric in colSpecs:
+                V = rawrow[c] if c < nCols else ''
+                if V == '': V = None
+                elif isNumeric: V = DelimitedTextNumber(V)
+                vals.append(V)
+            yield rowNum, RowType._make(vals)
+
+    def close(self):
+        if self._wb is not None:
+            self._wb.close()
+            self._wb = None
+        if self._text is not None:
+            # don't let the wrapper close the upload out from under Django
+            try:
+                self._text.detach()
+            except ValueError:
+                pass
+            self._text = None
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
@@ -0,0 +1,71 @@
+import csv, datetime, tempfile
+from django.http import StreamingHttpResponse
+from openpyxl import Workbook
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+
+
+EXPORT_FORMATS = {
+        'csv': 'text/csv; charset=utf-8',
+        'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        }
+EXPORT_XLSX_CHUNKSIZE = 64*1024     # bytes per chunk when the finished workbook is streamed out
+
+
+def fnExportFormat(req):
+    """
+    the export format asked for in req (?export=csv or ?export=xlsx), or None for the html report
+    """
+    fmt = req.GET.get('export', '').lower()
+    return fmt if fmt in EXPORT_FORMATS else None
+
+
+class _EchoBuffer:
+    # csv.writer writes a row here, which hands it straight back to be yielded
+    def write(self, value):
+        return value
+
+
+def _csvChunks(header, rows):
+    wrtr = csv.writer(_EchoBuffer())
+    yield '\ufeff'      # so Excel opens it as utf-8
+    yield wrtr.writerow(header)
+    for row in rows:
+        yield wrtr.writerow(row)
+
+
+def _xlsxCell(V):
+    if isinstance(V, str): return ILLEGAL_CHARACTERS_RE.sub('', V)
+    if isinstance(V, datetime.datetime) and V.tzinfo: return V.replace(tzinfo=None)
+    return V
+
+
+def _xlsxChunks(header, rows, sheetName):
+    # a write-only workbook keeps its rows in a temp file, not in memory.  The xlsx (a zip) can only be
+    # put together once the last row is in, so it is saved to a temp file and streamed from there
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(sheetName)
+    ws.append(header)
+    for row in rows:
+        ws.append([_xlsxCell(V) for V in row])
+    with tempfile.TemporaryFile() as f:
+        wb.save(f)
+        f.seek(0)
+        while True:
+            chunk = f.read(EXPORT_XLSX_CHUNKSIZE)
+            if not chunk: break
+            yield chunk
+
+
+def SprshtExportResponse(fmt, fileName, header, rows, sheetName=None):
+    """
+    a StreamingHttpResponse downloading header and rows (an iterable of lists, ideally a generator
+    reading the db as it goes) as fileName.csv or fileName.xlsx.  rows is only read as the response is sent,
+    one row at a time, so memory use doesn't grow with the size of the report
+    """
+    if fmt == 'csv':
+        content = _csvChunks(header, rows)
+    else:
+        content = _xlsxChunks(header, rows, (sheetName or fileName)[:31])
+    resp = StreamingHttpResponse(content, content_type=EXPORT_FORMATS[fmt])
+    resp['Content-Disposition'] = 'attachment; filename="%s.%s"' % (fileName, fmt)
+    return resp
@@ -1,3 +1,204 @@
+import datetime, threading
+from django.contrib.auth.models import User
 from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
+from cMenu.models import cParameters
+from userprofiles.models import WICSuser
+from WICS.models import Organizations, SAP_SOHSnapshots, WhsePartTypes, MaterialList, MaterialListRecon, UploadJobs
+from WICS.models import ActualCounts, CountDailySummary, UploadJobRowResults
+from WICS.procs_ActualCounts import fnCTDQtyEvalBackfill, fnCountAccuracy, procUploadActCountSprsht
+from WICS.procs_SAP import SAP_NumericFields, SAP_SSName_TableName_map, fnSAPIngest, fnSAPValidate
+from WICS.procs_SAP import fnMatlListReconApply, procUpdateMatlListfromSAP, fnSAPSnapshotDate, SAPSnapshotDateCache
+from WICS.procs_UploadJobs import NamedBytesIO, UPLOADJOB_TIMEOUT, fnUploadJobWorker
+from WICS.sprsht_reader import SprshtReader
 
 # Create your tests here.
+
+SAP_CSV = ('Material,Material description,Plant,Material type,Storage location,Base Unit of Measure,'
+           'Unrestricted,Currency,Value Unrestricted,Special Stock,Batch\n'
+           'M1,d,P1,RAW,S1,EA,5,USD,10,,\n')
+
+
+class SAPDeltaStorageParmTests(TestCase):
+    def setUp(self):
+        self.org = Organizations.objects.create(orgname='T')
+
+    def ingest(self, UplDate):
+        with SprshtReader(NamedBytesIO(SAP_CSV.encode(), 'SAP.csv'), SAP_SSName_TableName_map,
+                          numericFields=SAP_NumericFields) as SAPRdr:
+            return fnSAPIngest(self.org, UplDate, SAPRdr)
+
+    def test_truthy_spellings(self):
+        # any spelling makebool takes as true turns delta storage on, and is stored as True
+        for n, ParmValue in enumerate(('YES', 'ON', '1', 'True')):
+            cParameters.objects.update_or_create(ParmName='SAP-DELTA-STORAGE', defaults={'ParmValue': ParmValue})
+            UplDate = '2023-03-%02d' % (n + 1)
+            self.assertIs(self.ingest(UplDate)['DeltaStorage'], True)
+            self.assertIs(SAP_SOHSnapshots.objects.get(org=self.org, uploaded_at=UplDate).DeltaStorage, True)
+
+    def test_falsy_spellings(self):
+        for n, ParmValue in enumerate(('NO', 'off', '')):
+            cParameters.objects.update_or_create(ParmName='SAP-DELTA-STORAGE', defaults={'ParmValue': ParmValue})
+            UplDate = '2023-03-%02d' % (n + 1)
+            self.assertIs(self.ingest(UplDate)['DeltaStorage'], False)
+
+
+class SAPValidateTests(TestCase):
+    def setUp(self):
+        self.org = Organizations.objects.create(orgname='T')
+
+    def test_repeated_row_is_not_an_error(self):
+        # a row the same as an earlier one loads fine, so it is noted but not counted as an error
+        job = UploadJobs.objects.create(org=self.org, JobType='SAP')
+        csvtext = SAP_CSV + SAP_CSV.splitlines(keepends=True)[1]
+        Results = fnSAPValidate(self.org, datetime.date(2023, 3, 1), NamedBytesIO(csvtext.encode(), 'SAP.csv'), job.pk)
+        self.assertEqual((Results['nRows'], Results['nErrors']), (2, 0))
+        self.assertEqual([(R.rowNum, R.isError) for R in UploadJobRowResults.objects.filter(job=job, rowNum=3)],
+                         [(3, False), (3, False)])      # not in MaterialList, and the repeat of row 2
+
+    def test_blank_numeric_is_an_error(self):
+        # fnSAPIngest can't store a blank Unrestricted, so the check-only run mustn't pass it
+        job = UploadJobs.objects.create(org=self.org, JobType='SAP')
+        csvtext = SAP_CSV.replace('RAW,S1,EA,5,USD', 'RAW,S1,EA,,USD')
+        Results = fnSAPValidate(self.org, datetime.date(2023, 3, 1), NamedBytesIO(csvtext.encode(), 'SAP.csv'), job.pk)
+        self.assertEqual(Results['nErrors'], 1)
+        self.assertEqual(UploadJobRowResults.objects.get(job=job, isError=True).Result['error'], 'Amount is blank')
+
+
+class SAPSnapshotDateCacheTests(TestCase):
+    def setUp(self):
+        self.org = Organizations.objects.create(orgname='T')
+
+    def test_sees_uploads_from_other_processes(self):
+        # a snapshot written without going through this process' invalidate, as another process's upload would be
+        Cache = SAPSnapshotDateCache(0)
+        self.assertIsNone(Cache.resolve(self.org, datetime.date(2023, 3, 1)))
+        SAP_SOHSnapshots.objects.create(org=self.org, uploaded_at='2023-02-28')
+        self.assertEqual(Cache.resolve(self.org, datetime.date(2023, 3, 1)), datetime.date(2023, 2, 28))
+        self.assertEqual(Cache.resolve(self.org, datetime.date(2023, 3, 1)), datetime.date(2023, 2, 28))
+        self.assertEqual((Cache.loads, Cache.hits), (2, 1))      # unchanged snapshots aren't reloaded
+
+
+class MatlListReconTests(TestCase):
+    def setUp(self):
+        self.org = Organizations.objects.create(orgname='T')
+        self.PartType = WhsePartTypes.objects.create(org=self.org, WhsePartType='UNKNOWN', PartTypePriority=1)
+        MaterialList.objects.create(org=self.org, Material='M1', Description='one', PartType=self.PartType,
+                                    SAPMaterialType='RAW', SAPMaterialGroup='G', Price=3.5, PriceUnit=1)
+        self.job = UploadJobs.objects.create(org=self.org, JobType='MatlList')
+
+    def reconcile(self, csvtext):
+        procUpdateMatlListfromSAP(self.org, NamedBytesIO(csvtext.encode(), 'MM60.csv'), {'jobID': self.job.pk})
+        return {(R.Action, R.Material): R for R in MaterialListRecon.objects.filter(job=self.job)}
+
+    def test_missing_columns_are_not_changes(self):
+        # no Price or Price unit columns: Price is left alone, only the Description change is found and applied
+        Recon = self.reconcile('Material,Material description,Material type,Material Group\nM1,uno,RAW,G\n')
+        self.assertEqual(list(Recon), [('CHANGED', 'M1')])
+        self.assertEqual(Recon[('CHANGED', 'M1')].Changes, {'Description': ['one', 'uno']})
+        fnMatlListReconApply(self.org, self.job)
+        M1 = MaterialList.objects.get(org=self.org, Material='M1')
+        self.assertEqual((M1.Description, M1.Price, M1.PriceUnit), ('uno', 3.5, 1))
+
+    def test_material_spaces_and_case(self):
+        # ' m1 ' is M1, not a NEW m1 and a REMOVED M1
+        Recon = self.reconcile('Material,Material description,Material type,Material Group,Price,Price unit\n m1 ,one,RAW,G,3.5,1\n')
+        self.assertEqual(Recon, {})
+
+    def test_select_without_job(self):
+        User.objects.create_user('t', password='p')
+        WICSuser.objects.create(user=User.objects.get(username='t'), org=self.org)
+        self.client.login(username='t', password='p')
+        resp = self.client.post('/UpdateMatlListfromSAP', {'NextPhase': '03-Select', 'SelectAll': '1'})
+        self.assertEqual(resp.status_code, 404)
+
+
+class CountSummaryTests(TestCase):
+    def setUp(self):
+        self.org = Organizations.objects.create(orgname='T')
+        PartType = WhsePartTypes.objects.create(org=self.org, WhsePartType='UNKNOWN', PartTypePriority=1)
+        self.M1 = MaterialList.objects.create(org=self.org, Material='M1', PartType=PartType)
+
+    def test_backfill_rebuilds_summary(self):
+        # bulk_create skips save(), so neither the evaluation nor the summary are done until the backfill
+        ActualCounts.objects.bulk_create([ActualCounts(org=self.org, CountDate='2023-03-01', Material=self.M1,
+                                                       Counter='c', CTD_QTY_Expr=Expr) for Expr in ('2*3', '4')])
+        self.assertEqual(fnCTDQtyEvalBackfill(self.org), 2)
+        Summ = CountDailySummary.objects.get(org=self.org, CountDate='2023-03-01', Material=self.M1)
+        self.assertEqual((Summ.nCounts, Summ.CountTotal), (2, 10))
+
+    def test_summary_ignores_stale_snapshot_dates(self):
+        # the per-process date cache still says there are no snapshots; the stored row must not
+        self.assertIsNone(fnSAPSnapshotDate(self.org, datetime.date(2023, 3, 1)))
+        SAP_SOHSnapshots.objects.create(org=self.org, uploaded_at='2023-02-28')
+        ActualCounts.objects.create(org=self.org, CountDate='2023-03-01', Material=self.M1, Counter='c', CTD_QTY_Expr='1')
+        Summ = CountDailySummary.objects.get(org=self.org, CountDate='2023-03-01', Material=self.M1)
+        self.assertEqual(Summ.SAPDate, datetime.date(2023, 2, 28))
+
+    def test_accuracy_leaves_out_unevaluated_counts(self):
+        for Key, Value in (('ACCURACY-DANGER', '50'), ('ACCURACY-WARNING', '90'), ('ACCURACY-SUCCESS', '98')):
+            cParameters.objects.update_or_create(ParmName=Key, defaults={'ParmValue': Value})
+        for CountDate, Expr in (('2023-03-01', '5'), ('2023-03-01', 'x+'), ('2023-03-02', 'x+')):
+            ActualCounts.objects.create(org=self.org, CountDate=CountDate, Material=self.M1, Counter='c', CTD_QTY_Expr=Expr)
+        Acc = fnCountAccuracy(self.org, datetime.date(2023, 3, 1), datetime.date(2023, 3, 2))
+        Day1, Day2 = Acc['ByDay']
+        self.assertEqual((Day1['nCounts'], Day1['nNotEvaluated'], Day1['nMaterials'], Day1['CountTotal']), (2, 1, 1, 5))
+        # no count of M1 on the 2nd could be evaluated: no accuracy, rather than 0%
+        self.assertEqual((Day2['nCounts'], Day2['nNotEvaluated'], Day2['nMaterials'], Day2['Accuracy']), (1, 1, 0, None))
+        M1 = Acc['ByMaterial'][0]
+        self.assertEqual((M1['nDays'], M1['nNotEvaluated'], M1['LastCountDate']), (1, 2, datetime.date(2023, 3, 1)))
+
+
+class CountSprshtUploadTests(TestCase):
+    def setUp(self):
+        self.org = Organizations.objects.create(orgname='T')
+        PartType = WhsePartTypes.objects.create(org=self.org, WhsePartType='UNKNOWN', PartTypePriority=1)
+        MaterialList.objects.create(org=self.org, Material='M1', PartType=PartType)
+
+    def upload(self, rows, ValidateOnly=False):
+        job = UploadJobs.objects.create(org=self.org, JobType='CountSprsht')
+        csvtext = 'CountDate,Counter,BLDG,LOCATION,Material,LocationOnly,CTD_QTY_Expr\n' + \
+                    ''.join(f'2023-03-01,c,B,L{n},M1,{LocOnly},\n' for n, LocOnly in enumerate(rows))
+        Results = procUploadActCountSprsht(self.org, NamedBytesIO(csvtext.encode(), 'Counts.csv'),
+                                           {'jobID': job.pk, 'ValidateOnly': ValidateOnly})
+        return job, Results
+
+    def test_locationonly_spellings(self):
+        # what Excel writes for a checkbox column, among others
+        job, Results = self.upload(['TRUE', 'Yes', '1', 'FALSE', 'no'])
+        self.assertEqual((Results['nRowsAdded'], Results['nErrors']), (5, 0))
+        self.assertEqual(list(ActualCounts.objects.filter(org=self.org).order_by('LOCATION').values_list('LocationOnly', flat=True)),
+                         [True, True, True, False, False])
+
+    def test_locationonly_unknown_spelling(self):
+        # reported on its row, in the check-only run and the real one; the row doesn't load
+        for ValidateOnly in (True, False):
+            job, Results = self.upload(['TRUE', 'maybe'], ValidateOnly=ValidateOnly)
+            self.assertEqual(Results['nRowsAdded'], 1)
+            Errs = UploadJobRowResults.objects.filter(job=job, isError=True)
+            self.assertEqual({R.rowNum for R in Errs}, {3})
+            self.assertIn('maybe is invalid for LocationOnly', [R.Result['error'] for R in Errs])
+        self.assertEqual(ActualCounts.objects.filter(org=self.org).count(), 1)
+
+
+class StaleUploadJobTests(TestCase):
+    def setUp(self):
+        self.org = Organizations.objects.create(orgname='T')
+        self.Old = UploadJobs.objects.create(org=self.org, JobType='SAP', Status='RUNNING', FileData=b'x',
+                                             StartedAt=timezone.now() - datetime.timedelta(seconds=UPLOADJOB_TIMEOUT + 60))
+        self.New = UploadJobs.objects.create(org=self.org, JobType='SAP', Status='RUNNING', FileData=b'x', StartedAt=timezone.now())
+
+    def test_worker_fails_stale_jobs(self):
+        fnUploadJobWorker(threading.Event(), exitWhenIdle=True)
+        self.Old.refresh_from_db()
+        self.New.refresh_from_db()
+        self.assertEqual((self.Old.Status, self.Old.FileData), ('FAILED', None))
+        self.assertEqual(self.New.Status, 'RUNNING')
+
+    def test_status_poll_fails_stale_job(self):
+        User.objects.create_user('t', password='p')
+        WICSuser.objects.create(user=User.objects.get(username='t'), org=self.org)
+        self.client.login(username='t', password='p')
+        self.assertEqual(self.client.get(reverse('UploadJobStatus', args=[self.Old.pk])).json()['Status'], 'FAILED')
+        self.assertEqual(self.client.get(reverse('UploadJobStatus', args=[self.New.pk])).json()['Status'], 'RUNNING')
@@ -16,7 +16,7 @@ Including another URLconf
 from django.urls import path, reverse
 from django.shortcuts import redirect
 from WICS import userinit
-from WICS import procs_ActualCounts, procs_CountSchedule, procs_Material, procs_SAP, views
+from WICS import procs_ActualCounts, procs_CountSchedule, procs_Material, procs_SAP, procs_UploadJobs, views
 from WICS import adhoc_2023_02_01_001
 from userprofiles import logout
 
@@ -58,6 +58,8 @@ urlpatterns = [
             procs_ActualCounts.fnCountSummaryRpt, name='CountSummaryReport'),
     path('CountSummaryRpt/<str:passedCountDate>',
             procs_ActualCounts.fnCountSummaryRpt, name='CountSummaryReport'),
+    path('CountAccuracyRpt',
+            procs_ActualCounts.fnCountAccuracyRpt, name='CountAccuracyReport'),
 
     path('CountWorksheet',
             procs_CountSchedule.CountWorksheetReport.as_view(),name='CountWorksheet'),
@@ -101,9 +103,13 @@ urlpatterns = [
     path('UpldActCtSprsht', procs_ActualCounts.fnUploadActCountSprsht, name='UploadActualCountSprsht'),
 
     path('UpdateMatlListfromSAP',procs_SAP.fnUpdateMatlListfromSAP, name='UpdateMatlListfromSAP'),
+    path('UpdateMatlListfromSAP/<int:jobID>',procs_SAP.fnUpdateMatlListfromSAP, name='UpdateMatlListfromSAP-Review'),
 
     path('UpldSAPSprsht',procs_SAP.fnUploadSAP, name='UploadSAPSprSht'),
 
+    path('UploadJob/<int:jobID>',procs_UploadJobs.fnUploadJobResult, name='UploadJobResult'),
+    path('UploadJobStatus/<int:jobID>',procs_UploadJobs.fnUploadJobStatus, name='UploadJobStatus'),
+
     path('adhoc-2023-02-01-001',adhoc_2023_02_01_001.adhoc001,name='adhoc-2023-02-01-001'),
 
 ]
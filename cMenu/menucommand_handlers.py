@@ -73,6 +73,10 @@ def FormBrowse(req, formname, recNum = -1):
         url = 'CountScheduleForm'
         theView = resolve(reverse(url)).func
         theForm = theView(req)
+    elif formname.lower() == 'rptCountAccuracy'.lower():
+        url = 'CountAccuracyReport'
+        theView = resolve(reverse(url)).func
+        theForm = theView(req)
     elif formname.lower() == 'rptCountWorksheet'.lower():
         url = 'CountWorksheet'
         theView = resolve(reverse(url)).func
@@ -0,0 +1,281 @@
+"""
+benchmark and regression check for the expression evaluator (math_compiler, eval)
+
+    python -m mathematical_expressions_parser.benchmark [--repeat N] [--check] [--save-baseline]
+
+The corpus is the CTD_QTY_Expr values of the count test data (initdata/testdata20230302.py),
+the load_data count CSVs, the examples that used to be in eval.py, and synthetic long sums.
+For each part of the corpus it checks that MathCompiler agrees with MathParser, times
+parsing (MathParser, uncached MathCompiler) and evaluating (evaluate with a cold and a warm
+cache, evaluate_many), and reports the compile cache hit rate.
+
+Timings are reported as speedups over MathParser on the same corpus in the same run, so a
+baseline saved on one machine is still meaningful on another.  --check compares them to the
+baseline (benchmark_baseline.json) and exits with 1 if any is more than --tolerance below it,
+if the hit rate dropped, or if MathCompiler and MathParser disagree anywhere
+"""
+import argparse
+import ast
+import csv
+import json
+import os
+import random
+import sys
+import time
+from mathematical_expressions_parser.eval import evaluate, evaluate_many
+from mathematical_expressions_parser.math_compiler import MathCompiler, compile_expression
+from mathematical_expressions_parser.math_parser import MathParser
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TESTDATA_FILE = os.path.join(REPO_DIR, "initdata", "testdata20230302.py")
+COUNTS_CSV_FILES = [
+    os.path.join(REPO_DIR, "WICS", "load_data", "Counts.csv"),
+    os.path.join(REPO_DIR, "WICS", "load_data", "ARCHV_Counts.csv"),
+]
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+
+# (expression, in_vars) - the examples from the old eval.py __main__
+EXAMPLES = [
+    ("cos(x+4*3) + 2 * 3", {"x": 5}),
+    ("exp(0)", None),
+    ("-(1 + 2) * 3", None),
+    ("(1-2)/3.0 + 0.0000", None),
+    ("abs(-2) + pi / 4", None),
+    ("(x + e * 10) / 10", {"x": 3}),
+    ("1.0 / 3 * 6", None),
+    ("(1 - 1 + -1) * pi", None),
+    ("cos(pi) * 1", None),
+    ("atan2(2, 1)", None),
+    ("hypot(5, 12)", None),
+    ("pow(3, 5)", None),
+    ("800*101+84+790+800*2+766+796+780", None),     # 85616
+    ("25+48*(2*35+1)", None),                       # 3433
+    ("40+6+2600*11+*589+457+3+1467+2*100+20+1720+893+5", None),    # SyntaxError
+]
+
+
+def testdata_exprs(path=TESTDATA_FILE):
+    """
+    the CTD_QTY_Expr (5th item) of each acttestdata tuple in path.  The file is read with ast,
+    not imported, since it imports the Django models
+    """
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    exprs = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Assign) and any(getattr(t, "id", None) == "acttestdata" for t in node.targets):
+            for row in node.value.elts:
+                if isinstance(row, ast.Tuple) and len(row.elts) > 4 and isinstance(row.elts[4], ast.Constant):
+                    exprs.append(row.elts[4].value)
+    return exprs
+
+
+def csv_exprs(path, column="CTD QTY Expr"):
+    if not os.path.exists(path):
+        return []
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        return [row[column] for row in csv.DictReader(f) if row.get(column) is not None]
+
+
+def synthetic_sums(n, min_terms=20, max_terms=200, seed=20230302):
+    """
+    n long sums in the shapes the counters type: pallets*qty, loose counts, and the odd
+    parenthesized group - like the longest expressions in the count data, only longer
+    """
+    rnd = random.Random(seed)
+
+    def term():
+        shape = rnd.random()
+        if shape < 0.5:
+            return str(rnd.randint(1, 4000))
+        if shape < 0.85:
+            return "%d*%d" % (rnd.randint(2, 2600), rnd.randint(1, 120))
+        return "%d*(%d+%d)" % (rnd.randint(2, 800), rnd.randint(1, 60), rnd.randint(1, 60))
+
+    return ["+".join(term() for _ in range(rnd.randint(min_terms, max_terms))) for _ in range(n)]
+
+
+def build_corpus(synthetic=1000):
+    """
+    {name: [(expression, in_vars)]} - the parts of the corpus that are available
+    """
+    corpus = {
+        "examples": list(EXAMPLES),
+        "testdata": [(e, None) for e in testdata_exprs()],
+        "load_data": [(e, None) for path in COUNTS_CSV_FILES for e in csv_exprs(path)],
+        "synthetic": [(e, None) for e in synthetic_sums(synthetic)],
+    }
+    return {name: exprs for name, exprs in corpus.items() if exprs}
+
+
+def _outcome(fn):
+    try:
+        return ("value", fn())
+    except Exception as ex:
+        return (type(ex).__name__, str(ex))
+
+
+def disagreements(exprs):
+    """
+    the (expression, in_vars) of exprs where MathCompiler and MathParser give a different value or error
+    """
+    differ = []
+    for expr, in_vars in exprs:
+        v = in_vars or {}
+        if _outcome(lambda: MathParser(expr, v).getValue()) != _outcome(lambda: MathCompiler(expr).compile()(v)):
+            differ.append((expr, in_vars))
+    return differ
+
+
+MIN_RUN_SECONDS = 0.05
+
+
+def _best(fn, repeat, cold=True):
+    # seconds for one fn(), the best of repeat runs.  A run calls fn() as often as it takes to
+    # last MIN_RUN_SECONDS, so a small corpus is timed as reliably as a big one.
+    # cold clears the compile cache before each fn()
+    def timed(number):
+        tStart = time.perf_counter()
+        for _ in range(number):
+            if cold:
+                compile_expression.cache_clear()
+            fn()
+        return (time.perf_counter() - tStart) / number
+
+    first = timed(1)
+    number = max(1, int(MIN_RUN_SECONDS / max(first, 1e-9)))
+    return min([first] + [timed(number) for _ in range(max(repeat, 1))])
+
+
+def _each(fn, exprs):
+    def run():
+        for expr, in_vars in exprs:
+            try:
+                fn(expr, in_vars)
+            except Exception:
+                pass
+    return run
+
+
+def measure(exprs, repeat=3):
+    """
+    the benchmark of one corpus (a list of (expression, in_vars)).  Returns
+    {'n', 'distinct', 'disagree', 'hit_rate', 'seconds': {pass: s}, 'speedup': {pass: x MathParser}}
+    """
+    groups = [([e for e, v in exprs if v == vs], vs) for vs in _distinct_vars(exprs)]
+    passes = {
+        "MathParser": (_each(lambda e, v: MathParser(e, v or {}).getValue(), exprs), True),
+        "compile": (_each(lambda e, v: MathCompiler(e).compile()(v or {}), exprs), True),
+        "evaluate_cold": (_each(evaluate, exprs), True),
+        "evaluate_warm": (_each(evaluate, exprs), False),
+        "evaluate_many": (lambda: [evaluate_many(es, vs) for es, vs in groups], True),
+    }
+    seconds = {}
+    for name, (fn, cold) in passes.items():
+        if not cold:
+            fn()    # prime the cache
+        seconds[name] = _best(fn, repeat, cold)
+
+    # how often a record's expression is already compiled, evaluating the corpus once from cold
+    compile_expression.cache_clear()
+    passes["evaluate_cold"][0]()
+    info = compile_expression.cache_info()
+
+    return {
+        "n": len(exprs),
+        "distinct": len({e for e, v in exprs}),
+        "disagree": disagreements(exprs),
+        "hit_rate": info.hits / max(info.hits + info.misses, 1),
+        "seconds": seconds,
+        "speedup": {name: seconds["MathParser"] / max(s, 1e-9) for name, s in seconds.items() if name != "MathParser"},
+    }
+
+
+def _distinct_vars(exprs):
+    # the distinct in_vars of exprs, in order (evaluate_many takes one in_vars for all its expressions)
+    varsets = []
+    for e, v in exprs:
+        if v not in varsets:
+            varsets.append(v)
+    return varsets
+
+
+def run(corpus, repeat=3, out=sys.stdout):
+    """
+    measure each part of corpus ({name: [(expression, in_vars)]}) and print a report to out.  Returns {name: measure()}
+    """
+    results = {}
+    for name, exprs in corpus.items():
+        R = results[name] = measure(exprs, repeat)
+        out.write("%s: %d expressions, %d distinct, compile cache hit rate %.1f%%\n"
+                  % (name, R["n"], R["distinct"], R["hit_rate"] * 100))
+        for passname, s in R["seconds"].items():
+            out.write("  %-14s %8.4f s %12.0f exprs/s%s\n" % (
+                passname, s, R["n"] / max(s, 1e-9),
+                "  %5.1fx MathParser" % R["speedup"][passname] if passname in R["speedup"] else ""))
+        for expr, in_vars in R["disagree"][:10]:
+            out.write("  MathCompiler and MathParser differ: %r %r\n" % (expr, in_vars))
+    return results
+
+
+def baseline_of(results):
+    return {name: {"speedup": {p: round(x, 2) for p, x in R["speedup"].items()}, "hit_rate": round(R["hit_rate"], 4)}
+            for name, R in results.items()}
+
+
+def regressions(results, baseline, tolerance=0.3):
+    """
+    what is wrong with results compared to baseline (as baseline_of writes it): a list of messages, empty if nothing
+    """
+    problems = []
+    for name, R in results.items():
+        if R["disagree"]:
+            problems.append("%s: MathCompiler and MathParser differ on %d expressions" % (name, len(R["disagree"])))
+        B = baseline.get(name)
+        if not B:
+            continue
+        for passname, x in R["speedup"].items():
+            expected = B["speedup"].get(passname)
+            if expected and x < expected * (1 - tolerance):
+                problems.append("%s: %s is %.2fx MathParser, baseline %.2fx" % (name, passname, x, expected))
+        if R["hit_rate"] < B["hit_rate"] - 0.001:
+            problems.append("%s: cache hit rate %.1f%%, baseline %.1f%%" % (name, R["hit_rate"] * 100, B["hit_rate"] * 100))
+    return problems
+
+
+def main(argv=None):
+    argp = argparse.ArgumentParser(prog="python -m mathematical_expressions_parser.benchmark",
+                                   description="benchmark the expression evaluator against MathParser")
+    argp.add_argument("--repeat", type=int, default=3, help="run each pass this many times and keep the best (default 3)")
+    argp.add_argument("--synthetic", type=int, default=1000, help="number of synthetic long sums (default 1000)")
+    argp.add_argument("--baseline", default=BASELINE_FILE, help="baseline file (default benchmark_baseline.json)")
+    argp.add_argument("--check", action="store_true", help="exit with 1 if anything is slower than the baseline")
+    argp.add_argument("--tolerance", type=float, default=0.3, help="how far below the baseline a speedup may be (default 0.3)")
+    argp.add_argument("--save-baseline", action="store_true", help="write these results as the baseline")
+    args = argp.parse_args(argv)
+
+    results = run(build_corpus(args.synthetic), args.repeat)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(baseline_of(results), f, indent=2, sort_keys=True)
+            f.write("\n")
+        print("baseline saved to", args.baseline)
+
+    # without --check, only a disagreement with MathParser is a problem
+    baseline = {}
+    if args.check:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    problems = regressions(results, baseline, args.tolerance)
+    for p in problems:
+        print("REGRESSION:", p)
+    print("%d regressions" % len(problems))
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,18 +2,24 @@
 Taken from https://github.com/blakeohare/Mathematical-Expressions-Parser
 """
 # import math
-from mathematical_expressions_parser.math_parser import MathParser
+from collections import namedtuple
+from mathematical_expressions_parser.math_parser import _CONSTANTS
+from mathematical_expressions_parser.math_compiler import compile_expression
+
+# one result of evaluate_many: error is None, or the exception evaluate raised (and value is None)
+Evaluated = namedtuple('Evaluated', 'value error')
 
 def evaluate(expression, in_vars = None):
     """
-    I'll do a docstring one day
+    value of expression, with the variables in in_vars.  The expression is compiled once
+    (see math_compiler.compile_expression) and the compiled form is reused, so the same
+    expression on many count records is only parsed once
     """
-    try:
-        pars = MathParser(expression, in_vars)
-        value = pars.getValue()
-    except Exception as ex:
-        raise ex
-        # value = 0
+    in_vars = {} if in_vars == None else in_vars
+    for constant in _CONSTANTS.keys():
+        if in_vars.get(constant) != None:
+            raise NameError("Cannot redefine the value of " + constant)
+    value = compile_expression(expression)(in_vars)
 
     # Return an integer type if the answer is an integer
     if int(value) == value:
@@ -27,23 +33,24 @@ def evaluate(expression, in_vars = None):
         return int(value)
     return value
 
+def evaluate_many(expressions, in_vars = None):
+    """
+    evaluate each of expressions (strings), all with the same in_vars.  Returns a list of Evaluated,
+    in the same order as expressions.  Each distinct expression is evaluated once, however often it appears
+    """
+    results = {}
+    evaluated = []
+    for expression in expressions:
+        if expression not in results:
+            try:
+                results[expression] = Evaluated(evaluate(expression, in_vars), None)
+            except Exception as ex:
+                results[expression] = Evaluated(None, ex)
+        evaluated.append(results[expression])
+    return evaluated
+
 if __name__ == "__main__":
-    testexpressions = [
-        #{'exp_to_eval':"cos(x+4*3) + 2 * 3", 'vars':{ 'x': 5  }},
-        #{'exp_to_eval':"exp(0)", 'vars':None},
-        #{'exp_to_eval':"-(1 + 2) * 3", 'vars':None},
-        #{'exp_to_eval':"(1-2)/3.0 + 0.0000", 'vars':None},
-        #{'exp_to_eval':"abs(-2) + pi / 4", 'vars':None},
-        #{'exp_to_eval':"(x + e * 10) / 10", 'vars':{ 'x' : 3 }},
-        #{'exp_to_eval':"1.0 / 3 * 6", 'vars':None},
-        #{'exp_to_eval':"(1 - 1 + -1) * pi", 'vars':None},
-        #{'exp_to_eval':"cos(pi) * 1", 'vars':None},
-        #{'exp_to_eval':"atan2(2, 1)", 'vars':None},
-        #{'exp_to_eval':"hypot(5, 12)", 'vars':None},
-        #{'exp_to_eval':"pow(3, 5)", 'vars':None},
-        #{'exp_to_eval':"800*101+84+790+800*2+766+796+780", 'vars': None},   # 85616
-        #{'exp_to_eval':"25+48*(2*35+1)", 'vars': None},   # 3433
-        {'exp_to_eval':"40+6+2600*11+*589+457+3+1467+2*100+20+1720+893+5", 'vars':None},
-    ]
-    for TestE in testexpressions:
-        print(TestE['exp_to_eval']," = ", evaluate(TestE['exp_to_eval'], TestE['vars'] ) )
+    # the examples that were here are part of the benchmark corpus now
+    import sys
+    from mathematical_expressions_parser.benchmark import main
+    sys.exit(main())
@@ -0,0 +1,312 @@
+"""
+module for class MathCompiler and compile_expression
+"""
+import re
+from collections import namedtuple
+from functools import lru_cache
+from mathematical_expressions_parser.math_parser import MathParser, _CONSTANTS, _FUNCTIONS
+
+
+EXPRESSION_CACHE_SIZE = 4096
+
+# one token per match: a number, a name, or any other single character.  Whitespace between tokens
+# is skipped - the same whitespace MathParser skips.  Names are the characters MathParser accepts in a
+# variable (c.lower() in _a-z0-9 - which lets in the Kelvin sign, U+212A); a name never starts with a
+# digit, since a digit or '.' starts a number
+_TOKEN_RE = re.compile(r"[ \t\n\r]*(?:([0-9.]+)|([_A-Za-z0-9\u212a]+)|([^ \t\n\r]))", re.DOTALL)
+NUM, NAME, OP, END = 1, 2, 3, None     # token kinds: the _TOKEN_RE group that matched
+
+# binary operators and their precedence; the operands of the tightest level are unary terms
+_BINARY = {"+": 1, "-": 1, "*": 2, "/": 2}
+_TIGHTEST = 2
+
+
+def tokenize(string):
+    """
+    the tokens of string, as (kind, text, pos), ending with (END, '', len(string)).  Never raises -
+    anything unexpected is a one-character OP token, and is only an error if the parser gets to it
+    """
+    tokens = [(m.lastindex, m.group(m.lastindex), m.start(m.lastindex)) for m in _TOKEN_RE.finditer(string)]
+    tokens.append((END, "", len(string)))
+    return tokens
+
+
+class MathCompiler:
+    """
+    compiles an expression into a function of in_vars.  The string is tokenized once (tokenize),
+    then the tokens are parsed by precedence climbing.  The grammar, the error messages and the
+    arithmetic are MathParser's: a-b is a+(-1*b), a/b is a*(1.0/b) (after the check for 0), every
+    sum is sum() of its terms and every product is 1.0 times its factors, in order.
+    Parts that don't depend on in_vars are computed as they are parsed, as MathParser does,
+    unless that raises - then the error is left for evaluation time
+
+    MathParser computes as it parses, so when an expression has a syntax error, anything before the
+    error is computed first, and that can raise instead (an unknown variable, a division by 0).
+    So on an error, compile() raises it with self.pending holding the finished parts that MathParser
+    would already have computed, in order (see compile_expression)
+    """
+
+    def __init__(self, string):
+        self.string = string
+        self.tokens = tokenize(string)
+        self.i = 0
+        self.pending = []   # lists of finished nodes whose values MathParser would have by now
+
+    def compile(self):
+        node = self.parseExpression()
+        kind, text, pos = self.tokens[self.i]
+
+        if kind is not END:
+            self.pending.append([node])
+            raise SyntaxError(
+                "Unexpected character found: '"
+                + self.string[pos]
+                + "' at index "
+                + str(pos)
+            )
+        return _build(node)
+
+    def parseExpression(self):
+        return self.parseLevel(1)
+
+    def parseLevel(self, prec):
+        # the operands joined by the operators of precedence prec: a sum (1) or a product (2)
+        # the operands of the tightest level are unary terms, the others are the next level's
+        parseOperand = self.parseUnary if prec == _TIGHTEST else (lambda: self.parseLevel(prec + 1))
+        operands = [parseOperand()]
+        self.pending.append(operands)
+
+        while True:
+            kind, text, pos = self.tokens[self.i]
+            if kind != OP or _BINARY.get(text) != prec:
+                break
+            self.i += 1
+            operand = parseOperand()
+            if text == "-":
+                operand = _negated(operand)
+            elif text == "/":
+                operand = _reciprocal(operand, pos)
+            operands.append(operand)
+
+        self.pending.pop()
+        if prec == 1:
+            return _sum(operands)
+        return _product(operands)
+
+    def parseUnary(self):
+        kind, text, pos = self.tokens[self.i]
+
+        if kind == OP and text == "(":
+            self.i += 1
+            node = self.parseExpression()
+            kind, text, pos = self.tokens[self.i]
+
+            if kind != OP or text != ")":
+                self.pending.append([node])
+                raise SyntaxError(
+                    "No closing parenthesis found at character " + str(pos)
+                )
+            self.i += 1
+            return node
+        elif kind == OP and text == "-":
+            self.i += 1
+            return _negated(self.parseUnary())
+        elif kind == NUM or kind is END:
+            return self.parseNumber()
+        else:
+            return self.parseName()
+
+    def parseNumber(self):
+        kind, text, pos = self.tokens[self.i]
+        if kind is END:
+            raise SyntaxError("Unexpected end found")
+
+        firstPeriod = text.find(".")
+        if firstPeriod >= 0 and text.find(".", firstPeriod + 1) >= 0:
+            raise SyntaxError(
+                "Found an extra period in a number at character "
+                + str(pos + text.find(".", firstPeriod + 1))
+                + ". Are you European?"
+            )
+        self.i += 1
+        return ("value", float(text))
+
+    def parseName(self):
+        # anything that isn't a name here is read as the variable '' (and not consumed), as MathParser does
+        kind, text, pos = self.tokens[self.i]
+        var = ""
+        if kind == NAME:
+            var = text
+            self.i += 1
+
+        function = _FUNCTIONS.get(var.lower())
+        if function != None:
+            return _call(function, self.parseArguments())
+
+        constant = _CONSTANTS.get(var.lower())
+        if constant != None:
+            return ("value", constant)
+
+        return ("var", var)
+
+    def parseArguments(self):
+        args = []
+        kind, text, pos = self.tokens[self.i]
+        if kind != OP or text != "(":
+            raise SyntaxError("Expected '(' at index " + str(pos))
+        self.i += 1
+        self.pending.append(args)
+
+        # MathParser looks for the ')' right after the '(' before it skips any whitespace,
+        # so "f( )" is called with the variable '', not with no arguments
+        if self.string[pos + 1 : pos + 2] != ")":
+            while True:
+                if len(args) > 0:
+                    kind, text, pos = self.tokens[self.i]
+                    if kind != OP or text != ",":
+                        raise SyntaxError("Expected ',' at index " + str(pos))
+                    self.i += 1
+                args.append(self.parseExpression())
+                kind, text, pos = self.tokens[self.i]
+                if kind == OP and text == ")":
+                    break
+        self.i += 1
+
+        self.pending.pop()
+        return args
+
+
+# the nodes.  A ("value", v) node is already computed; the others are computed by _build's functions
+
+def _negated(node):
+    if node[0] == "value":
+        return ("value", -1 * node[1])
+    return ("neg", node)
+
+
+def _reciprocal(node, div_index):
+    if node[0] == "value" and node[1] != 0:
+        return ("value", 1.0 / node[1])
+    return ("recip", node, div_index)
+
+
+def _sum(terms):
+    for term in terms:
+        if term[0] != "value":
+            return ("sum", terms)
+    return ("value", sum([term[1] for term in terms]))
+
+
+def _product(factors):
+    value = 1.0
+    for factor in factors:
+        if factor[0] != "value":
+            return ("product", factors)
+        value *= factor[1]
+    return ("value", value)
+
+
+def _call(function, args):
+    if all(arg[0] == "value" for arg in args):
+        try:
+            return ("value", float(function(*[arg[1] for arg in args])))
+        except Exception:
+            pass    # left to raise when it is evaluated
+    return ("call", function, args)
+
+
+def _build(node):
+    """
+    the function of in_vars that computes node
+    """
+    kind = node[0]
+
+    if kind == "value":
+        value = node[1]
+        return lambda in_vars: value
+
+    if kind == "var":
+        var = node[1]
+
+        def variable(in_vars):
+            value = in_vars.get(var, None)
+            if value != None:
+                return float(value)
+            raise NameError("Unrecognized variable: '" + var + "'")
+
+        return variable
+
+    if kind == "neg":
+        operand = _build(node[1])
+        return lambda in_vars: -1 * operand(in_vars)
+
+    if kind == "recip":
+        operand = _build(node[1])
+        div_index = node[2]
+
+        def reciprocal(in_vars):
+            denominator = operand(in_vars)
+            if denominator == 0:
+                raise ZeroDivisionError(
+                    "Division by 0 kills baby whales (occured at index "
+                    + str(div_index)
+                    + ")"
+                )
+            return 1.0 / denominator
+
+        return reciprocal
+
+    if kind == "sum":
+        terms = [_build(term) for term in node[1]]
+        if len(terms) == 1:
+            term = terms[0]
+            return lambda in_vars: sum([term(in_vars)])
+        return lambda in_vars: sum([term(in_vars) for term in terms])
+
+    if kind == "product":
+        factors = [_build(factor) for factor in node[1]]
+
+        def product(in_vars):
+            values = [factor(in_vars) for factor in factors]
+            value = 1.0
+            for v in values:
+                value *= v
+            return value
+
+        return product
+
+    if kind == "call":
+        function = node[1]
+        args = [_build(arg) for arg in node[2]]
+        return lambda in_vars: float(function(*[arg(in_vars) for arg in args]))
+
+    raise ValueError("unknown node " + repr(kind))
+
+
+def _failed(err, finished):
+    # what MathParser does with a bad expression: compute what it parsed before the error, then raise it
+    finished = [_build(node) for node in finished]
+
+    def failed(in_vars):
+        for part in finished:
+            part(in_vars)
+        raise type(err)(*err.args)
+
+    return failed
+
+
+@lru_cache(maxsize=EXPRESSION_CACHE_SIZE)
+def compile_expression(expression):
+    """
+    returns a function of in_vars (a dict) that computes expression, cached on the expression string.
+    It gives exactly the value, or raises exactly the error, that MathParser(expression, in_vars).getValue()
+    would.  (Anything but a str goes to MathParser, which has its own ideas about what is wrong with it)
+    """
+    if not isinstance(expression, str):
+        return lambda in_vars: MathParser(expression, in_vars).getValue()
+
+    compiler = MathCompiler(expression)
+    try:
+        return compiler.compile()
+    except (SyntaxError, ValueError) as err:
+        return _failed(err, [node for nodes in compiler.pending for node in nodes])